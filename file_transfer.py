@@ -1,512 +1,4178 @@
+import argparse
+import bisect
+import contextlib
 import socket
 import os
+import mmap
+import stat
+import struct
+import subprocess
+import hashlib
+import collections
+import heapq
+import ipaddress
+import itertools
+import json
+import math
+import random
 import threading
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
+import uuid
+import sys
 import time
-from tkinter.font import Font
-
-class CustomStyle:
-    PRIMARY = "#2C3E50"
-    SECONDARY = "#3498DB"
-    ACCENT = "#27AE60"
-    WARNING = "#F39C12"
-    ERROR = "#E74C3C"
-    BG_GRADIENT_1 = "#2980B9"
-    BG_GRADIENT_2 = "#6DD5FA"
-    BG_GRADIENT_3 = "#FFFFFF"
-    TEXT_LIGHT = "#ECF0F1"
-    TEXT_DARK = "#2C3E50"
-
-class GradientFrame(tk.Canvas):
-    def __init__(self, parent, color1, color2, color3, **kwargs):
-        super().__init__(parent, **kwargs)
-        self._color1 = color1
-        self._color2 = color2
-        self._color3 = color3
-        self.bind("<Configure>", self._draw_gradient)
-
-    def _draw_gradient(self, event=None):
-        self.delete("gradient")
-        width = self.winfo_width()
-        height = self.winfo_height()
-        for i in range(height):
-            if i < height/2:
-                ratio = 2.0 * i / height
-                r = int(int(self._color1[1:3],  16) * (1-ratio) + int(self._color2[1:3],  16) * ratio)
-                g = int(int(self._color1[3:5],  16) * (1-ratio) + int(self._color2[3:5],  16) * ratio)
-                b = int(int(self._color1[5:7],  16) * (1-ratio) + int(self._color2[5:7],  16) * ratio)
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+# asyncio, http.server, multiprocessing, lzma, bz2 and shutil (which loads the last
+# two) are imported where they are first needed, so a plain send or threaded receive
+# does not pay for loading them
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_PORT = 5000
+MIN_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_RECV_BUFFER_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 0.1
+RATE_TIME_CONSTANT = 1.0
+EVENT_QUEUE_SIZE = 10000
+CONSOLE_PROGRESS_INTERVAL = 1.0
+CONNECT_TIMEOUT = 5
+MAX_STREAMS = 16
+MIN_STRIPE_SIZE = 8 * 1024 * 1024
+STRIPE_TIMEOUT = 300
+DEFAULT_RETRIES = 5
+RETRY_BACKOFF = 1.0
+RETRY_BACKOFF_MAX = 30.0
+PART_SUFFIX = '.part'
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_INTERVAL = 64 * 1024 * 1024
+FANOUT_RING_SIZE = 8
+FANOUT_STALL_TIMEOUT = 2.0
+DEFAULT_BACKLOG = 128
+DEFAULT_MAX_TRANSFERS = 256
+DEFAULT_WRITE_WORKERS = 16
+SERVER_ENGINES = ('threads', 'asyncio')
+DEFAULT_MAX_CONCURRENCY = 8
+THROTTLE_BURST = 0.25
+THROTTLE_MAX_SLEEP = 0.25
+SMALL_FILE_SIZE = 64 * 1024
+HASH_WORKERS = 4
+HASH_QUEUE_BYTES = 16 * 1024 * 1024
+DIGEST_CACHE_SIZE = 1024
+COMPRESS_CHUNK_SIZE = 1024 * 1024
+COMPRESS_SAMPLE_SIZE = 64 * 1024
+COMPRESS_MIN_SAVING = 0.1
+COMPRESS_WORKERS = os.cpu_count() or 1
+DELTA_MIN_BLOCK = 4 * 1024
+DELTA_MAX_BLOCK = 256 * 1024
+DELTA_SIGNATURE_SPAN = 16 * 1024 * 1024
+DELTA_LITERAL_SIZE = 4 * 1024 * 1024
+DELTA_MAX_SKIP = 64
+DEDUP_CHUNK_SIZE = 1024 * 1024
+STREAM_SUFFIX = '.stream'
+STREAM_LOG_STEP = 64 * 1024 * 1024
+STORE_DIRECTORY = '.sft-store'
+DEFAULT_STORE_SIZE = 1024 * 1024 * 1024
+FICLONE = 0x40049409
+PROGRESS_LOG_STEP = 0.1
+METRICS_INTERVAL = 10.0
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+PROFILE_INTERVAL = 0.01
+PROFILE_MAX_DEPTH = 64
+PROFILE_WRITE_INTERVAL = 10.0
+DISCOVERY_GROUP = '239.255.83.70'
+DISCOVERY_PORT = 5001
+DISCOVERY_MAGIC = b'\x93SFD'
+DISCOVERY_INTERVAL = 2.0
+DISCOVERY_TTL = 3 * DISCOVERY_INTERVAL
+DISCOVERY_WAIT = 1.0
+DISCOVERY_POLL = 0.5
+DISCOVERY_PROBE_GAP = 0.2
+DISCOVERY_DATAGRAM_SIZE = 4096
+
+# Wire protocol: every file is announced by one binary header
+#   magic(4) version(1) flags(1) name_len(2) size(8) name
+#   [ext_flags(1)]                                                          if version >= 2
+#   [algorithm(1) digest_len(1) digest]                                     if FLAG_CHECKSUM
+#   [transfer_id(16) stripe_offset(8) stripe_length(8) stripe_count(2)]     if FLAG_STRIPE
+#   [source_mtime(8)]                                                       if FLAG_RESUME
+# With FLAG_TRAILER the header's digest is empty and the digest instead follows the data
+#   digest_len(1) digest
+# so the sender can hash while it streams. With FLAG_COMPRESS the data is sent as frames
+#   codec(1) raw_len(4) payload_len(4) payload
+# each carrying up to COMPRESS_CHUNK_SIZE bytes of the file, stored raw when codec is
+# CODEC_RAW. Every header is answered by one fixed-size response
+#   magic(4) version(1) status(1) offset(8)
+# With FLAG_DELTA the response's offset is a block size, followed by the signatures
+# of the server's current copy of the file
+#   block_count(8) then per block: adler32(4) blake2b_128(16)
+# and the client sends ops until DELTA_END
+#   op(1) a(8) b(8)       DELTA_COPY: a = first block, b = block count
+#                         DELTA_DATA: a = length, then that much file data (framed with FLAG_COMPRESS)
+# With EXT_FLAG_DEDUP the client follows the header with an offer
+#   file_digest(32) chunk_size(4) chunk_count(8) then chunk_digest(32) per chunk
+# (BLAKE2b-256), the response's offset is the number of chunks the server lacks,
+# followed by a bitmap of them (most significant bit first), and the client sends
+# just those chunks in order (framed with FLAG_COMPRESS).
+# With EXT_FLAG_STREAM (version 3) the size is unknown and sent as 0; the data follows
+# as frames of up to MAX_CHUNK_SIZE bytes whatever the flags, and a frame with raw_len 0
+# ends it.
+PROTOCOL_MAGIC = b'\x93SFT'
+PROTOCOL_VERSION = 3
+HEADER_FORMAT = '!4sBBHQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RESPONSE_FORMAT = '!4sBBQ'
+RESPONSE_SIZE = struct.calcsize(RESPONSE_FORMAT)
+STRIPE_FORMAT = '!16sQQH'
+STRIPE_SIZE = struct.calcsize(STRIPE_FORMAT)
+FRAME_FORMAT = '!BII'
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+DELTA_SIGNATURE_FORMAT = '!I16s'
+DELTA_SIGNATURE_SIZE = struct.calcsize(DELTA_SIGNATURE_FORMAT)
+DELTA_OP_FORMAT = '!BQQ'
+DELTA_OP_SIZE = struct.calcsize(DELTA_OP_FORMAT)
+DEDUP_OFFER_FORMAT = '!32sIQ'
+DEDUP_OFFER_SIZE = struct.calcsize(DEDUP_OFFER_FORMAT)
+
+FLAG_CHECKSUM = 0x01
+FLAG_BATCH = 0x02
+FLAG_END = 0x04
+FLAG_STRIPE = 0x08
+FLAG_RESUME = 0x10
+FLAG_TRAILER = 0x20
+FLAG_COMPRESS = 0x40
+FLAG_DELTA = 0x80
+
+EXT_FLAG_DEDUP = 0x01
+EXT_FLAG_STREAM = 0x02
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_UNSUPPORTED_VERSION = 2
+STATUS_INCOMPLETE = 3
+STATUS_CHECKSUM_MISMATCH = 4
+STATUS_BUSY = 5
+
+STATUS_MESSAGES = {
+    STATUS_OK: "OK",
+    STATUS_ERROR: "Server error",
+    STATUS_UNSUPPORTED_VERSION: "Unsupported protocol version",
+    STATUS_INCOMPLETE: "Transfer incomplete",
+    STATUS_CHECKSUM_MISMATCH: "Checksum mismatch",
+    STATUS_BUSY: "The file is already being received from this source",
+}
+
+CHECKSUM_SHA256 = 1
+CHECKSUM_BLAKE2B = 2
+CHECKSUM_XXH64 = 3
+CHECKSUM_CRC32 = 4
+CHECKSUM_ALGORITHMS = {
+    CHECKSUM_SHA256: 'sha256',
+    CHECKSUM_BLAKE2B: 'blake2b',
+    CHECKSUM_CRC32: 'crc32',
+}
+if xxhash:
+    CHECKSUM_ALGORITHMS[CHECKSUM_XXH64] = 'xxh64'
+DEFAULT_CHECKSUM = CHECKSUM_SHA256
+
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_BZ2 = 3
+COMPRESSION_CODECS = {
+    CODEC_ZLIB: 'zlib',
+    CODEC_LZMA: 'lzma',
+    CODEC_BZ2: 'bz2',
+}
+DEFAULT_COMPRESS_LEVELS = {
+    CODEC_ZLIB: 1,
+    CODEC_LZMA: 1,
+    CODEC_BZ2: 9,
+}
+
+DELTA_COPY = 1
+DELTA_DATA = 2
+DELTA_END = 3
+
+class ProtocolError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class ConnectionClosed(ProtocolError):
+    pass
+
+class TransferCancelled(Exception):
+    pass
+
+class Counter:
+    # Monotonic total; `labels` are fixed at creation, so one metric name can have
+    # several Counter objects, one per label set
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=None):
+        self.name = name
+        self.help = help_text
+        self.labels = labels or {}
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+class Histogram:
+    # Cumulative buckets in the Prometheus style: counts[i] is the number of
+    # observations <= buckets[i], plus one overflow count for +Inf
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS, labels=None):
+        self.name = name
+        self.help = help_text
+        self.labels = labels or {}
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield self.name + '_bucket', dict(self.labels, le='+Inf' if bound == float('inf') else repr(bound)), cumulative
+        yield self.name + '_sum', self.labels, total
+        yield self.name + '_count', self.labels, cumulative
+
+def series_name(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{label}"' for key, label in labels.items()) + '}'
+
+class Metrics:
+    # Registry of the process's metrics, exported as Prometheus text (render) or
+    # as one JSON object per snapshot (snapshot, write_json_lines)
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, **labels):
+        return self.add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, **labels):
+        return self.add(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, **labels):
+        return self.add(Histogram(name, help_text, buckets, labels))
+
+    def render(self):
+        lines = []
+        described = set()
+        with self.lock:
+            metrics = list(self.metrics)
+        for metric in metrics:
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{series_name(name, labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        values = {}
+        with self.lock:
+            metrics = list(self.metrics)
+        for metric in metrics:
+            # Keyed by the same series names as the Prometheus text
+            for name, labels, value in metric.samples():
+                values[series_name(name, labels)] = value
+        return {'time': round(time.time(), 3), 'metrics': values}
+
+    def write_json_lines(self, path, stop=None, interval=METRICS_INTERVAL):
+        # Appends a snapshot to path every interval until stop is set, and once more at the end
+        stop = stop or threading.Event()
+        while True:
+            stopping = stop.wait(interval)
+            with open(path, 'a') as file:
+                file.write(json.dumps(self.snapshot()) + '\n')
+            if stopping:
+                return
+
+def serve_metrics(port, host='127.0.0.1', metrics=None):
+    # Serves /metrics (Prometheus text) and /metrics.json from a background thread
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path == '/metrics':
+                body = self.server.metrics.render().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            elif path == '/metrics.json':
+                body = json.dumps(self.server.metrics.snapshot()).encode('utf-8')
+                content_type = 'application/json'
             else:
-                ratio = 2.0 * (i - height/2) / height
-                r = int(int(self._color2[1:3],  16) * (1-ratio) + int(self._color3[1:3],  16) * ratio)
-                g = int(int(self._color2[3:5],  16) * (1-ratio) + int(self._color3[3:5],  16) * ratio)
-                b = int(int(self._color2[5:7],  16) * (1-ratio) + int(self._color3[5:7],  16) * ratio)
-            color = f'#{r:02x}{g:02x}{b:02x}'
-            self.create_line(0, i, width, i, tags=("gradient",), fill=color)
-        self.lower("gradient")
-
-class ModernButton(tk.Button):
-    def __init__(self, master=None, **kwargs):
-        super().__init__(master, **kwargs)
-        self.config(relief=tk.FLAT, bd=0, padx=20, pady=10,
-                    font=('Helvetica', 10, 'bold'), cursor="hand2")
-        self.bind('<Enter>', self._on_enter)
-        self.bind('<Leave>', self._on_leave)
-
-    def _on_enter(self, e):
-        self['background'] = CustomStyle.SECONDARY
-
-    def _on_leave(self, e):
-        self['background'] = CustomStyle.PRIMARY
-
-class FileTransferClient:
-    def __init__(self, root):
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class MetricsHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = MetricsHTTPServer((host, port), MetricsRequestHandler)
+    server.metrics = metrics or METRICS
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+METRICS = Metrics()
+SENT_BYTES = METRICS.counter('sft_sent_bytes_total', "Bytes sent on transfer connections")
+RECEIVED_BYTES = METRICS.counter('sft_received_bytes_total', "Bytes received on transfer connections")
+SENT_CHUNKS = METRICS.counter('sft_sent_chunks_total', "send()/sendfile() calls carrying file data")
+RECEIVED_CHUNKS = METRICS.counter('sft_received_chunks_total', "recv() calls on transfer connections")
+SEND_SECONDS = METRICS.histogram('sft_send_seconds', "Time spent in one send()/sendfile() call for file data")
+RECEIVE_SECONDS = METRICS.histogram('sft_receive_seconds',
+                                    "Time spent in one blocking recv() call (threaded server and clients)")
+DISK_WRITE_SECONDS = METRICS.histogram('sft_disk_write_seconds', "Latency of one positional write to a received file")
+SEND_QUEUE_DEPTH = METRICS.gauge('sft_send_queue_depth', "Sends queued behind the concurrency limit")
+ACTIVE_SENDS = METRICS.gauge('sft_active_sends', "Sends currently running")
+ACTIVE_CONNECTIONS = METRICS.gauge('sft_active_connections', "Connections the server is currently handling")
+FILES_RECEIVED = METRICS.counter('sft_files_received_total', "Files received completely")
+
+class SamplingProfiler:
+    # Opt-in: every interval, records the stack of each thread that is inside a
+    # profiled() section (the send and receive loops). Stacks are counted in the
+    # collapsed format ("outer;inner count") read by flamegraph.pl and speedscope,
+    # so time spent stalled in a call shows up as a wide frame.
+    def __init__(self, path, interval=PROFILE_INTERVAL, max_depth=PROFILE_MAX_DEPTH):
+        self.path = path
+        self.interval = interval
+        self.max_depth = max_depth
+        self.threads = collections.Counter()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.write()
+
+    def enter(self):
+        with self.lock:
+            self.threads[threading.get_ident()] += 1
+
+    def leave(self):
+        ident = threading.get_ident()
+        with self.lock:
+            self.threads[ident] -= 1
+            if not self.threads[ident]:
+                del self.threads[ident]
+
+    def run(self):
+        written = time.time()
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                idents = list(self.threads)
+            frames = sys._current_frames()
+            for ident in idents:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[';'.join(reversed(stack))] += 1
+                    self.samples += 1
+            if time.time() - written >= PROFILE_WRITE_INTERVAL:
+                # Long-running servers get a fresh file every so often, not only at exit
+                self.write()
+                written = time.time()
+
+    def write(self):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        os.replace(temporary, self.path)
+
+PROFILER = None
+
+def start_profiler(path, interval=PROFILE_INTERVAL):
+    global PROFILER
+    PROFILER = SamplingProfiler(path, interval)
+    PROFILER.start()
+    return PROFILER
+
+def record_send(count, seconds):
+    SENT_BYTES.inc(count)
+    SENT_CHUNKS.inc()
+    SEND_SECONDS.observe(seconds)
+
+@contextlib.contextmanager
+def profiled():
+    profiler = PROFILER
+    if profiler is None:
+        yield
+        return
+    profiler.enter()
+    try:
+        yield
+    finally:
+        profiler.leave()
+
+def clamp_chunk_size(chunk_size):
+    return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, int(chunk_size)))
+
+def can_sendfile(sock, file):
+    if not hasattr(os, 'sendfile') or sock.gettimeout() == 0:
+        return False
+    try:
+        return stat.S_ISREG(os.fstat(file.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        return False
+
+def send_file_data(sock, file, offset, count, chunk_size=DEFAULT_CHUNK_SIZE, zero_copy=True, progress=None):
+    # Sends `count` bytes of `file` starting at `offset`, either through the kernel
+    # (sendfile) or through a single reused buffer. Returns the number of bytes sent.
+    # progress may return the most the next call should send (see Throttle.slice_size).
+    chunk_size = clamp_chunk_size(chunk_size)
+    sent = 0
+    limit = progress(0) if progress else None
+    if zero_copy and can_sendfile(sock, file):
+        while sent < count:
+            start = time.perf_counter()
+            n = sock.sendfile(file, offset + sent, min(limit or chunk_size, chunk_size, count - sent))
+            record_send(n, time.perf_counter() - start)
+            if not n:
+                break
+            sent += n
+            if progress:
+                limit = progress(sent)
+        return sent
+    buffer = bytearray(min(chunk_size, max(count, 1)))
+    view = memoryview(buffer)
+    file.seek(offset)
+    while sent < count:
+        n = file.readinto(view[:min(limit or len(buffer), len(buffer), count - sent)])
+        if not n:
+            break
+        start = time.perf_counter()
+        sock.sendall(view[:n])
+        record_send(n, time.perf_counter() - start)
+        sent += n
+        if progress:
+            limit = progress(sent)
+    return sent
+
+class FanOutReader:
+    # Reads a file once into a bounded ring of chunks that every per-target sender
+    # consumes. The reader runs at most `capacity` chunks ahead of the slowest
+    # attached sender; a sender that holds it up for longer than `stall_timeout`
+    # is detached and reads the rest of the file itself, so it can't stall the others.
+    def __init__(self, path, size, chunk_size=DEFAULT_CHUNK_SIZE, capacity=FANOUT_RING_SIZE,
+                 stall_timeout=FANOUT_STALL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.chunk_size = clamp_chunk_size(chunk_size)
+        self.capacity = max(2, capacity)
+        self.stall_timeout = stall_timeout
+        self.chunk_count = -(-size // self.chunk_size)
+        self.chunks = {}
+        self.next_index = 0
+        self.positions = {}
+        self.error = None
+        self._stalled_since = None
+        self._ids = itertools.count()
+        self.condition = threading.Condition()
+
+    def attach(self):
+        with self.condition:
+            consumer = next(self._ids)
+            self.positions[consumer] = 0
+            return consumer
+
+    def detach(self, consumer):
+        with self.condition:
+            self.positions.pop(consumer, None)
+            self._evict()
+
+    def release(self, consumer, index):
+        # The consumer is done with every chunk below index
+        with self.condition:
+            if consumer in self.positions:
+                self.positions[consumer] = index
+                self._evict()
+
+    def get(self, consumer, index):
+        # Returns the chunk, or None once the consumer has to read for itself
+        with self.condition:
+            while consumer in self.positions and index >= self.next_index and self.error is None:
+                self.condition.wait()
+            data = self.chunks.get(index) if consumer in self.positions else None
+            if data is None:
+                self.positions.pop(consumer, None)
+                self._evict()
+            return data
+
+    def _evict(self):
+        low = min(self.positions.values(), default=self.next_index)
+        for index in [index for index in self.chunks if index < low]:
+            del self.chunks[index]
+        self.condition.notify_all()
+
+    def _wait_for_room(self):
+        # The stall clock only restarts once a chunk can be read without waiting, so a
+        # sender that is steadily slower than the rest is spilled too, not just a stuck one
+        if not self.positions or self.next_index - min(self.positions.values()) < self.capacity:
+            self._stalled_since = None
+        while self.positions and self.next_index - min(self.positions.values()) >= self.capacity:
+            if self._stalled_since is None:
+                self._stalled_since = time.time()
+            remaining = self._stalled_since + self.stall_timeout - time.time()
+            if remaining > 0:
+                self.condition.wait(remaining)
+                continue
+            # Spill the slowest senders back to their own file reads
+            low = min(self.positions.values())
+            for consumer in [consumer for consumer, index in self.positions.items() if index == low]:
+                del self.positions[consumer]
+            self._evict()
+            self._stalled_since = None
+        return bool(self.positions)
+
+    def run(self):
+        try:
+            with open(self.path, 'rb', buffering=0) as file:
+                while self.next_index < self.chunk_count:
+                    with self.condition:
+                        if not self._wait_for_room():
+                            return
+                    expected = min(self.chunk_size, self.size - self.next_index * self.chunk_size)
+                    data = file.read(expected)
+                    if len(data) < expected:
+                        raise Exception("File shrank during transfer")
+                    with self.condition:
+                        self.chunks[self.next_index] = data
+                        self.next_index += 1
+                        self.condition.notify_all()
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+def send_fanout_data(sock, reader, consumer, file, offset, count, chunk_size=DEFAULT_CHUNK_SIZE, zero_copy=True,
+                     progress=None):
+    # Like send_file_data, but takes chunks from a shared FanOutReader and only
+    # falls back to reading `file` once the reader has detached this consumer.
+    sent = 0
+    index = offset // reader.chunk_size
+    skip = offset - index * reader.chunk_size
+    reader.release(consumer, index)
+    limit = progress(0) if progress else None
+    while sent < count:
+        data = reader.get(consumer, index)
+        if data is None:
+            done = sent
+            return done + send_file_data(sock, file, offset + done, count - done, chunk_size=chunk_size,
+                                         zero_copy=zero_copy,
+                                         progress=progress and (lambda n: progress(done + n)))
+        view = memoryview(data)[skip:skip + count - sent]
+        while view:
+            part = view[:limit or len(view)]
+            start = time.perf_counter()
+            sock.sendall(part)
+            record_send(len(part), time.perf_counter() - start)
+            sent += len(part)
+            view = view[len(part):]
+            if progress:
+                limit = progress(sent)
+        skip = 0
+        index += 1
+        reader.release(consumer, index)
+    reader.detach(consumer)
+    return sent
+
+def preallocate(fileno, size):
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fileno, 0, size)
+    except (AttributeError, OSError):
+        # Not every platform/filesystem supports fallocate; at least size the file up front
+        os.ftruncate(fileno, size)
+
+class FileSink:
+    # Destination file opened for positional writes, so several connections can
+    # fill different ranges of it. Optionally memory-mapped for recv_into().
+    def __init__(self, path, size, use_mmap=False, truncate=True):
+        self.path = path
+        self.size = size
+        self.position = 0
+        self.mmap = None
+        self.memory = None
+        self._lock = threading.Lock()
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        if truncate:
+            flags |= os.O_TRUNC
+        self.fd = os.open(path, flags, 0o644)
+        try:
+            if os.fstat(self.fd).st_size > size:
+                os.ftruncate(self.fd, size)
+            preallocate(self.fd, size)
+            if use_mmap and size > 0:
+                self.mmap = mmap.mmap(self.fd, size)
+                self.memory = memoryview(self.mmap)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def write_at(self, data, offset):
+        view = memoryview(data)
+        start = time.perf_counter()
+        while view:
+            if hasattr(os, 'pwrite'):
+                n = os.pwrite(self.fd, view, offset)
+            else:
+                with self._lock:
+                    os.lseek(self.fd, offset, os.SEEK_SET)
+                    n = os.write(self.fd, view)
+            view = view[n:]
+            offset += n
+        DISK_WRITE_SECONDS.observe(time.perf_counter() - start)
+
+    def write(self, data):
+        self.write_at(data, self.position)
+        self.position += len(data)
+
+    def sync(self):
+        if self.mmap is not None:
+            self.mmap.flush()
+        os.fsync(self.fd)
+
+    def close(self, length=None):
+        if self.memory is not None:
+            self.memory.release()
+            self.memory = None
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        if length is not None and length < self.size:
+            # Don't leave preallocated zeros behind a short transfer
+            os.ftruncate(self.fd, length)
+        os.close(self.fd)
+
+def write_chunk(sink, data, offset, hasher=None, progress=None, received=0):
+    # sink is None for data that was received straight into a mapped file
+    if sink:
+        sink.write_at(data, offset)
+    if hasher:
+        hasher.update(data)
+    if progress:
+        progress(received)
+
+class Crc32:
+    # hashlib-style wrapper for zlib.crc32: a fast, non-cryptographic check that
+    # is always available, unlike xxhash
+    name = 'crc32'
+    digest_size = 4
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self):
+        return struct.pack('!I', self.value)
+
+def new_hasher(algorithm):
+    if algorithm == 'crc32':
+        return Crc32()
+    if algorithm == 'xxh64':
+        return xxhash.xxh64()
+    return hashlib.new(algorithm)
+
+_hash_executor = None
+_hash_executor_lock = threading.Lock()
+
+def hash_executor():
+    # Shared by every transfer; only started once something needs hashing
+    global _hash_executor
+    with _hash_executor_lock:
+        if _hash_executor is None:
+            _hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+        return _hash_executor
+
+class PipelinedHasher:
+    # Drop-in for a hasher whose update() only queues a copy of the data; the
+    # shared hash_executor() hashes it in order, overlapping with socket and disk
+    # I/O. Once HASH_QUEUE_BYTES are waiting, update() blocks until it catches up.
+    def __init__(self, hasher):
+        self.hasher = hasher
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        self.running = False
+        self.condition = threading.Condition()
+
+    def update(self, data):
+        data = bytes(data)
+        with self.condition:
+            while self.pending_bytes >= HASH_QUEUE_BYTES:
+                self.condition.wait()
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+            if not self.running:
+                self.running = True
+                hash_executor().submit(self._drain)
+
+    def _drain(self):
+        while True:
+            with self.condition:
+                if not self.pending:
+                    self.running = False
+                    self.condition.notify_all()
+                    return
+                data = self.pending.popleft()
+            self.hasher.update(data)
+            with self.condition:
+                self.pending_bytes -= len(data)
+                self.condition.notify_all()
+
+    def digest(self):
+        with self.condition:
+            while self.running:
+                self.condition.wait()
+        return self.hasher.digest()
+
+class DigestCache:
+    # Client-side digests keyed by (path, size, mtime, algorithm). Each file is
+    # hashed once on a background thread while it is being sent; every target
+    # (and every retry) of the same unchanged file shares that one result.
+    def __init__(self, max_entries=DIGEST_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+
+    def submit(self, path, algorithm, hash_file=None):
+        # algorithm is a checksum id, or any name for a custom hash_file(path)
+        file_stat = os.stat(path)
+        key = (os.path.abspath(path), file_stat.st_size, file_stat.st_mtime_ns, algorithm)
+        with self.lock:
+            future = self.entries.get(key)
+            if future is None or (future.done() and future.exception()):
+                if hash_file:
+                    future = self.executor.submit(hash_file, path)
+                else:
+                    future = self.executor.submit(file_digest, path, CHECKSUM_ALGORITHMS[algorithm])
+                self.entries[key] = future
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return future
+
+def file_digest(path, algorithm='sha256', chunk_size=DEFAULT_CHUNK_SIZE):
+    hasher = new_hasher(algorithm)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as file:
+        while True:
+            n = file.readinto(buffer)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return hasher.digest()
+
+def worth_compressing(data):
+    # A fast zlib pass over a sample from the middle of the chunk. Runs in the
+    # sending process, so chunks that are already compressed (media, archives)
+    # never make the trip to a compression worker.
+    middle = max(0, len(data) - COMPRESS_SAMPLE_SIZE) // 2
+    sample = data[middle:middle + COMPRESS_SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - COMPRESS_MIN_SAVING)
+
+def compress_chunk(data, codec, level=None):
+    # Runs in a compression worker process; returns (codec, payload), with payload
+    # None when compressing saved too little and the chunk should go out raw.
+    if level is None:
+        level = DEFAULT_COMPRESS_LEVELS[codec]
+    if codec == CODEC_ZLIB:
+        payload = zlib.compress(data, level)
+    elif codec == CODEC_LZMA:
+        import lzma
+        payload = lzma.compress(data, preset=level)
+    else:
+        import bz2
+        payload = bz2.compress(data, level)
+    if len(payload) > len(data) * (1 - COMPRESS_MIN_SAVING):
+        return CODEC_RAW, None
+    return codec, payload
+
+def start_compression(data, codec, level=None, executor=None):
+    # Returns a function that gives compress_chunk's result for data; the work is
+    # queued on executor now, for chunks that pass worth_compressing
+    if not codec or not worth_compressing(data):
+        return lambda: (CODEC_RAW, None)
+    if executor:
+        return executor.submit(compress_chunk, data, codec, level).result
+    result = compress_chunk(data, codec, level)
+    return lambda: result
+
+def decompress_chunk(codec, payload, raw_len):
+    # Decompresses at most raw_len + 1 bytes, so a hostile frame cannot balloon
+    if codec == CODEC_RAW:
+        data = payload
+    elif codec == CODEC_ZLIB:
+        data = zlib.decompressobj().decompress(payload, raw_len + 1)
+    elif codec == CODEC_LZMA:
+        import lzma
+        data = lzma.LZMADecompressor().decompress(payload, raw_len + 1)
+    elif codec == CODEC_BZ2:
+        import bz2
+        data = bz2.BZ2Decompressor().decompress(payload, raw_len + 1)
+    else:
+        raise ProtocolError(f"Unknown compression codec {codec}")
+    if len(data) != raw_len:
+        raise ProtocolError("Compressed frame does not match its length")
+    return data
+
+def check_frame(raw_len, payload_len, remaining):
+    if not 0 < raw_len <= min(remaining, MAX_CHUNK_SIZE) or payload_len > raw_len:
+        raise ProtocolError("Bad compressed frame")
+
+def write_frame(sink, codec, payload, raw_len, offset, hasher=None, progress=None, received=0):
+    write_chunk(sink, decompress_chunk(codec, payload, raw_len), offset, hasher, progress, received)
+
+def send_compressed_data(sock, file, offset, count, codec=CODEC_ZLIB, level=None, executor=None, progress=None):
+    # Sends count bytes from offset as FLAG_COMPRESS frames. Chunks are read in
+    # order and compressed on `executor` (a process pool) with several in flight,
+    # then sent in order. Returns (file bytes sent, bytes put on the wire).
+    pending = collections.deque()
+    depth = 2 * COMPRESS_WORKERS if executor else 1
+    position = offset
+    end = offset + count
+    sent = 0
+    wire = 0
+    file.seek(offset)
+    while position < end or pending:
+        while position < end and len(pending) < depth:
+            data = file.read(min(COMPRESS_CHUNK_SIZE, end - position))
+            if not data:
+                end = position
+                break
+            position += len(data)
+            pending.append((data, start_compression(data, codec, level, executor)))
+        if not pending:
+            break
+        data, result = pending.popleft()
+        used, payload = result()
+        if payload is None:
+            payload = data
+        start = time.perf_counter()
+        sock.sendall(struct.pack(FRAME_FORMAT, used, len(data), len(payload)) + payload)
+        record_send(FRAME_SIZE + len(payload), time.perf_counter() - start)
+        sent += len(data)
+        wire += FRAME_SIZE + len(payload)
+        if progress:
+            progress(sent)
+    return sent, wire
+
+def iter_source(source, chunk_size):
+    # Chunks of at most chunk_size from a stream source: anything with read() (stdin,
+    # a pipe, a socket file) or an iterable of bytes-like objects. Chunks are copied
+    # to bytes, so a generator may reuse its buffer.
+    read = getattr(source, 'read', None)
+    if read:
+        while True:
+            data = read(chunk_size)
+            if not data:
+                return
+            yield data if isinstance(data, bytes) else bytes(data)
+    for data in source:
+        if isinstance(data, bytes) and len(data) <= chunk_size:
+            if data:
+                yield data
+            continue
+        view = memoryview(data).cast('B')
+        for start in range(0, len(view), chunk_size):
+            yield bytes(view[start:start + chunk_size])
+
+def stream_frames(chunks, codec=None, level=None, executor=None):
+    # (data, frame) for every chunk of an EXT_FLAG_STREAM body, frame being its
+    # FRAME_FORMAT header and payload. With a codec, chunks are compressed where it
+    # pays; like send_compressed_data, several are in flight at once on executor.
+    pending = collections.deque()
+    depth = 2 * COMPRESS_WORKERS if codec and executor else 1
+
+    def frame(data, result):
+        used, payload = result()
+        if payload is None:
+            payload = data
+        return data, struct.pack(FRAME_FORMAT, used, len(data), len(payload)) + payload
+
+    for data in chunks:
+        pending.append((data, start_compression(data, codec, level, executor)))
+        if len(pending) >= depth:
+            yield frame(*pending.popleft())
+    while pending:
+        yield frame(*pending.popleft())
+
+def write_stream_frame(sink, codec, payload, raw_len, hasher=None, progress=None, received=0):
+    data = decompress_chunk(codec, payload, raw_len)
+    sink.write(data)
+    if hasher:
+        hasher.update(data)
+    if progress:
+        progress(received)
+
+class StreamFileSink:
+    # Default destination of a stream: <path>.stream, moved over path once the whole
+    # stream has arrived (and verified), so a broken stream never replaces a file
+    def __init__(self, path):
+        self.path = path
+        self.description = path
+        self.sink = FileSink(path + STREAM_SUFFIX, 0)
+
+    def write(self, data):
+        self.sink.write(data)
+
+    def commit(self):
+        self.sink.close()
+        self.sink = None
+        os.replace(self.path + STREAM_SUFFIX, self.path)
+
+    def abort(self):
+        if self.sink:
+            self.sink.close()
+            self.sink = None
+        if os.path.exists(self.path + STREAM_SUFFIX):
+            os.remove(self.path + STREAM_SUFFIX)
+
+class PipeSink:
+    # Writes a stream to a binary file object: sys.stdout.buffer, a FIFO or the stdin
+    # of process, in which case the stream only succeeds if process exits with 0
+    def __init__(self, file, process=None, description=None):
+        self.file = file
+        self.process = process
+        self.description = description or getattr(file, 'name', 'a pipe')
+
+    def write(self, data):
+        try:
+            self.file.write(data)
+        except BrokenPipeError:
+            raise Exception(f"{self.description} stopped reading the stream")
+
+    def commit(self):
+        if not self.process:
+            self.file.flush()
+            return
+        broken = False
+        try:
+            self.file.close()
+        except BrokenPipeError:
+            broken = True
+        status = self.process.wait()
+        if status:
+            raise Exception(f"{self.description} exited with status {status}")
+        if broken:
+            raise Exception(f"{self.description} stopped reading the stream")
+
+    def abort(self):
+        if not self.process:
+            return
+        # Whatever the process made of a partial stream is not to be trusted
+        self.process.kill()
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        self.process.wait()
+
+class CallbackSink:
+    # Hands every chunk of a stream to on_data(data) as it arrives, then calls
+    # on_end(True) once it is complete, or on_end(False) if it broke off
+    def __init__(self, on_data, on_end=None, description='a callback'):
+        self.on_data = on_data
+        self.on_end = on_end
+        self.description = description
+
+    def write(self, data):
+        self.on_data(data)
+
+    def commit(self):
+        if self.on_end:
+            self.on_end(True)
+
+    def abort(self):
+        if self.on_end:
+            self.on_end(False)
+
+def command_sink(command):
+    # Stream sink factory for ReceiveServer(stream_sink=...): every stream is piped
+    # into a new shell command, which finds the stream's name in $SFT_NAME and its
+    # sender in $SFT_SENDER (quote them: they come from the client)
+    def open_sink(name, address):
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                                   env=dict(os.environ, SFT_NAME=name, SFT_SENDER=address[0]))
+        return PipeSink(process.stdin, process, f"'{command}'")
+
+    return open_sink
+
+def delta_block_size(size):
+    # About the square root of the file size, as rsync picks it
+    block_size = DELTA_MIN_BLOCK
+    while block_size < DELTA_MAX_BLOCK and block_size * block_size < size:
+        block_size *= 2
+    return block_size
+
+def span_signatures(path, offset, length, block_size):
+    with open(path, 'rb', buffering=0) as file:
+        file.seek(offset)
+        view = memoryview(file.read(length))
+    parts = []
+    for start in range(0, len(view), block_size):
+        block = view[start:start + block_size]
+        parts.append(struct.pack(DELTA_SIGNATURE_FORMAT, zlib.adler32(block),
+                                 hashlib.blake2b(block, digest_size=16).digest()))
+    return b''.join(parts)
+
+def block_signatures(path, size, block_size):
+    # Yields the packed signatures of path's blocks in order. Spans of blocks are
+    # hashed on hash_executor() (zlib and hashlib release the GIL), a few ahead.
+    span = max(1, DELTA_SIGNATURE_SPAN // block_size) * block_size
+    pending = collections.deque()
+    for offset in range(0, size, span):
+        pending.append(hash_executor().submit(span_signatures, path, offset, span, block_size))
+        if len(pending) >= HASH_WORKERS:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def delta_ops(data, block_size, signatures):
+    # Matches data against the (adler32, strong) block signatures of the receiver's
+    # copy. Yields (offset, length, first_block) runs in file order, first_block being
+    # None for literal data. Every block-aligned position is checked at C speed; after
+    # a miss a rolling adler32 searches the next block's worth of offsets for shifted
+    # content. Searches that find nothing are retried ever more rarely (up to every
+    # DELTA_MAX_SKIP blocks), so unrelated data costs little.
+    weak = {}
+    for index, (adler, strong) in enumerate(signatures):
+        weak.setdefault(adler, []).append(index)
+    size = len(data)
+    view = memoryview(data)
+
+    def match(adler, offset, length, expected):
+        candidates = weak.get(adler)
+        if not candidates:
+            return None
+        strong = hashlib.blake2b(view[offset:offset + length], digest_size=16).digest()
+        if expected in candidates and signatures[expected][1] == strong:
+            return expected
+        for index in candidates:
+            if signatures[index][1] == strong:
+                return index
+        return None
+
+    def search(offset, adler):
+        limit = min(offset + block_size - 1, size - block_size)
+        window = bytes(view[offset:limit + block_size])
+        a = adler & 0xffff
+        b = adler >> 16
+        for start in range(1, limit - offset + 1):
+            old = window[start - 1]
+            a = (a - old + window[start + block_size - 1]) % 65521
+            b = (b - block_size * old + a - 1) % 65521
+            rolled = (b << 16) | a
+            if rolled in weak:
+                index = match(rolled, offset + start, block_size, None)
+                if index is not None:
+                    return offset + start, index
+        return None, None
+
+    try:
+        position = 0
+        literal = 0
+        run = None
+        expected = 0
+        skip = 0
+        backoff = 1
+        while position < size:
+            length = min(block_size, size - position)
+            adler = zlib.adler32(view[position:position + length])
+            found = position
+            index = match(adler, position, length, expected)
+            if index is None and length == block_size and position + block_size < size:
+                if skip:
+                    skip -= 1
+                else:
+                    found, index = search(position, adler)
+                    if index is None:
+                        skip = backoff
+                        backoff = min(backoff * 2, DELTA_MAX_SKIP)
+            if index is None:
+                if run:
+                    yield run
+                    run = None
+                position += length
+                if position - literal >= DELTA_LITERAL_SIZE:
+                    yield literal, position - literal, None
+                    literal = position
+                continue
+            if found > literal:
+                if run:
+                    yield run
+                    run = None
+                yield literal, found - literal, None
+            if run and index == run[2] + -(-run[1] // block_size):
+                run = (run[0], run[1] + length, run[2])
+            else:
+                if run:
+                    yield run
+                run = (found, length, index)
+            position = literal = found + length
+            expected = index + 1
+            skip = 0
+            backoff = 1
+        if run:
+            yield run
+        if size > literal:
+            yield literal, size - literal, None
+    finally:
+        view.release()
+
+def delta_op_length(op, a, b, block_size, basis_size, remaining):
+    # Checks a DELTA_COPY or DELTA_DATA op against the receiver's copy and the
+    # bytes still missing; returns how many bytes of the file it produces
+    if op == DELTA_COPY:
+        if not b or (a + b - 1) * block_size >= basis_size:
+            raise ProtocolError("Delta copy lies outside the existing file")
+        length = min(b * block_size, basis_size - a * block_size)
+    elif op == DELTA_DATA:
+        length = a
+    else:
+        raise ProtocolError(f"Unknown delta op {op}")
+    if not 0 < length <= remaining:
+        raise ProtocolError("Delta op lies outside the file")
+    return length
+
+def copy_blocks(source, sink, offset, length, position, hasher=None):
+    # Copies length bytes at offset of the receiver's existing copy to position in sink
+    source.seek(offset)
+    copied = 0
+    while copied < length:
+        data = source.read(min(DEFAULT_CHUNK_SIZE, length - copied))
+        if not data:
+            raise ProtocolError("Existing file shrank during delta transfer")
+        write_chunk(sink, data, position + copied, hasher)
+        copied += len(data)
+
+def content_hashes(path, chunk_size=DEDUP_CHUNK_SIZE):
+    # The BLAKE2b-256 digests of the whole file and of each of its chunks, which
+    # the client offers to a deduplicating server
+    file_hasher = hashlib.blake2b(digest_size=32)
+    chunk_digests = []
+    with open(path, 'rb') as file:
+        while True:
+            data = file.read(chunk_size)
+            if not data:
+                break
+            file_hasher.update(data)
+            chunk_digests.append(hashlib.blake2b(data, digest_size=32).digest())
+    return file_hasher.digest(), chunk_digests
+
+def check_offer(size, chunk_size, chunk_count):
+    if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE or chunk_count != -(-size // chunk_size):
+        raise ProtocolError("Bad dedup offer")
+
+def pack_bitmap(bits):
+    bitmap = bytearray((len(bits) + 7) // 8)
+    for index, bit in enumerate(bits):
+        if bit:
+            bitmap[index // 8] |= 0x80 >> index % 8
+    return bytes(bitmap)
+
+def bitmap_bit(bitmap, index):
+    return bool(bitmap[index // 8] & (0x80 >> index % 8))
+
+def chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=32).digest()
+
+def clone_file(source, destination, hardlink=False):
+    # Makes destination a copy-on-write clone of source where the filesystem
+    # supports it (btrfs, XFS), else (if allowed) a hardlink, else a plain copy.
+    # Returns which. Hardlinked files share their data: writing to one changes all.
+    if fcntl and sys.platform.startswith('linux'):
+        try:
+            with open(source, 'rb') as src, open(destination, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except OSError:
+            if os.path.exists(destination):
+                os.remove(destination)
+    if hardlink:
+        try:
+            os.link(source, destination)
+            return 'hardlink'
+        except OSError:
+            pass
+    import shutil
+    shutil.copyfile(source, destination)
+    return 'copy'
+
+class Connection:
+    # Socket wrapper with a small read-ahead buffer, so bytes received while
+    # sniffing for the protocol can be handed back to later reads. With a throttle,
+    # reads pause while it is over a limit and TCP flow control slows the sender.
+    def __init__(self, sock, throttle=None):
+        self.sock = sock
+        self.pending = bytearray()
+        self.throttle = throttle
+
+    def unread(self, data):
+        self.pending[:0] = data
+
+    def recv(self, size):
+        if self.pending:
+            data = bytes(self.pending[:size])
+            del self.pending[:size]
+            return data
+        return self.sock.recv(size)
+
+    def recv_into(self, view):
+        if self.pending:
+            n = min(len(view), len(self.pending))
+            view[:n] = self.pending[:n]
+            del self.pending[:n]
+            return n
+        start = time.perf_counter()
+        n = self.sock.recv_into(view)
+        RECEIVE_SECONDS.observe(time.perf_counter() - start)
+        RECEIVED_BYTES.inc(n)
+        RECEIVED_CHUNKS.inc()
+        if self.throttle:
+            self.throttle.pace(n)
+        return n
+
+    def recv_exact(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            n = self.recv_into(view[received:])
+            if not n:
+                raise ConnectionClosed(f"Connection closed after {received} of {size} bytes")
+            received += n
+        return bytes(data)
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        SENT_BYTES.inc(len(data))
+
+    def close(self):
+        self.sock.close()
+
+class FileHeader:
+    def __init__(self, name, size, flags=0, checksum_algorithm=0, checksum=b'', version=None, ext_flags=0):
+        self.name = name
+        self.size = size
+        self.flags = flags
+        self.checksum_algorithm = checksum_algorithm
+        self.checksum = checksum
+        # Headers without extension flags go out as version 1, which older servers accept
+        self.version = version or (PROTOCOL_VERSION if ext_flags else 1)
+        self.ext_flags = ext_flags
+        self.transfer_id = b''
+        self.stripe_offset = 0
+        self.stripe_length = size
+        self.stripe_count = 1
+        self.source_mtime = 0
+        if checksum:
+            self.flags |= FLAG_CHECKSUM
+
+    def set_trailer(self, algorithm):
+        self.flags |= FLAG_CHECKSUM | FLAG_TRAILER
+        self.checksum_algorithm = algorithm
+        self.checksum = b''
+        return self
+
+    def set_resume(self, source_mtime):
+        self.flags |= FLAG_RESUME
+        self.source_mtime = source_mtime
+        return self
+
+    def set_dedup(self):
+        self.ext_flags |= EXT_FLAG_DEDUP
+        self.version = max(self.version, 2)
+        return self
+
+    def set_stream(self):
+        self.ext_flags |= EXT_FLAG_STREAM
+        self.version = max(self.version, 3)
+        return self
+
+    def set_stripe(self, transfer_id, offset, length, count):
+        self.flags |= FLAG_STRIPE
+        self.transfer_id = transfer_id
+        self.stripe_offset = offset
+        self.stripe_length = length
+        self.stripe_count = count
+        return self
+
+    def pack(self):
+        name = self.name.encode('utf-8')
+        parts = [struct.pack(HEADER_FORMAT, PROTOCOL_MAGIC, self.version, self.flags, len(name), self.size), name]
+        if self.version >= 2:
+            parts.append(struct.pack('!B', self.ext_flags))
+        if self.flags & FLAG_CHECKSUM:
+            parts.append(struct.pack('!BB', self.checksum_algorithm, len(self.checksum)) + self.checksum)
+        if self.flags & FLAG_STRIPE:
+            parts.append(struct.pack(STRIPE_FORMAT, self.transfer_id, self.stripe_offset,
+                                     self.stripe_length, self.stripe_count))
+        if self.flags & FLAG_RESUME:
+            parts.append(struct.pack('!Q', self.source_mtime))
+        return b''.join(parts)
+
+    @classmethod
+    def parse(cls):
+        # Generator behind read(): it yields how many bytes it needs next, is sent
+        # exactly those bytes, and returns the header.
+        magic, version, flags, name_len, size = struct.unpack(HEADER_FORMAT, (yield HEADER_SIZE))
+        if magic != PROTOCOL_MAGIC:
+            raise ProtocolError("Bad header magic")
+        name = (yield name_len).decode('utf-8') if name_len else ''
+        header = cls(name, size, flags=flags, version=version)
+        if version >= 2:
+            header.ext_flags, = struct.unpack('!B', (yield 1))
+        if flags & FLAG_CHECKSUM:
+            header.checksum_algorithm, digest_len = struct.unpack('!BB', (yield 2))
+            header.checksum = (yield digest_len) if digest_len else b''
+        if flags & FLAG_STRIPE:
+            header.set_stripe(*struct.unpack(STRIPE_FORMAT, (yield STRIPE_SIZE)))
+            if header.stripe_offset + header.stripe_length > header.size or not header.stripe_count:
+                raise ProtocolError("Stripe lies outside the file")
+        if flags & FLAG_RESUME:
+            header.source_mtime, = struct.unpack('!Q', (yield 8))
+        return header
+
+    @classmethod
+    async def read(cls, conn):
+        # conn is a ServerConnection
+        parser = cls.parse()
+        size = next(parser)
+        try:
+            while True:
+                size = parser.send(await conn.recv_exact(size))
+        except StopIteration as done:
+            return done.value
+
+def pack_response(status, offset=0):
+    return struct.pack(RESPONSE_FORMAT, PROTOCOL_MAGIC, PROTOCOL_VERSION, status, offset)
+
+def pack_trailer(digest):
+    return struct.pack('!B', len(digest)) + digest
+
+def read_response(conn):
+    magic, version, status, offset = struct.unpack(RESPONSE_FORMAT, conn.recv_exact(RESPONSE_SIZE))
+    if magic != PROTOCOL_MAGIC:
+        raise ProtocolError("Server does not speak the framed transfer protocol")
+    return status, offset
+
+def check_response(conn):
+    status, offset = read_response(conn)
+    if status != STATUS_OK:
+        raise ProtocolError(STATUS_MESSAGES.get(status, f"Unknown status {status}"), status)
+    return offset
+
+def is_retryable(error):
+    if isinstance(error, ProtocolError):
+        return error.status in (None, STATUS_INCOMPLETE, STATUS_CHECKSUM_MISMATCH, STATUS_BUSY)
+    return isinstance(error, OSError)
+
+def retry_delay(attempt):
+    # Exponential backoff with jitter, so many clients retrying against one
+    # restarted server don't reconnect in lockstep.
+    return min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def read_journal(journal_path):
+    try:
+        with open(journal_path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def write_journal(journal_path, journal):
+    temp_path = journal_path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(journal, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, journal_path)
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+def get_local_ip():
+    # Looked up once per process. Connecting a UDP socket sends nothing; it only
+    # picks the interface that routes to a public address.
+    global LOCAL_IP
+    if LOCAL_IP is None:
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.connect(('8.8.8.8', 1))
+                LOCAL_IP = s.getsockname()[0]
+        except OSError:
+            LOCAL_IP = '127.0.0.1'
+    return LOCAL_IP
+
+LOCAL_IP = None
+
+def split_target(target, port):
+    # "host" or "host:port"
+    host, separator, target_port = target.rpartition(':')
+    if not separator:
+        return target, port
+    if not target_port.isdigit():
+        raise ValueError(f"Bad port in target '{target}'")
+    return host, int(target_port)
+
+def open_connection(target_ip, port):
+    # CONNECT_TIMEOUT only bounds connecting. Once connected, replies may take as
+    # long as the server needs (it hashes whole files before some of them), and
+    # keepalive notices a peer that has gone away.
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_socket.settimeout(CONNECT_TIMEOUT)
+    try:
+        client_socket.connect((target_ip, port))
+        client_socket.settimeout(None)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    except Exception:
+        client_socket.close()
+        raise
+    return Connection(client_socket)
+
+def safe_path(root, name):
+    # Maps a '/'-separated name from the wire onto a path under root, refusing
+    # absolute paths and '..' components, and on Windows drive letters and colons
+    # (alternate data streams). Elsewhere a colon is an ordinary character.
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or name.startswith(('/', '\\')) or any(part == '..' for part in parts):
+        raise ProtocolError(f"Unsafe path '{name}'")
+    if parts[0] == STORE_DIRECTORY:
+        raise ProtocolError(f"Unsafe path '{name}'")
+    if os.name == 'nt' and any(os.path.splitdrive(part)[0] or ':' in part for part in parts):
+        raise ProtocolError(f"Unsafe path '{name}'")
+    path = os.path.join(root, *parts)
+    real_root = os.path.realpath(root)
+    if os.path.commonpath([real_root, os.path.realpath(path)]) != real_root:
+        raise ProtocolError(f"Unsafe path '{name}'")
+    return path
+
+def iter_directory(directory):
+    # Yields (path, name) for every regular file under directory. Names are
+    # relative to the directory's parent so the tree keeps its top-level folder.
+    base = os.path.dirname(os.path.abspath(directory))
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if os.path.isfile(path):
+                yield path, os.path.relpath(os.path.abspath(path), base).replace(os.sep, '/')
+
+def split_stripes(size, streams, align=MIN_CHUNK_SIZE):
+    # Splits [0, size) into at most `streams` contiguous ranges of at least
+    # MIN_STRIPE_SIZE, aligned so each connection sends whole chunks.
+    if size <= 0:
+        return [(0, 0)]
+    streams = max(1, min(streams, MAX_STREAMS, size // MIN_STRIPE_SIZE or 1))
+    length = -(-size // streams)
+    length = -(-length // align) * align
+    return [(offset, min(length, size - offset)) for offset in range(0, size, length)]
+
+def temp_path(full_path):
+    # Unique name next to full_path for data that only replaces it once complete
+    # (and verified), so a failed receive never truncates an existing file
+    return f"{full_path}.{uuid.uuid4().hex}{PART_SUFFIX}"
+
+def remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+def resume_path(full_path, header):
+    # Part file of a resumable receive, named after the sender's size and mtime, so
+    # uploads of different files under one name never share it
+    return f"{full_path}.{header.size:x}-{header.source_mtime:x}{PART_SUFFIX}"
+
+class PartialFile:
+    # Destination of a resumable receive. Data goes to the resume_path() and
+    # <part>.journal records how much of it is on disk (fsynced before every
+    # journal update); a reconnecting client is told that offset.
+    def __init__(self, full_path, header, use_mmap=False):
+        self.full_path = full_path
+        self.part_path = resume_path(full_path, header)
+        self.journal_path = self.part_path + JOURNAL_SUFFIX
+        self.size = header.size
+        self.offset = self.resume_offset(header)
+        self.journal = {'size': header.size, 'mtime': header.source_mtime, 'offset': self.offset}
+        self.next_checkpoint = self.offset + JOURNAL_INTERVAL
+        self.sink = FileSink(self.part_path, header.size, use_mmap=use_mmap, truncate=not self.offset)
+
+    def resume_offset(self, header):
+        journal = read_journal(self.journal_path)
+        if not journal or not os.path.exists(self.part_path):
+            return 0
+        if journal.get('size') != header.size or journal.get('mtime') != header.source_mtime:
+            # A different version of the file: start over
+            return 0
+        return max(0, min(int(journal.get('offset', 0)), os.path.getsize(self.part_path), header.size))
+
+    def checkpoint(self, received_bytes):
+        position = self.offset + received_bytes
+        if position >= self.next_checkpoint:
+            self.sink.sync()
+            self.journal['offset'] = position
+            write_journal(self.journal_path, self.journal)
+            self.next_checkpoint = position + JOURNAL_INTERVAL
+
+    def close(self, received_bytes):
+        position = self.offset + received_bytes
+        try:
+            self.sink.sync()
+            self.journal['offset'] = position
+            write_journal(self.journal_path, self.journal)
+        finally:
+            self.sink.close(position)
+        return position
+
+    def commit(self, checksum=b'', algorithm=None, digest=None):
+        # Moves the completed file into place; a file failing its checksum is
+        # dropped entirely so the next attempt starts over. A resumed file is
+        # hashed from disk since only part of it streamed through this connection.
+        if checksum:
+            if digest is None:
+                digest = file_digest(self.part_path, algorithm)
+            if digest != checksum:
+                os.remove(self.part_path)
+                os.remove(self.journal_path)
+                return False
+        os.replace(self.part_path, self.full_path)
+        os.remove(self.journal_path)
+        return True
+
+class ChunkStore:
+    # Content-addressed store under <save_directory>/.sft-store. Chunks of
+    # deduplicated transfers are kept as files named by their BLAKE2b digest, and
+    # whole files as hardlinks to where they arrived, so data that arrives again
+    # is copied or linked locally instead of being sent. Entries beyond max_bytes
+    # are evicted least recently used first, except those pinned by a transfer.
+    # A stored file that was modified in place since is noticed by its mtime.
+    def __init__(self, root, max_bytes=DEFAULT_STORE_SIZE, hardlink=False):
         self.root = root
-        self.root.title("Simultaneous File Transfer Client")
-        self.root.geometry("600x700")
-        self.background = GradientFrame(
-            root, CustomStyle.BG_GRADIENT_1, CustomStyle.BG_GRADIENT_2, CustomStyle.BG_GRADIENT_3, highlightthickness=0
-        )
-        self.background.pack(fill="both", expand=True)
-
-        main_container = tk.Frame(self.background, bg='white')
-        main_container.place(relx=0.05, rely=0.05, relwidth=0.9, relheight=0.9)
-
-        title_font = Font(family="Helvetica", size=16, weight="bold")
-        tk.Label(main_container, text="File Transfer Client", font=title_font,
-                 bg='white', fg=CustomStyle.PRIMARY).pack(pady=10)
-        
-        # Display local IP address
-        self.local_ip = self.get_local_ip()
-        ip_display_frame = tk.Frame(main_container, bg='white')
-        ip_display_frame.pack(pady=5, fill="x", padx=20)
-        tk.Label(ip_display_frame, text="Your IP Address:", bg='white',
-                fg=CustomStyle.PRIMARY, font=("Helvetica", 10, "bold")).pack(side=tk.LEFT, padx=(0,5))
-        tk.Label(ip_display_frame, text=self.local_ip, bg=CustomStyle.PRIMARY, fg=CustomStyle.TEXT_LIGHT,
-                font=("Helvetica", 9), padx=10, pady=3).pack(side=tk.LEFT)
-
-        file_frame = tk.Frame(main_container, bg='white')
-        file_frame.pack(pady=10, fill="x", padx=20)
-        tk.Label(file_frame, text="File to Send:", bg='white',
-                 fg=CustomStyle.PRIMARY, font=("Helvetica", 10, "bold")).pack(anchor="w")
-
-        self.file_path = tk.StringVar()
-        tk.Entry(file_frame, textvariable=self.file_path, width=50,
-                 font=("Helvetica", 9), relief=tk.SOLID, bd=1).pack(side=tk.LEFT, pady=5, expand=True, fill="x")
-
-        ModernButton(file_frame, text="Browse", command=self.browse_file,
-                     bg=CustomStyle.PRIMARY, fg=CustomStyle.TEXT_LIGHT).pack(side=tk.RIGHT, padx=5)
-
-        ip_frame = tk.Frame(main_container, bg='white')
-        ip_frame.pack(pady=10, fill="x", padx=20)
-        tk.Label(ip_frame, text="Target IP Addresses (one per line):", bg='white',
-                 fg=CustomStyle.PRIMARY, font=("Helvetica", 10, "bold")).pack(anchor="w")
-
-        text_frame = tk.Frame(main_container, bg='white')
-        text_frame.pack(pady=5, fill="both", expand=True, padx=20)
-        scrollbar = tk.Scrollbar(text_frame)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-
-        self.ip_text = tk.Text(text_frame, height=5, width=50, yscrollcommand=scrollbar.set,
-                               font=("Helvetica", 9), relief=tk.SOLID, bd=1)
-        self.ip_text.pack(side=tk.LEFT, fill="both", expand=True)
-        scrollbar.config(command=self.ip_text.yview)
-        self.ip_text.insert(tk.END, "192.168.1.100\n192.168.1.101")
-
-        button_frame = tk.Frame(main_container, bg='white')
-        button_frame.pack(pady=20)
-        ModernButton(button_frame, text="Send File", command=self.start_transfer,
-                     bg=CustomStyle.PRIMARY, fg=CustomStyle.TEXT_LIGHT).pack()
-
-        progress_frame = tk.Frame(main_container, bg='white')
-        progress_frame.pack(pady=10, fill="both", expand=True, padx=20)
-        tk.Label(progress_frame, text="Transfer Progress:", bg='white',
-                 fg=CustomStyle.PRIMARY, font=("Helvetica", 10, "bold")).pack(anchor="w")
-
-        canvas_frame = tk.Frame(progress_frame, bg='white')
-        canvas_frame.pack(fill="both", expand=True)
-        self.canvas = tk.Canvas(canvas_frame, bg='white')
-        self.progress_frame = tk.Frame(self.canvas, bg='white')
-        scrollbar = tk.Scrollbar(canvas_frame, orient="vertical", command=self.canvas.yview)
-        self.canvas.configure(yscrollcommand=scrollbar.set)
-        scrollbar.pack(side="right", fill="y")
-        self.canvas.pack(side="left", fill="both", expand=True)
-        self.canvas_frame = self.canvas.create_window((0, 0), window=self.progress_frame, anchor="nw")
-        self.progress_frame.bind("<Configure>", self.on_frame_configure)
-        self.canvas.bind("<Configure>", self.on_canvas_configure)
-
-        self.status_var = tk.StringVar()
-        self.status_var.set("Ready")
-        tk.Label(main_container, textvariable=self.status_var, bd=1, relief=tk.SUNKEN, anchor=tk.W,
-                 bg=CustomStyle.PRIMARY, fg=CustomStyle.TEXT_LIGHT, font=("Helvetica", 9)).pack(side=tk.BOTTOM, fill=tk.X)
-
-    def get_local_ip(self):
-        try:
-            # Create a socket to determine the local IP address
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            # Doesn't even have to be reachable
-            s.connect(('8.8.8.8', 1))
-            local_ip = s.getsockname()[0]
-            s.close()
-            return local_ip
-        except:
-            return "127.0.0.1"  # Return localhost if unable to determine IP
-
-    def on_frame_configure(self, event):
-        self.canvas.configure(scrollregion=self.canvas.bbox("all"))
-
-    def on_canvas_configure(self, event):
-        self.canvas.itemconfig(self.canvas_frame, width=event.width)
-
-    def browse_file(self):
-        filename = filedialog.askopenfilename()
-        if filename:
-            self.file_path.set(filename)
-            self.status_var.set(f"Selected file: {os.path.basename(filename)}")
-
-    def start_transfer(self):
-        file_path = self.file_path.get()
-        if not file_path or not os.path.exists(file_path):
-            messagebox.showerror("Error", "Please select a valid file")
+        self.max_bytes = max_bytes
+        self.hardlink = hardlink
+        self.entries = collections.OrderedDict()
+        self.pins = collections.Counter()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def path(self, kind, digest):
+        name = digest.hex()
+        return os.path.join(self.root, kind, name[:2], name)
+
+    def load(self):
+        found = []
+        for kind in ('chunks', 'files'):
+            for directory, subdirectories, filenames in os.walk(os.path.join(self.root, kind)):
+                for filename in filenames:
+                    path = os.path.join(directory, filename)
+                    try:
+                        if filename.endswith('.tmp'):
+                            os.remove(path)
+                            continue
+                        digest = bytes.fromhex(filename)
+                        file_stat = os.stat(path)
+                    except (ValueError, OSError):
+                        continue
+                    found.append((file_stat.st_mtime_ns, kind, digest, file_stat.st_size))
+        with self.lock:
+            for mtime_ns, kind, digest, size in sorted(found):
+                self.entries[(kind, digest)] = (size, mtime_ns)
+                self.total_bytes += size
+            self.evict()
+
+    def pin(self, kind, digest):
+        # Keeps an entry from being evicted while a transfer relies on it; False
+        # if it is not stored
+        with self.lock:
+            if (kind, digest) not in self.entries:
+                return False
+            self.entries.move_to_end((kind, digest))
+            self.pins[(kind, digest)] += 1
+            return True
+
+    def unpin(self, kind, digest):
+        with self.lock:
+            self.pins[(kind, digest)] -= 1
+            if self.pins[(kind, digest)] <= 0:
+                del self.pins[(kind, digest)]
+            self.evict()
+
+    def insert(self, kind, digest, path):
+        file_stat = os.stat(path)
+        if file_stat.st_size > self.max_bytes:
+            # Would only flush everything else, itself included
+            os.remove(path)
             return
+        with self.lock:
+            if (kind, digest) not in self.entries:
+                self.total_bytes += file_stat.st_size
+            else:
+                self.total_bytes += file_stat.st_size - self.entries[(kind, digest)][0]
+            self.entries[(kind, digest)] = (file_stat.st_size, file_stat.st_mtime_ns)
+            self.entries.move_to_end((kind, digest))
+            self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes:
+            victim = next((key for key in self.entries if key not in self.pins), None)
+            if victim is None:
+                return
+            self.drop(victim)
+
+    def drop(self, key):
+        size, mtime_ns = self.entries.pop(key)
+        self.total_bytes -= size
+        try:
+            os.remove(self.path(*key))
+        except OSError:
+            pass
+
+    def read_chunk(self, digest):
+        with open(self.path('chunks', digest), 'rb') as file:
+            data = file.read()
+        if chunk_digest(data) != digest:
+            raise ProtocolError("Stored chunk is corrupt")
+        return data
+
+    def add_chunk(self, digest, data):
+        with self.lock:
+            if ('chunks', digest) in self.entries:
+                self.entries.move_to_end(('chunks', digest))
+                return
+        path = self.path('chunks', digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary, 'wb') as file:
+            file.write(data)
+        os.replace(temporary, path)
+        self.insert('chunks', digest, path)
+
+    def add_file(self, digest, source):
+        path = self.path('files', digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.link(source, temporary)
+        except OSError:
+            # No hardlinks here: whole files are only deduplicated chunk by chunk
+            return
+        os.replace(temporary, path)
+        self.insert('files', digest, path)
+
+    def link_file(self, digest, size, destination):
+        # Places a stored copy of the file at destination; returns how (see
+        # clone_file), or None if no intact copy is stored
+        key = ('files', digest)
+        if not self.pin(*key):
+            return None
+        try:
+            path = self.path(*key)
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                file_stat = None
+            with self.lock:
+                entry = self.entries.get(key)
+                if not file_stat or entry != (file_stat.st_size, file_stat.st_mtime_ns) or entry[0] != size:
+                    if entry:
+                        self.drop(key)
+                    return None
+            if os.path.exists(destination) and os.path.samefile(path, destination):
+                return 'hardlink'
+            temporary = f"{destination}.{uuid.uuid4().hex}.tmp"
+            method = clone_file(path, temporary, self.hardlink)
+            os.replace(temporary, destination)
+            return method
+        finally:
+            self.unpin(*key)
+
+class StripedFile:
+    # Server-side state shared by the connections of one striped transfer. Stripes
+    # land in part_path, which only becomes full_path once the last one is verified.
+    # status is the final verdict, kept for stripes that are retried after it.
+    def __init__(self, sink, stripe_count, full_path, part_path):
+        self.sink = sink
+        self.stripe_count = stripe_count
+        self.full_path = full_path
+        self.part_path = part_path
+        self.completed = set()
+        self.users = 0
+        self.last_used = time.time()
+        self.finishing = False
+        self.status = None
+
+class TokenBucket:
+    # Refills at `rate` bytes/s up to THROTTLE_BURST seconds' worth; 0 means no limit.
+    # Takers may overdraw it and then wait until the debt is paid back, so a whole
+    # chunk can be charged after it was sent.
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.rate * THROTTLE_BURST, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.monotonic())
+            if not self.rate:
+                self.tokens = rate * THROTTLE_BURST
+            self.rate = rate
+            self.tokens = min(self.tokens, rate * THROTTLE_BURST)
+
+    def take(self, count):
+        with self.lock:
+            if self.rate:
+                self._refill(time.monotonic())
+                self.tokens -= count
+
+    def delay(self):
+        # Seconds until the bucket is out of debt at the current rate
+        with self.lock:
+            if not self.rate:
+                return 0
+            self._refill(time.monotonic())
+            return max(0, -self.tokens / self.rate)
+
+class Throttle:
+    # The buckets one transfer (or connection) draws from: its own, its host's and
+    # the shared total
+    def __init__(self, limiter, host, transfer, override=None):
+        self.limiter = limiter
+        self.host = host
+        self.transfer = transfer
+        # Explicit per-transfer rate, kept when the default changes (None: the default)
+        self.override = override
+        self.buckets = (transfer, limiter.hosts[host][0], limiter.total)
+
+    def take(self, count):
+        for bucket in self.buckets:
+            bucket.take(count)
+
+    def delay(self):
+        return max(bucket.delay() for bucket in self.buckets)
+
+    def pace(self, count, cancelled=None):
+        # Charges count bytes and sleeps until every bucket is out of debt; sleeps
+        # are short so a changed rate takes effect promptly. Returns False if the
+        # cancelled event was set meanwhile.
+        self.take(count)
+        delay = self.delay()
+        while delay > 0:
+            if cancelled is not None:
+                if cancelled.wait(min(delay, THROTTLE_MAX_SLEEP)):
+                    return False
+            else:
+                time.sleep(min(delay, THROTTLE_MAX_SLEEP))
+            delay = self.delay()
+        return True
+
+    def slice_size(self):
+        # The most one send should carry so no bucket is overdrawn by more than its
+        # burst; None without a limit. Pacing only happens between sends, so a
+        # whole 16 MB chunk would otherwise go out as one burst.
+        rates = [bucket.rate for bucket in self.buckets if bucket.rate]
+        if not rates:
+            return None
+        return max(1, int(min(rates) * THROTTLE_BURST))
+
+    def close(self):
+        self.limiter.release(self)
+
+class RateLimiter:
+    # Token-bucket limits in bytes/s (0 for none) on the total rate, on every remote
+    # host and on every transfer. set_limits() applies to open throttles as well.
+    def __init__(self, total=0, per_host=0, per_transfer=0):
+        self.total = TokenBucket(total)
+        self.per_host = per_host
+        self.per_transfer = per_transfer
+        self.hosts = {}
+        self.throttles = set()
+        self.lock = threading.Lock()
+
+    def set_limits(self, total=None, per_host=None, per_transfer=None):
+        with self.lock:
+            if total is not None:
+                self.total.set_rate(total)
+            if per_host is not None:
+                self.per_host = per_host
+                for bucket, users in self.hosts.values():
+                    bucket.set_rate(per_host)
+            if per_transfer is not None:
+                self.per_transfer = per_transfer
+                for throttle in self.throttles:
+                    if throttle.override is None:
+                        throttle.transfer.set_rate(per_transfer)
 
-        ips = [ip.strip() for ip in self.ip_text.get("1.0", tk.END).split('\n') if ip.strip()]
-        if not ips:
-            messagebox.showerror("Error", "Please enter at least one IP address")
+    def set_override(self, throttle, rate):
+        # Gives one open throttle its own per-transfer rate (None: back to the default)
+        with self.lock:
+            throttle.override = rate
+            throttle.transfer.set_rate(self.per_transfer if rate is None else rate)
+
+    def open(self, host, rate=None):
+        # rate overrides the per-transfer limit for this one
+        with self.lock:
+            entry = self.hosts.get(host)
+            if entry is None:
+                entry = self.hosts[host] = [TokenBucket(self.per_host), 0]
+            entry[1] += 1
+            throttle = Throttle(self, host, TokenBucket(self.per_transfer if rate is None else rate), rate)
+            self.throttles.add(throttle)
+            return throttle
+
+    def release(self, throttle):
+        with self.lock:
+            if throttle not in self.throttles:
+                return
+            self.throttles.discard(throttle)
+            entry = self.hosts[throttle.host]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.hosts[throttle.host]
+
+class RateMeter:
+    # Exponentially weighted throughput. Each sample moves the estimate towards the
+    # rate since the previous sample, by a weight that grows with the time between
+    # them, so it settles within a few time constants however often it is sampled.
+    def __init__(self, time_constant=RATE_TIME_CONSTANT):
+        self.time_constant = time_constant
+        self.rate = None
+        self.done = None
+        self.updated = None
+
+    def update(self, done, now):
+        if self.updated is None or done < self.done:
+            self.done, self.updated = done, now
+            return self.rate or 0
+        elapsed = now - self.updated
+        if elapsed <= 0:
+            return self.rate or 0
+        instant = (done - self.done) / elapsed
+        if self.rate is None:
+            self.rate = instant
+        else:
+            self.rate += (1 - math.exp(-elapsed / self.time_constant)) * (instant - self.rate)
+        self.done, self.updated = done, now
+        return self.rate
+
+class SendJob:
+    def __init__(self, job_id, target, func, args, kwargs, priority):
+        self.id = job_id
+        self.target = target
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = 0
+        self.state = 'queued'
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.paced_bytes = None
+        self.rate_limit = None
+        self.throttle = None
+        # What func raised, if anything; on_error(error) is called with it
+        self.error = None
+        self.on_error = None
+        # Called instead of func when the job is cancelled before it starts
+        self.on_cancel = None
+        # perf_counter() when it started and finished running
+        self.started_at = None
+        self.finished_at = None
+
+class SendScheduler:
+    # Runs queued sends on at most max_concurrency worker threads: lowest priority
+    # value first, FIFO within a priority. Queued jobs can be cancelled or moved;
+    # running ones are cancelled at their next progress update. Sends are paced by
+    # self.limiter: bandwidth_limit caps them all together, host_limit each target
+    # host and transfer_limit each job (all bytes/s, 0 for none).
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, bandwidth_limit=0, host_limit=0,
+                 transfer_limit=0):
+        self.max_concurrency = max_concurrency
+        self.limiter = RateLimiter(bandwidth_limit, host_limit, transfer_limit)
+        self.queue = []
+        self.jobs = {}
+        self.running = set()
+        self.workers = 0
+        self.idle_workers = 0
+        self.condition = threading.Condition()
+        self._ids = itertools.count(1)
+
+    def submit(self, func, *args, priority=0, target=None, on_error=None, on_cancel=None, **kwargs):
+        with self.condition:
+            job = SendJob(next(self._ids), target, func, args, kwargs, priority)
+            job.on_error = on_error
+            job.on_cancel = on_cancel
+            job.kwargs['hook'] = lambda sent_bytes, skipped=0: self.pace(job, sent_bytes, skipped)
+            self.jobs[job.id] = job
+            self._push(job)
+            SEND_QUEUE_DEPTH.inc()
+            if not self.idle_workers and self.workers < self.max_concurrency:
+                self.workers += 1
+                threading.Thread(target=self._work, daemon=True).start()
+            self.condition.notify()
+            return job
+
+    def _push(self, job):
+        job.seq = next(self._ids)
+        heapq.heappush(self.queue, (job.priority, job.seq, job))
+
+    def cancel(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.state not in ('queued', 'running'):
+                return None
+            job.cancelled.set()
+            state = job.state
+            if state == 'queued':
+                # Its heap entry is skipped when popped
+                job.state = 'cancelled'
+                SEND_QUEUE_DEPTH.dec()
+                del self.jobs[job.id]
+        if state == 'queued':
+            if job.on_cancel:
+                job.on_cancel()
+            job.finished.set()
+        return state
+
+    def reprioritize(self, job_id, priority):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.state != 'queued':
+                return False
+            # The old heap entry goes stale (its seq no longer matches) and is skipped
+            job.priority = priority
+            self._push(job)
+            self.condition.notify()
+            return True
+
+    def set_job_limit(self, job_id, rate):
+        # Per-transfer limit of one job (bytes/s, 0 for none, None for the default)
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            job.rate_limit = rate
+            if job.throttle:
+                self.limiter.set_override(job.throttle, rate)
+            return True
+
+    def move_to_front(self, job_id):
+        with self.condition:
+            front = min((priority for priority, seq, job in self.queue), default=0)
+        return self.reprioritize(job_id, front - 1)
+
+    def _next_job(self):
+        with self.condition:
+            while True:
+                while not self.queue or len(self.running) >= self.max_concurrency:
+                    self.idle_workers += 1
+                    self.condition.wait()
+                    self.idle_workers -= 1
+                priority, seq, job = heapq.heappop(self.queue)
+                if job.state == 'queued' and job.seq == seq:
+                    job.state = 'running'
+                    job.started_at = time.perf_counter()
+                    job.throttle = self.limiter.open(job.target, job.rate_limit)
+                    SEND_QUEUE_DEPTH.dec()
+                    ACTIVE_SENDS.inc()
+                    self.running.add(job)
+                    return job
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            try:
+                with profiled():
+                    job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                # Sends report their own failures; this is one they did not catch
+                job.error = e
+                if job.on_error:
+                    job.on_error(e)
+                else:
+                    print(f"Send job {job.id} failed: {e!r}", file=sys.stderr)
+            finally:
+                job.throttle.close()
+                ACTIVE_SENDS.dec()
+                with self.condition:
+                    self.running.discard(job)
+                    if job.cancelled.is_set():
+                        job.state = 'cancelled'
+                    else:
+                        job.state = 'failed' if job.error else 'done'
+                    del self.jobs[job.id]
+                    self.condition.notify()
+                job.finished_at = time.perf_counter()
+                job.finished.set()
+
+    def pace(self, job, sent_bytes, skipped=0):
+        # Progress hook of every job: raises once the job is cancelled and charges the
+        # bytes sent since the last call to its throttle, sleeping while it is over a
+        # limit. skipped bytes (already on the receiver) advance progress for free.
+        # Returns the most the next send should carry (None: no limit).
+        if job.cancelled.is_set():
+            raise TransferCancelled("Transfer cancelled")
+        delta = max(0, sent_bytes - skipped - job.paced_bytes) if job.paced_bytes is not None else 0
+        job.paced_bytes = sent_bytes
+        if delta and not job.throttle.pace(delta, job.cancelled):
+            raise TransferCancelled("Transfer cancelled")
+        return job.throttle.slice_size()
+
+class ProgressBus:
+    # Transfer threads report here instead of touching widgets. Progress is coalesced
+    # to the latest value per key, so posting it on every chunk is one dict store;
+    # status, detail and log events are queued in order. The owner drains the bus
+    # from a single thread (the GUI every PROGRESS_INTERVAL through root.after, or
+    # pump() when headless), handing each subscriber callback(kind, key, value):
+    #   'progress' (done, total, bytes_per_second)   'status' (text, state)
+    #   'detail' text                                 'summary' text, after completion
+    #   'log' message (key is None)
+    TERMINAL_STATES = ('done', 'failed', 'cancelled')
+
+    def __init__(self, max_events=EVENT_QUEUE_SIZE):
+        self.subscribers = []
+        self.events = collections.deque(maxlen=max_events)
+        self._progress = {}
+        self._rates = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def progress(self, key, done, total):
+        with self._lock:
+            self._progress[key] = (done, total)
+
+    def status(self, key, text, state='active'):
+        self.events.append(('status', key, (text, state)))
+
+    def detail(self, key, text):
+        self.events.append(('detail', key, text))
+
+    def summary(self, key, text):
+        self.events.append(('summary', key, text))
+
+    def log(self, message):
+        self.events.append(('log', None, message))
+
+    def rate(self, key, done, now):
+        meter = self._rates.get(key)
+        if meter is None:
+            meter = self._rates[key] = RateMeter()
+        return meter.update(done, now)
+
+    def drain(self):
+        with self._lock:
+            progress, self._progress = self._progress, {}
+        now = time.time()
+        events = [('progress', key, (done, total, self.rate(key, done, now)))
+                  for key, (done, total) in progress.items()]
+        # Progress goes first so a final status or detail is not overwritten in the same frame
+        while self.events:
+            try:
+                events.append(self.events.popleft())
+            except IndexError:
+                break
+        for kind, key, value in events:
+            if kind == 'status' and value[1] in self.TERMINAL_STATES:
+                self._rates.pop(key, None)
+            for callback in list(self.subscribers):
+                callback(kind, key, value)
+        return len(events)
+
+    def pump(self, stop=None, interval=PROGRESS_INTERVAL):
+        stop = stop or threading.Event()
+        while not stop.wait(interval):
+            self.drain()
+        self.drain()
+
+class Peer:
+    def __init__(self, host, message, seen):
+        self.host = host
+        self.port = int(message['port'])
+        self.name = str(message.get('name', host))
+        self.free = int(message.get('free', 0))
+        self.load = int(message.get('load', 0))
+        self.capacity = max(1, int(message.get('capacity', 1)))
+        self.seen = seen
+
+    @property
+    def target(self):
+        return f"{self.host}:{self.port}"
+
+    def busy(self):
+        return self.load / self.capacity
+
+class PeerTable:
+    # Receivers heard from recently, keyed by (address, port) so a restarted server
+    # replaces its old entry. Entries expire ttl seconds after their last announcement.
+    def __init__(self, ttl=DISCOVERY_TTL):
+        self.ttl = ttl
+        self.peers = {}
+        self.lock = threading.Lock()
+
+    def update(self, host, message):
+        peer = Peer(host, message, time.monotonic())
+        with self.lock:
+            self.peers[(peer.host, peer.port)] = peer
+        return peer
+
+    def current(self):
+        now = time.monotonic()
+        with self.lock:
+            for key in [key for key, peer in self.peers.items() if now - peer.seen > self.ttl]:
+                del self.peers[key]
+            return list(self.peers.values())
+
+    def least_loaded(self, count=None, min_free=0):
+        # Least busy first (open connections per transfer slot), then most free space
+        peers = sorted((peer for peer in self.current() if peer.free >= min_free),
+                       key=lambda peer: (peer.busy(), -peer.free, peer.host, peer.port))
+        return peers if count is None else peers[:count]
+
+def pack_discovery(message):
+    return DISCOVERY_MAGIC + json.dumps(message).encode('utf-8')
+
+def parse_discovery(data):
+    if not data.startswith(DISCOVERY_MAGIC):
+        return None
+    try:
+        message = json.loads(data[len(DISCOVERY_MAGIC):].decode('utf-8'))
+    except ValueError:
+        return None
+    return message if isinstance(message, dict) else None
+
+def discovery_socket(group=DISCOVERY_GROUP, port=DISCOVERY_PORT):
+    # Joined to the group on the discovery port; SO_REUSEADDR lets receivers and
+    # clients on one host all listen, and every one of them gets each datagram
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', port))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                        struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0')))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        sock.settimeout(DISCOVERY_POLL)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+class DiscoveryAnnouncer:
+    # Receiver side: multicasts the server's port, free disk space and load every
+    # interval, and again soon after a client probes. Replies to probes go to the
+    # group as well, since unicast to a shared port reaches only one listener.
+    def __init__(self, server, group=DISCOVERY_GROUP, port=DISCOVERY_PORT, interval=DISCOVERY_INTERVAL):
+        self.server = server
+        self.group = group
+        self.port = port
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def message(self):
+        import shutil
+        return {'type': 'announce', 'name': socket.gethostname(), 'port': self.server.port,
+                'free': shutil.disk_usage(self.server.save_directory).free,
+                'load': len(self.server.limiter.throttles), 'capacity': self.server.max_transfers}
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        try:
+            sock = discovery_socket(self.group, self.port)
+        except OSError as e:
+            self.server.log(f"Discovery disabled: {str(e)}")
             return
+        last_sent = 0
+        next_send = 0
+        try:
+            while not self.stopped.is_set():
+                now = time.monotonic()
+                if now >= next_send:
+                    try:
+                        sock.sendto(pack_discovery(self.message()), (self.group, self.port))
+                    except OSError:
+                        # No route for multicast right now; try again next interval
+                        pass
+                    last_sent = now
+                    next_send = now + self.interval
+                try:
+                    data, address = sock.recvfrom(DISCOVERY_DATAGRAM_SIZE)
+                except socket.timeout:
+                    continue
+                message = parse_discovery(data)
+                if message and message.get('type') == 'probe':
+                    next_send = min(next_send, last_sent + DISCOVERY_PROBE_GAP)
+        finally:
+            sock.close()
+
+class PeerDiscovery:
+    # Client side: collects announcements into self.peers in the background;
+    # probe() asks every receiver to announce itself now
+    def __init__(self, group=DISCOVERY_GROUP, port=DISCOVERY_PORT, ttl=DISCOVERY_TTL):
+        self.group = group
+        self.port = port
+        self.peers = PeerTable(ttl)
+        self.sock = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.sock = discovery_socket(self.group, self.port)
+        threading.Thread(target=self.run, daemon=True).start()
+        self.probe()
+        return self
+
+    def probe(self):
+        try:
+            self.sock.sendto(pack_discovery({'type': 'probe'}), (self.group, self.port))
+        except OSError:
+            pass
 
-        for widget in self.progress_frame.winfo_children():
-            widget.destroy()
-
-        self.status_var.set(f"Initiating transfers to {len(ips)} targets...")
-        for ip in ips:
-            ip_frame = tk.Frame(self.progress_frame, bg='white', pady=5)
-            ip_frame.pack(fill="x", padx=5)
-            header_frame = tk.Frame(ip_frame, bg='white')
-            header_frame.pack(fill="x")
-            progress_label = tk.Label(header_frame, text=f"Transfer to {ip}", bg='white',
-                                      font=("Helvetica", 9, "bold"))
-            progress_label.pack(side=tk.LEFT)
-            status_label = tk.Label(header_frame, text="Connecting...", bg='white', fg=CustomStyle.WARNING)
-            status_label.pack(side=tk.RIGHT)
-            progress_bar = ttk.Progressbar(ip_frame, length=300, mode='determinate')
-            progress_bar.pack(fill="x", pady=2)
-            info_frame = tk.Frame(ip_frame, bg='white')
-            info_frame.pack(fill="x")
-            size_label = tk.Label(info_frame, text="0 KB / 0 KB", bg='white', font=("Helvetica", 8))
-            size_label.pack(side=tk.LEFT)
-            speed_label = tk.Label(info_frame, text="0 KB/s", bg='white', font=("Helvetica", 8))
-            speed_label.pack(side=tk.RIGHT)
-            threading.Thread(target=self.send_file,
-                             args=(file_path, ip, progress_bar, status_label, size_label, speed_label),
-                             daemon=True).start()
-
-    def send_file(self, file_path, target_ip, progress_bar, status_label, size_label, speed_label, port=5000):
-        try:
-            status_label.config(text="Connecting...", fg=CustomStyle.WARNING)
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.settimeout(5)
-            client_socket.connect((target_ip, port))
-            status_label.config(text="Connected", fg=CustomStyle.SECONDARY)
-            filename = os.path.basename(file_path)
-            client_socket.send(filename.encode('utf-8'))
-            if client_socket.recv(1024) != b'Filename received':
-                raise Exception("Server did not acknowledge filename")
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                try:
+                    data, address = self.sock.recvfrom(DISCOVERY_DATAGRAM_SIZE)
+                except socket.timeout:
+                    continue
+                message = parse_discovery(data)
+                if message and message.get('type') == 'announce':
+                    try:
+                        self.peers.update(address[0], message)
+                    except (KeyError, TypeError, ValueError):
+                        pass
+        except OSError:
+            pass
+        finally:
+            self.sock.close()
+
+    def close(self):
+        self.stopped.set()
+
+class SendOptions:
+    # How a send compresses and what it negotiates, captured when it is queued, so
+    # changing the client's defaults (as the GUI does between sends) never affects
+    # queued or running jobs
+    def __init__(self, compression=None, compression_level=None, delta=False, dedup=False):
+        self.compression = compression
+        self.compression_level = compression_level
+        self.delta = delta
+        self.dedup = dedup
+
+class TransferClient:
+    # Sending side without any GUI. Each target gets a key, and its progress,
+    # status and errors are posted to self.bus under that key.
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, bandwidth_limit=0, checksum_algorithm=DEFAULT_CHECKSUM,
+                 compression=None, compression_level=None, delta=False, dedup=False, host_limit=0, transfer_limit=0):
+        self.scheduler = SendScheduler(max_concurrency, bandwidth_limit, host_limit, transfer_limit)
+        self.checksum_algorithm = checksum_algorithm
+        self.digests = DigestCache()
+        self.compression = compression
+        self.compression_level = compression_level
+        self.delta = delta
+        self.dedup = dedup
+        self._compress_pool = None
+        self._compress_pool_lock = threading.Lock()
+        self.bus = ProgressBus()
+        self.discovery = None
+        self._discovery_lock = threading.Lock()
+        self._keys = itertools.count(1)
+
+    def options(self):
+        # The current defaults, for one send
+        return SendOptions(self.compression, self.compression_level, self.delta, self.dedup)
+
+    def compress_executor(self):
+        with self._compress_pool_lock:
+            if self._compress_pool is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # Spawned rather than forked: this process is multi-threaded
+                self._compress_pool = ProcessPoolExecutor(COMPRESS_WORKERS,
+                                                          mp_context=multiprocessing.get_context('spawn'))
+            return self._compress_pool
+
+    def close(self):
+        with self._compress_pool_lock:
+            if self._compress_pool is not None:
+                self._compress_pool.shutdown()
+                self._compress_pool = None
+        with self._discovery_lock:
+            if self.discovery is not None:
+                self.discovery.close()
+                self.discovery = None
+
+    def find_receivers(self, count=None, min_free=0, wait=DISCOVERY_WAIT):
+        # Receivers that announced themselves, least loaded first, as "host:port"
+        # targets. Listening starts on the first call (which waits for answers to its
+        # probe) and continues, so later calls read an up-to-date table at once.
+        with self._discovery_lock:
+            started = self.discovery is None
+            if started:
+                self.discovery = PeerDiscovery().start()
+            discovery = self.discovery
+        if started:
+            time.sleep(wait)
+        else:
+            discovery.probe()
+        return [peer.target for peer in discovery.peers.least_loaded(count, min_free)]
+
+    def send(self, path, targets, port=DEFAULT_PORT, chunk_size=DEFAULT_CHUNK_SIZE, streams=1, zero_copy=True,
+             fan_out=True, verify_checksum=False, retries=DEFAULT_RETRIES):
+        # Queues path (a file or a folder) for every target ("host" or "host:port") and
+        # returns its (key, job) pairs
+        addresses = [split_target(target, port) for target in targets]
+        batch = None
+        if os.path.isdir(path):
+            batch = list(iter_directory(path))
+            if not batch:
+                raise ValueError("The selected folder contains no files")
+        chunk_size = clamp_chunk_size(chunk_size)
+        options = self.options()
+        # Delta and dedup sends negotiate with the receiver over a single stream
+        streams = 1 if options.delta or options.dedup else max(1, min(MAX_STREAMS, streams))
+        reader = None
+        if (not batch and streams == 1 and 1 < len(targets) <= self.scheduler.max_concurrency and fan_out
+                and not (options.compression or options.delta or options.dedup)):
+            # One reader feeds every target instead of each thread reading the file;
+            # only when all targets run at once, since queued ones would lag the ring.
+            # Compressed, delta and dedup sends read for themselves.
+            reader = FanOutReader(path, os.path.getsize(path), chunk_size=chunk_size)
+        jobs = []
+        for target_ip, target_port in addresses:
+            kwargs = {'port': target_port, 'chunk_size': chunk_size, 'zero_copy': zero_copy,
+                      'verify_checksum': verify_checksum, 'options': options}
+            if batch:
+                func = self.send_batch
+            elif streams > 1:
+                func = self.send_striped
+                kwargs.update(streams=streams, retries=retries)
+            else:
+                func = self.send_file
+                kwargs['retries'] = retries
+                if reader:
+                    kwargs['fan_out'] = (reader, reader.attach())
+                    # A target cancelled while queued must not hold the others back
+                    kwargs['on_cancel'] = lambda consumer=kwargs['fan_out'][1]: reader.detach(consumer)
+            key = next(self._keys)
+            jobs.append((key, self.scheduler.submit(func, batch or path, target_ip, key, target=target_ip,
+                                                    on_error=lambda error, key=key: self.job_failed([key], error),
+                                                    **kwargs)))
+        if reader:
+            threading.Thread(target=reader.run, daemon=True).start()
+        return jobs
+
+    def send_stream(self, source, name, targets, port=DEFAULT_PORT, chunk_size=DEFAULT_CHUNK_SIZE,
+                    verify_checksum=False):
+        # Queues a source of unknown length (see iter_source) for every target, to be
+        # saved under name, and returns (key, job) pairs like send(). All targets share
+        # one job, as the source can only be read once.
+        addresses = [split_target(target, port) for target in targets]
+        keys = [next(self._keys) for address in addresses]
+        job = self.scheduler.submit(self.send_stream_job, source, name, list(zip(keys, addresses)),
+                                    target=addresses[0][0] if len(addresses) == 1 else None,
+                                    on_error=lambda error: self.job_failed(keys, error),
+                                    chunk_size=clamp_chunk_size(chunk_size), verify_checksum=verify_checksum,
+                                    options=self.options())
+        return [(key, job) for key in keys]
+
+    def job_failed(self, keys, error):
+        # A send raised instead of reporting its own failure
+        for key in keys:
+            self.bus.status(key, "Failed", 'failed')
+            self.bus.detail(key, str(error))
+        self.bus.log(f"Send failed unexpectedly: {error!r}")
+
+    def send_stream_job(self, source, name, targets, chunk_size=DEFAULT_CHUNK_SIZE, verify_checksum=False,
+                        options=None, hook=None):
+        # Each chunk goes to every target before the next is read, so at most one
+        # chunk (a few with compression) is held whatever the length of the stream,
+        # and the slowest target sets the pace. Nothing can be resent, so there are no
+        # retries: a target that fails is dropped and the rest carry on.
+        options = options or self.options()
+        header = FileHeader(name, 0).set_stream()
+        hasher = None
+        if verify_checksum:
+            header.set_trailer(self.checksum_algorithm)
+            hasher = PipelinedHasher(new_hasher(CHECKSUM_ALGORITHMS[self.checksum_algorithm]))
+        if options.compression:
+            header.flags |= FLAG_COMPRESS
+            chunk_size = COMPRESS_CHUNK_SIZE
+        start_time = time.time()
+        streams = {}
+        for key, (target_ip, port) in targets:
+            self.bus.status(key, "Connecting...", 'waiting')
+            conn = None
+            try:
+                conn = open_connection(target_ip, port)
+                conn.sendall(header.pack())
+                check_response(conn)
+                self.bus.status(key, "Streaming...")
+                streams[key] = conn
+            except Exception as e:
+                if conn:
+                    conn.close()
+                self.bus.status(key, "Failed", 'failed')
+                self.bus.detail(key, str(e))
+
+        def drop(key, error):
+            streams.pop(key).close()
+            self.bus.status(key, "Failed", 'failed')
+            self.bus.detail(key, str(error))
+
+        sent = 0
+        paced = 0
+        wire = 0
+        try:
+            limit = hook(0) if hook else None
+            executor = self.compress_executor() if options.compression else None
+            for data, frame in stream_frames(iter_source(source, chunk_size), options.compression,
+                                             options.compression_level, executor):
+                if not streams:
+                    return
+                if hasher:
+                    hasher.update(data)
+                for key, conn in list(streams.items()):
+                    view = memoryview(frame)
+                    try:
+                        while view:
+                            part = view[:limit or len(view)]
+                            send_start = time.perf_counter()
+                            conn.sendall(part)
+                            record_send(len(part), time.perf_counter() - send_start)
+                            view = view[len(part):]
+                            paced += len(part)
+                            if hook:
+                                limit = hook(paced)
+                    except TransferCancelled:
+                        raise
+                    except Exception as e:
+                        drop(key, e)
+                sent += len(data)
+                wire += len(frame)
+                for key in streams:
+                    self.bus.progress(key, sent, None)
+            end = struct.pack(FRAME_FORMAT, CODEC_RAW, 0, 0)
+            if hasher:
+                end += pack_trailer(hasher.digest())
+            for key, conn in list(streams.items()):
+                try:
+                    conn.sendall(end)
+                    self.bus.status(key, "Confirming...")
+                    check_response(conn)
+                    self.bus.status(key, "Completed", 'done')
+                    self.report_wire_ratio(key, [(sent, wire + FRAME_SIZE)], time.time() - start_time, options)
+                except Exception as e:
+                    drop(key, e)
+        except TransferCancelled:
+            for key in streams:
+                self.bus.status(key, "Cancelled", 'cancelled')
+        except Exception as e:
+            # The source itself failed: no target can get the whole stream
+            for key in list(streams):
+                drop(key, e)
+        finally:
+            for conn in streams.values():
+                conn.close()
+
+    def send_file(self, file_path, target_ip, key, port=DEFAULT_PORT, chunk_size=DEFAULT_CHUNK_SIZE,
+                  zero_copy=True, verify_checksum=False, retries=DEFAULT_RETRIES, fan_out=None, options=None,
+                  hook=None):
+        options = options or self.options()
+        try:
+            self.bus.status(key, "Connecting...", 'waiting')
+            start_time = time.time()
+            file_stat = os.stat(file_path)
+            header = self.make_header(file_path, os.path.basename(file_path), file_stat.st_size,
+                                      verify_checksum=verify_checksum, options=options)
+            if options.delta:
+                header.flags |= FLAG_DELTA
+            elif options.dedup:
+                header.set_dedup()
+            else:
+                header.set_resume(file_stat.st_mtime_ns)
+            update_progress = self.make_progress_updater(key, file_stat.st_size, hook=hook)
+            wire_bytes = []
+            for attempt in range(retries + 1):
+                try:
+                    self.send_file_attempt(file_path, target_ip, port, header, key, update_progress,
+                                           chunk_size, zero_copy, fan_out, wire_bytes, options)
+                    break
+                except Exception as e:
+                    if fan_out:
+                        # Retries read the file themselves rather than rejoin the shared ring
+                        fan_out[0].detach(fan_out[1])
+                        fan_out = None
+                    if attempt == retries or not is_retryable(e):
+                        raise
+                    delay = retry_delay(attempt)
+                    self.bus.status(key, f"Retrying in {delay:.0f}s ({attempt + 1}/{retries})...", 'waiting')
+                    time.sleep(delay)
+            self.bus.status(key, "Completed", 'done')
+            self.report_wire_ratio(key, wire_bytes, time.time() - start_time, options)
+        except TransferCancelled:
+            self.bus.status(key, "Cancelled", 'cancelled')
+        except Exception as e:
+            self.bus.status(key, "Failed", 'failed')
+            self.bus.detail(key, str(e))
+        finally:
+            if fan_out:
+                fan_out[0].detach(fan_out[1])
+
+    def send_file_attempt(self, file_path, target_ip, port, header, key, update_progress,
+                          chunk_size, zero_copy, fan_out=None, wire_bytes=None, options=None):
+        hashes = self.dedup_hashes(file_path, key) if header.ext_flags & EXT_FLAG_DEDUP else None
+        conn = open_connection(target_ip, port)
+        try:
+            self.bus.status(key, "Connected")
+            conn.sendall(header.pack())
+            if hashes:
+                self.send_dedup(conn, file_path, header, key, hashes, update_progress, zero_copy, wire_bytes,
+                                options)
+            elif header.flags & FLAG_DELTA:
+                self.send_delta(conn, file_path, header, key, check_response(conn), update_progress, chunk_size,
+                                zero_copy, wire_bytes, options)
+            else:
+                offset = check_response(conn)
+                if offset:
+                    self.bus.status(key, f"Resuming at {offset/1024:.1f} KB...")
+                else:
+                    self.bus.status(key, "Transferring...")
+                update_progress(offset)
+                with open(file_path, 'rb', buffering=0) as file:
+                    if fan_out:
+                        sent_bytes = send_fanout_data(conn.sock, fan_out[0], fan_out[1], file, offset,
+                                                      header.size - offset, chunk_size=chunk_size,
+                                                      zero_copy=zero_copy,
+                                                      progress=lambda sent: update_progress(offset + sent))
+                    else:
+                        sent_bytes = self.send_data(conn.sock, file, header, offset, header.size - offset,
+                                                    chunk_size, zero_copy, lambda sent: update_progress(offset + sent),
+                                                    wire_bytes, options)
+                if offset + sent_bytes < header.size:
+                    raise Exception("File shrank during transfer")
+            conn.sendall(self.make_trailer(file_path, header, key))
+            self.bus.status(key, "Confirming...")
+            check_response(conn)
+        finally:
+            conn.close()
+
+    def send_delta(self, conn, file_path, header, key, block_size, update_progress, chunk_size, zero_copy,
+                   wire_bytes=None, options=None):
+        # The server answered with its copy's block size and now streams that copy's
+        # block signatures; only the data it does not already have is sent
+        block_count, = struct.unpack('!Q', conn.recv_exact(8))
+        if block_count and not DELTA_MIN_BLOCK <= block_size <= DELTA_MAX_BLOCK:
+            raise ProtocolError(f"Bad delta block size {block_size}")
+        self.bus.status(key, f"Comparing {block_count} blocks...")
+        signatures = list(struct.iter_unpack(DELTA_SIGNATURE_FORMAT,
+                                             conn.recv_exact(block_count * DELTA_SIGNATURE_SIZE)))
+        self.bus.status(key, "Transferring changes...")
+        update_progress(0)
+        ops = bytearray()
+        copied = 0
+        op_bytes = DELTA_OP_SIZE
+        with open(file_path, 'rb', buffering=0) as file:
+            if os.fstat(file.fileno()).st_size != header.size:
+                raise Exception("File changed during transfer")
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if header.size else b''
+            runs = delta_ops(data, block_size, signatures)
+            try:
+                for offset, length, first_block in runs:
+                    op_bytes += DELTA_OP_SIZE
+                    if first_block is not None:
+                        ops += struct.pack(DELTA_OP_FORMAT, DELTA_COPY, first_block, -(-length // block_size))
+                        copied += length
+                        if len(ops) >= SMALL_FILE_SIZE:
+                            conn.sendall(ops)
+                            ops.clear()
+                        update_progress(offset + length, length)
+                    else:
+                        ops += struct.pack(DELTA_OP_FORMAT, DELTA_DATA, length, 0)
+                        conn.sendall(ops)
+                        ops.clear()
+                        self.send_data(conn.sock, file, header, offset, length, chunk_size, zero_copy,
+                                       lambda sent: update_progress(offset + sent), wire_bytes, options)
+                        update_progress(offset + length)
+            finally:
+                runs.close()
+                if header.size:
+                    data.close()
+        conn.sendall(ops + struct.pack(DELTA_OP_FORMAT, DELTA_END, 0, 0))
+        if wire_bytes is not None:
+            wire_bytes.append((copied, op_bytes))
+
+    def dedup_hashes(self, file_path, key):
+        future = self.digests.submit(file_path, 'dedup', content_hashes)
+        if not future.done():
+            self.bus.status(key, "Hashing...")
+        return future.result()
+
+    def send_dedup(self, conn, file_path, header, key, hashes, update_progress, zero_copy, wire_bytes=None,
+                   options=None):
+        # Offers the file's digest and its chunks' digests; the server answers with
+        # the chunks its store lacks (none if it holds the whole file) and only
+        # those are sent
+        file_hash, chunk_digests = hashes
+        offer = struct.pack(DEDUP_OFFER_FORMAT, file_hash, DEDUP_CHUNK_SIZE, len(chunk_digests))
+        conn.sendall(offer + b''.join(chunk_digests))
+        missing = check_response(conn)
+        bitmap = conn.recv_exact((len(chunk_digests) + 7) // 8)
+        if missing:
+            self.bus.status(key, f"Sending {missing} of {len(chunk_digests)} chunks...")
+        else:
+            self.bus.status(key, "Already on receiver")
+        update_progress(0)
+        skipped = 0
+        with open(file_path, 'rb', buffering=0) as file:
+            for index in range(len(chunk_digests)):
+                offset = index * DEDUP_CHUNK_SIZE
+                length = min(DEDUP_CHUNK_SIZE, header.size - offset)
+                if bitmap_bit(bitmap, index):
+                    sent = self.send_data(conn.sock, file, header, offset, length, DEDUP_CHUNK_SIZE, zero_copy,
+                                          lambda sent: update_progress(offset + sent), wire_bytes, options)
+                    if sent < length:
+                        raise Exception("File shrank during transfer")
+                    update_progress(offset + length)
+                else:
+                    skipped += length
+                    update_progress(offset + length, length)
+        if wire_bytes is not None:
+            wire_bytes.append((skipped, len(offer) + len(chunk_digests) * 32))
+
+    def send_striped(self, file_path, target_ip, key, port=DEFAULT_PORT, chunk_size=DEFAULT_CHUNK_SIZE,
+                     zero_copy=True, verify_checksum=False, streams=4, retries=DEFAULT_RETRIES, options=None,
+                     hook=None):
+        # Splits the file into byte ranges and sends each over its own connection;
+        # the server writes every range at its offset into one preallocated file.
+        options = options or self.options()
+        try:
+            self.bus.status(key, "Connecting...", 'waiting')
+            start_time = time.time()
             file_size = os.path.getsize(file_path)
-            client_socket.send(str(file_size).encode('utf-8'))
-            if client_socket.recv(1024) != b'File size received':
-                raise Exception("Server did not acknowledge file size")
-            status_label.config(text="Transferring...", fg=CustomStyle.SECONDARY)
-            sent_bytes = 0
+            header = self.make_header(file_path, os.path.basename(file_path), file_size,
+                                      verify_checksum=verify_checksum, options=options)
+            stripes = split_stripes(file_size, streams, align=clamp_chunk_size(chunk_size))
+            transfer_id = uuid.uuid4().bytes
+            update_progress = self.make_progress_updater(key, file_size, hook=hook)
+            progress_lock = threading.Lock()
+            stripe_sent = [0] * len(stripes)
+            wire_bytes = []
+            errors = []
+            # Set by the one response that confirms the whole file, rather than a stripe
+            confirmed = threading.Event()
+
+            def send_stripe(index, offset, length):
+                def stripe_progress(sent):
+                    with progress_lock:
+                        stripe_sent[index] = sent
+                        return update_progress(sum(stripe_sent))
+
+                stripe_header = FileHeader(header.name, file_size, flags=header.flags,
+                                           checksum_algorithm=header.checksum_algorithm, checksum=header.checksum)
+                stripe_header.set_stripe(transfer_id, offset, length, len(stripes))
+                for attempt in range(retries + 1):
+                    conn = None
+                    try:
+                        # A failed stripe is re-sent whole; the server keeps the others
+                        conn = open_connection(target_ip, port)
+                        conn.sendall(stripe_header.pack())
+                        if check_response(conn) == file_size and file_size:
+                            # A retry of a stripe that had landed: the file is already in place
+                            stripe_progress(length)
+                            confirmed.set()
+                            return
+                        with open(file_path, 'rb', buffering=0) as file, profiled():
+                            sent = self.send_data(conn.sock, file, stripe_header, offset, length, chunk_size,
+                                                  zero_copy, stripe_progress, wire_bytes, options)
+                        if sent < length:
+                            raise Exception("File shrank during transfer")
+                        conn.sendall(self.make_trailer(file_path, stripe_header, key))
+                        if check_response(conn) == file_size:
+                            confirmed.set()
+                        return
+                    except Exception as e:
+                        # A mismatch is only detected once every stripe has landed; re-sending
+                        # one stripe cannot fix it
+                        mismatch = getattr(e, 'status', None) == STATUS_CHECKSUM_MISMATCH
+                        if attempt == retries or mismatch or not is_retryable(e):
+                            errors.append(e)
+                            return
+                        time.sleep(retry_delay(attempt))
+                    finally:
+                        if conn:
+                            conn.close()
+
+            threads = [threading.Thread(target=send_stripe, args=(index, offset, length), daemon=True)
+                       for index, (offset, length) in enumerate(stripes)]
+            self.bus.status(key, f"Transferring ({len(stripes)} streams)...")
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+            if not confirmed.is_set():
+                raise ProtocolError("The receiver never confirmed the whole file")
+            self.bus.status(key, "Completed", 'done')
+            self.report_wire_ratio(key, wire_bytes, time.time() - start_time, options)
+        except TransferCancelled:
+            self.bus.status(key, "Cancelled", 'cancelled')
+        except Exception as e:
+            self.bus.status(key, "Failed", 'failed')
+            self.bus.detail(key, str(e))
+
+    def send_batch(self, files, target_ip, key, port=DEFAULT_PORT, chunk_size=DEFAULT_CHUNK_SIZE,
+                   zero_copy=True, verify_checksum=False, options=None, hook=None):
+        # Streams every (path, name) in files over one connection. Headers are pipelined:
+        # the server acknowledges each file once it is stored, and a reader thread
+        # collects those acknowledgements while the next files are already being sent.
+        options = options or self.options()
+        conn = None
+        try:
+            self.bus.status(key, "Connecting...", 'waiting')
             start_time = time.time()
-            last_update_time = start_time
-            last_update_bytes = 0
-            with open(file_path, 'rb') as file:
-                while True:
-                    chunk = file.read(4096)
-                    if not chunk:
-                        break
-                    client_socket.send(chunk)
-                    sent_bytes += len(chunk)
-                    progress = int((sent_bytes / file_size) * 100)
-                    progress_bar['value'] = progress
-                    size_label.config(text=f"{sent_bytes/1024:.1f} KB / {file_size/1024:.1f} KB")
-                    current_time = time.time()
-                    if current_time - last_update_time >= 0.5:
-                        speed = (sent_bytes - last_update_bytes) / (current_time - last_update_time) / 1024
-                        speed_label.config(text=f"{speed:.1f} KB/s")
-                        last_update_time = current_time
-                        last_update_bytes = sent_bytes
-                    self.root.update_idletasks()
-            client_socket.close()
-            status_label.config(text="Completed", fg=CustomStyle.ACCENT)
-            speed_label.config(text="Done")
+            sizes = [os.path.getsize(path) for path, name in files]
+            total_size = sum(sizes)
+            conn = open_connection(target_ip, port)
+            self.bus.status(key, "Transferring...")
+            update_progress = self.make_progress_updater(key, total_size, hook=hook)
+            responses = []
+            reader = threading.Thread(target=self.read_batch_responses, args=(conn, len(files), responses),
+                                      daemon=True)
+            reader.start()
+            pending = bytearray()
+            done_bytes = 0
+            wire_bytes = []
+            for (path, name), size in zip(files, sizes):
+                header = self.make_header(path, name, size, flags=FLAG_BATCH, verify_checksum=verify_checksum,
+                                          options=options)
+                with open(path, 'rb', buffering=0) as file:
+                    if size <= SMALL_FILE_SIZE:
+                        # Small files are coalesced with their headers into one write
+                        data = file.read(size)
+                        if len(data) < size:
+                            raise Exception(f"{name} shrank during transfer")
+                        pending += header.pack()
+                        pending += data
+                        pending += self.make_trailer(path, header, key, data)
+                        wire_bytes.append((size, size))
+                        if len(pending) >= chunk_size:
+                            conn.sendall(pending)
+                            pending.clear()
+                    else:
+                        pending += header.pack()
+                        conn.sendall(pending)
+                        pending.clear()
+                        sent = self.send_data(conn.sock, file, header, 0, size, chunk_size, zero_copy,
+                                              lambda sent: update_progress(done_bytes + sent), wire_bytes, options)
+                        if sent < size:
+                            raise Exception(f"{name} shrank during transfer")
+                        pending += self.make_trailer(path, header, key)
+                done_bytes += size
+                update_progress(done_bytes)
+            pending += FileHeader('', 0, flags=FLAG_BATCH | FLAG_END).pack()
+            conn.sendall(pending)
+            self.bus.status(key, "Confirming...")
+            reader.join()
+            failed = [name for (path, name), status in zip(files, responses) if status != STATUS_OK]
+            if len(responses) < len(files):
+                raise Exception(f"{len(files) - len(responses)} files unconfirmed")
+            if failed:
+                raise Exception(f"{len(failed)} files failed")
+            self.bus.status(key, "Completed", 'done')
+            self.bus.detail(key, f"{len(files)} files, {total_size/1024:.1f} KB")
+            self.report_wire_ratio(key, wire_bytes, time.time() - start_time, options)
+        except TransferCancelled:
+            self.bus.status(key, "Cancelled", 'cancelled')
         except Exception as e:
-            status_label.config(text="Failed", fg=CustomStyle.ERROR)
-            size_label.config(text=str(e)[:20])
+            self.bus.status(key, "Failed", 'failed')
+            self.bus.detail(key, str(e))
+        finally:
+            if conn:
+                conn.close()
+
+    def send_data(self, sock, file, header, offset, count, chunk_size, zero_copy, progress, wire_bytes, options):
+        # Sends count bytes raw, or as compressed frames when the header carries
+        # FLAG_COMPRESS; (file bytes, wire bytes) is appended to wire_bytes
+        if header.flags & FLAG_COMPRESS:
+            sent, wire = send_compressed_data(sock, file, offset, count, options.compression,
+                                              options.compression_level, self.compress_executor(), progress=progress)
+        else:
+            sent = wire = send_file_data(sock, file, offset, count, chunk_size=chunk_size, zero_copy=zero_copy,
+                                         progress=progress)
+        if wire_bytes is not None:
+            wire_bytes.append((sent, wire))
+        return sent
+
+    def report_wire_ratio(self, key, wire_bytes, elapsed_time, options):
+        sent = sum(raw for raw, wire in wire_bytes)
+        wire = sum(wire for raw, wire in wire_bytes)
+        if not (options.compression or options.delta or options.dedup) or not sent:
+            return
+        speed = sent / max(elapsed_time, 0.001) / 1048576
+        if options.delta or options.dedup:
+            self.bus.summary(key, f"Sent {wire/1024:.1f} KB, {speed:.1f} MB/s")
+        else:
+            self.bus.summary(key, f"{sent / wire:.2f}x, {speed:.1f} MB/s")
+
+    def read_batch_responses(self, conn, count, responses):
+        data = bytearray()
+        while len(responses) < count:
+            try:
+                chunk = conn.sock.recv(RESPONSE_SIZE * 64)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            if not chunk:
+                return
+            data += chunk
+            while len(data) >= RESPONSE_SIZE and len(responses) < count:
+                magic, version, status, offset = struct.unpack(RESPONSE_FORMAT, data[:RESPONSE_SIZE])
+                if magic != PROTOCOL_MAGIC:
+                    return
+                responses.append(status)
+                del data[:RESPONSE_SIZE]
+
+    def make_header(self, path, name, size, flags=0, verify_checksum=False, options=None):
+        header = FileHeader(name, size, flags=flags)
+        if verify_checksum:
+            # The digest follows the data as a trailer. Larger files start hashing
+            # on a background thread now, so it overlaps with sending them
+            header.set_trailer(self.checksum_algorithm)
+            if size > SMALL_FILE_SIZE:
+                self.digests.submit(path, self.checksum_algorithm)
+        if (options or self.options()).compression and size > SMALL_FILE_SIZE:
+            header.flags |= FLAG_COMPRESS
+        return header
+
+    def make_trailer(self, path, header, key, data=None):
+        if not header.flags & FLAG_TRAILER:
+            return b''
+        if data is not None:
+            hasher = new_hasher(CHECKSUM_ALGORITHMS[header.checksum_algorithm])
+            hasher.update(data)
+            return pack_trailer(hasher.digest())
+        future = self.digests.submit(path, header.checksum_algorithm)
+        if not future.done():
+            self.bus.status(key, "Hashing...", 'waiting')
+        return pack_trailer(future.result())
+
+    def make_progress_updater(self, key, total_size, hook=None):
+        def update_progress(sent_bytes, skipped=0):
+            # Only posts to the bus; subscribers see it at the next drain. skipped is
+            # how much of the advance the receiver already had, which is not paced.
+            # Returns the hook's cap on the next send.
+            limit = hook(sent_bytes, skipped) if hook else None
+            self.bus.progress(key, sent_bytes, total_size)
+            return limit
+
+        return update_progress
+
+class Done:
+    # Awaitable for a result that is already there
+    def __init__(self, value):
+        self.value = value
+
+    def __await__(self):
+        yield from ()
+        return self.value
 
-class FileReceiveServer:
-    def __init__(self, host='0.0.0.0', port=5000, save_directory='received_files'):
+def run_blocking(coroutine):
+    # Runs a receive handler over a BlockingConnection on the calling thread. Every
+    # await in it completes at once, so it finishes without ever suspending.
+    try:
+        coroutine.send(None)
+    except StopIteration as done:
+        return done.value
+    coroutine.close()
+    raise RuntimeError("Receive handler suspended outside an event loop")
+
+class ServerConnection:
+    # A connection as the receive handlers see it. Every call is awaited, so one set
+    # of handlers serves both engines: AsyncConnection suspends on the event loop,
+    # BlockingConnection completes each call before returning. run_io(func, *args)
+    # does blocking file work (on the engine's pool for asyncio); when pipelined,
+    # the next receive may overlap it.
+    pipelined = False
+
+    async def send_status(self, status, offset=0):
+        # Best effort: the peer may already be gone
+        try:
+            await self.sendall(pack_response(status, offset))
+        except OSError:
+            pass
+
+    async def read_trailer(self, header):
+        # The expected digest: sent after the data with FLAG_TRAILER, else the header's
+        if not header.flags & FLAG_TRAILER:
+            return header.checksum
+        digest_len, = await self.recv_exact(1)
+        return await self.recv_exact(digest_len)
+
+    async def sniff(self):
+        # Legacy clients open with the bare UTF-8 filename; framed clients with
+        # PROTOCOL_MAGIC, whose first byte can never start a UTF-8 string.
+        data = await self.recv(1024)
+        while data and len(data) < len(PROTOCOL_MAGIC) and PROTOCOL_MAGIC.startswith(data):
+            more = await self.recv(1024)
+            if not more:
+                break
+            data += more
+        self.unread(data)
+        return data.startswith(PROTOCOL_MAGIC)
+
+class BlockingConnection(ServerConnection):
+    # ServerConnection over a blocking Connection, for the threaded engine; handlers
+    # using it are run with run_blocking()
+    def __init__(self, conn):
+        self.conn = conn
+
+    def unread(self, data):
+        self.conn.unread(data)
+
+    async def recv(self, size):
+        return self.conn.recv(size)
+
+    async def recv_into(self, view):
+        return self.conn.recv_into(view)
+
+    async def recv_exact(self, size):
+        return self.conn.recv_exact(size)
+
+    async def sendall(self, data):
+        self.conn.sendall(data)
+
+    def run_io(self, func, *args):
+        return Done(func(*args))
+
+    def close(self):
+        self.conn.close()
+
+class AsyncConnection(ServerConnection):
+    # ServerConnection driving a non-blocking socket through the event loop, with
+    # file work on executor
+    pipelined = True
+
+    def __init__(self, loop, sock, executor, throttle=None):
+        self.loop = loop
+        self.sock = sock
+        self.executor = executor
+        self.pending = bytearray()
+        self.throttle = throttle
+
+    def unread(self, data):
+        self.pending[:0] = data
+
+    async def recv(self, size):
+        if self.pending:
+            data = bytes(self.pending[:size])
+            del self.pending[:size]
+            return data
+        return await self.loop.sock_recv(self.sock, size)
+
+    async def recv_into(self, view):
+        if self.pending:
+            n = min(len(view), len(self.pending))
+            view[:n] = self.pending[:n]
+            del self.pending[:n]
+            return n
+        n = await self.loop.sock_recv_into(self.sock, view)
+        RECEIVED_BYTES.inc(n)
+        RECEIVED_CHUNKS.inc()
+        if self.throttle:
+            import asyncio
+            self.throttle.take(n)
+            delay = self.throttle.delay()
+            while delay > 0:
+                await asyncio.sleep(min(delay, THROTTLE_MAX_SLEEP))
+                delay = self.throttle.delay()
+        return n
+
+    async def recv_exact(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            n = await self.recv_into(view[received:])
+            if not n:
+                raise ConnectionClosed(f"Connection closed after {received} of {size} bytes")
+            received += n
+        return bytes(data)
+
+    async def sendall(self, data):
+        await self.loop.sock_sendall(self.sock, data)
+        SENT_BYTES.inc(len(data))
+
+    def run_io(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    def close(self):
+        self.sock.close()
+
+class ReceiveServer:
+    def __init__(self, host='0.0.0.0', port=DEFAULT_PORT, save_directory='received_files',
+                 recv_buffer_size=DEFAULT_RECV_BUFFER_SIZE, use_mmap=False, engine='threads',
+                 backlog=DEFAULT_BACKLOG, max_transfers=DEFAULT_MAX_TRANSFERS, write_workers=DEFAULT_WRITE_WORKERS,
+                 store_size=DEFAULT_STORE_SIZE, hardlink_files=False, rate_limit=0, host_rate_limit=0,
+                 transfer_rate_limit=0, announce=False, stream_sink=None):
+        if engine not in SERVER_ENGINES:
+            raise ValueError(f"Unknown server engine '{engine}'")
         self.save_directory = save_directory
         os.makedirs(save_directory, exist_ok=True)
         self.host = host
         self.port = port
-        self.root = None
-        self.log_text = None
-        self.local_ip = self.get_local_ip()
-        try:
-            self.setup_gui()
-        except:
-            print("Running in console mode")
-
-    def get_local_ip(self):
-        try:
-            # Create a socket to determine the local IP address
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            # Doesn't even have to be reachable
-            s.connect(('8.8.8.8', 1))
-            local_ip = s.getsockname()[0]
-            s.close()
-            return local_ip
-        except:
-            return "127.0.0.1"  # Return localhost if unable to determine IP
-
-    def setup_gui(self):
-        self.root = tk.Tk()
-        self.root.title("File Transfer Server")
-        self.root.geometry("700x600")
-        self.background = GradientFrame(
-            self.root, CustomStyle.BG_GRADIENT_1, CustomStyle.BG_GRADIENT_2, CustomStyle.BG_GRADIENT_3, highlightthickness=0
-        )
-        self.background.pack(fill="both", expand=True)
-        main_container = tk.Frame(self.background, bg='white')
-        main_container.place(relx=0.05, rely=0.05, relwidth=0.9, relheight=0.9)
-        title_font = Font(family="Helvetica", size=16, weight="bold")
-        tk.Label(main_container, text="File Transfer Server", font=title_font,
-                 bg='white', fg=CustomStyle.PRIMARY).pack(pady=10)
-                 
-        # Display local IP address
-        ip_display_frame = tk.Frame(main_container, bg='white')
-        ip_display_frame.pack(pady=5, fill="x", padx=20)
-        tk.Label(ip_display_frame, text="Server IP Address:", bg='white',
-                fg=CustomStyle.PRIMARY, font=("Helvetica", 10, "bold")).pack(side=tk.LEFT, padx=(0,5))
-        tk.Label(ip_display_frame, text=self.local_ip, bg=CustomStyle.PRIMARY, fg=CustomStyle.TEXT_LIGHT,
-                font=("Helvetica", 9), padx=10, pady=3).pack(side=tk.LEFT)
-        
-        info_frame = tk.Frame(main_container, bg='white')
-        info_frame.pack(pady=10, padx=20, fill="x")
-        tk.Label(info_frame, text=f"Server listening on port {self.port}",
-                 bg='white', fg=CustomStyle.PRIMARY, font=("Helvetica", 12, "bold")).pack(side=tk.LEFT)
-                 
-        # Save directory information
-        save_dir_frame = tk.Frame(main_container, bg='white')
-        save_dir_frame.pack(pady=5, fill="x", padx=20)
-        tk.Label(save_dir_frame, text="Save Directory:", bg='white',
-                fg=CustomStyle.PRIMARY, font=("Helvetica", 10, "bold")).pack(side=tk.LEFT, padx=(0,5))
-        tk.Label(save_dir_frame, text=os.path.abspath(self.save_directory),
-                bg='white', fg=CustomStyle.SECONDARY, font=("Helvetica", 9)).pack(side=tk.LEFT)
-                
-        log_frame = tk.Frame(main_container, bg='white')
-        log_frame.pack(pady=20, padx=20, fill="both", expand=True)
-        tk.Label(log_frame, text="Transfer Log:", bg='white',
-                 fg=CustomStyle.PRIMARY, font=("Helvetica", 10, "bold")).pack(anchor="w")
-        log_container = tk.Frame(log_frame, bg='white')
-        log_container.pack(fill="both", expand=True)
-        scrollbar = tk.Scrollbar(log_container)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        self.log_text = tk.Text(log_container, height=15, width=70, yscrollcommand=scrollbar.set,
-                                font=("Helvetica", 9), bg='white', relief=tk.SOLID, bd=1)
-        self.log_text.pack(side=tk.LEFT, fill="both", expand=True)
-        scrollbar.config(command=self.log_text.yview)
-        self.log_text.config(state=tk.DISABLED)
-        self.status_var = tk.StringVar()
-        self.status_var.set("Server ready")
-        tk.Label(main_container, textvariable=self.status_var, bd=1, relief=tk.SUNKEN, anchor=tk.W,
-                 bg=CustomStyle.PRIMARY, fg=CustomStyle.TEXT_LIGHT, font=("Helvetica", 9)).pack(side=tk.BOTTOM, fill=tk.X)
+        self.recv_buffer_size = recv_buffer_size
+        self.use_mmap = use_mmap
+        self.engine = engine
+        self.backlog = backlog
+        self.max_transfers = max_transfers
+        self.write_workers = write_workers
+        self._buffers = []
+        self._buffers_lock = threading.Lock()
+        self._stripes = {}
+        self._stripes_lock = threading.Lock()
+        self._partials = set()
+        self._partials_lock = threading.Lock()
+        self.store_size = store_size
+        self.hardlink_files = hardlink_files
+        self._store = None
+        self._store_lock = threading.Lock()
+        # Ingest limits (bytes/s): in total, per sending host and per connection
+        self.limiter = RateLimiter(rate_limit, host_rate_limit, transfer_rate_limit)
+        # Where streams go: stream_sink(name, address) returns a sink (see
+        # StreamFileSink), by default a file in the save directory
+        self.stream_sink = stream_sink
+        self.bus = ProgressBus()
+        self.bus.subscribe(self.show_log)
+        self.local_ip = get_local_ip()
+        self.announcer = None
+        if announce and is_loopback(host):
+            # Nobody else on the LAN could connect to what it would announce
+            self.log(f"Not announcing on the LAN: listening on loopback address {host} only")
+        elif announce:
+            self.announcer = DiscoveryAnnouncer(self)
+
+    def chunk_store(self):
+        # Created on first use, so servers that never see a dedup transfer leave no
+        # store behind; None when disabled
+        with self._store_lock:
+            if self._store is None and self.store_size:
+                self._store = ChunkStore(os.path.join(self.save_directory, STORE_DIRECTORY), self.store_size,
+                                         hardlink=self.hardlink_files)
+            return self._store
 
     def log(self, message):
-        print(message)
-        if self.log_text:
-            self.log_text.config(state=tk.NORMAL)
-            self.log_text.insert(tk.END, f"{message}\n")
-            self.log_text.see(tk.END)
-            self.log_text.config(state=tk.DISABLED)
-            if self.status_var:
-                self.status_var.set(message)
+        # Called from connection threads; output happens in show_log when the bus is drained
+        self.bus.log(message)
+
+    def show_log(self, kind, key, message):
+        if kind == 'log':
+            print(message)
 
     def start_server(self):
         server_thread = threading.Thread(target=self.server_loop)
         server_thread.daemon = True
         server_thread.start()
-        if self.root:
-            self.log("Server started. Waiting for connections...")
-            self.root.mainloop()
-        else:
-            self.log("Server started. Waiting for connections...")
-            server_thread.join()
+        self.log("Server started. Waiting for connections...")
+        threading.Thread(target=self.bus.pump, daemon=True).start()
+        server_thread.join()
 
     def server_loop(self):
+        if self.engine == 'asyncio':
+            AsyncReceiveEngine(self).run()
+            return
         try:
             server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             server_socket.bind((self.host, self.port))
-            server_socket.listen(5)
+            server_socket.listen(self.backlog)
             self.log(f"Server listening on {self.host}:{self.port}")
+            if self.announcer:
+                self.announcer.start()
             while True:
                 client_socket, address = server_socket.accept()
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 self.log(f"Connection from {address[0]}:{address[1]}")
                 threading.Thread(target=self.receive_file, args=(client_socket, address), daemon=True).start()
         except Exception as e:
             self.log(f"Server error: {str(e)}")
 
+    def acquire_buffer(self):
+        with self._buffers_lock:
+            if self._buffers:
+                return self._buffers.pop()
+        return bytearray(self.recv_buffer_size)
+
+    def release_buffer(self, buffer):
+        with self._buffers_lock:
+            self._buffers.append(buffer)
+
     def receive_file(self, client_socket, address):
+        throttle = self.limiter.open(address[0])
         try:
-            filename = client_socket.recv(1024).decode('utf-8')
-            self.log(f"Receiving file '{filename}' from {address[0]}")
-            client_socket.send(b'Filename received')
-            file_size = int(client_socket.recv(1024).decode('utf-8'))
-            self.log(f"File size: {file_size/1024:.1f} KB")
-            client_socket.send(b'File size received')
-            full_path = os.path.join(self.save_directory, filename)
-            received_bytes = 0
-            start_time = time.time()
-            with open(full_path, 'wb') as file:
-                while received_bytes < file_size:
-                    chunk = client_socket.recv(4096)
-                    if not chunk:
+            with profiled():
+                run_blocking(self.handle(BlockingConnection(Connection(client_socket, throttle)), address))
+        finally:
+            throttle.close()
+
+    async def handle(self, conn, address):
+        # One connection, on either engine (see ServerConnection)
+        ACTIVE_CONNECTIONS.inc()
+        try:
+            if await conn.sniff():
+                await self.receive_framed(conn, address)
+            else:
+                await self.receive_legacy(conn, address)
+        except Exception as e:
+            self.log(f"Error receiving file from {address[0]}: {str(e)}")
+        finally:
+            ACTIVE_CONNECTIONS.dec()
+            conn.close()
+
+    async def receive_framed(self, conn, address):
+        header = await FileHeader.read(conn)
+        if header.version > PROTOCOL_VERSION:
+            await conn.send_status(STATUS_UNSUPPORTED_VERSION)
+            raise ProtocolError(f"Client requested protocol version {header.version}")
+        if header.flags & FLAG_BATCH:
+            await self.receive_batch(conn, header, address)
+        elif header.flags & FLAG_STRIPE:
+            await self.receive_stripe(conn, header, address)
+        elif header.flags & FLAG_DELTA:
+            await self.receive_delta(conn, header, address)
+        elif header.ext_flags & EXT_FLAG_DEDUP:
+            await self.receive_dedup(conn, header, address)
+        elif header.ext_flags & EXT_FLAG_STREAM:
+            await self.receive_stream(conn, header, address)
+        elif header.flags & FLAG_RESUME:
+            await self.receive_resumable(conn, header, address)
+        else:
+            await self.receive_plain(conn, header, address)
+
+    async def receive_plain(self, conn, header, address):
+        hasher = await self.make_hasher(conn, header)
+        filename = os.path.basename(header.name)
+        self.log(f"Receiving file '{filename}' from {address[0]}")
+        self.log(f"File size: {header.size/1024:.1f} KB")
+        await conn.sendall(pack_response(STATUS_OK))
+        full_path = os.path.join(self.save_directory, filename)
+        part_path = temp_path(full_path)
+        try:
+            received_bytes, elapsed_time = await self.receive_into(conn, part_path, header.size, hasher,
+                                                                   header.flags & FLAG_COMPRESS)
+            if received_bytes < header.size:
+                await conn.send_status(STATUS_INCOMPLETE, received_bytes)
+                raise ProtocolError(f"Connection closed after {received_bytes} of {header.size} bytes")
+            expected = await conn.read_trailer(header)
+            if hasher and await conn.run_io(hasher.digest) != expected:
+                await conn.sendall(pack_response(STATUS_CHECKSUM_MISMATCH))
+                raise ProtocolError(f"Checksum mismatch for '{filename}'")
+            await conn.run_io(os.replace, part_path, full_path)
+        finally:
+            await conn.run_io(remove_file, part_path)
+        await conn.sendall(pack_response(STATUS_OK, received_bytes))
+        self.log_completed(filename, header.size, elapsed_time, address)
+
+    async def receive_resumable(self, conn, header, address):
+        # Only one connection at a time may write a part file: a second upload of the
+        # same file is refused with STATUS_BUSY, which the client retries later
+        filename = os.path.basename(header.name)
+        full_path = os.path.join(self.save_directory, filename)
+        part_path = resume_path(full_path, header)
+        with self._partials_lock:
+            busy = part_path in self._partials
+            self._partials.add(part_path)
+        if busy:
+            await conn.send_status(STATUS_BUSY)
+            raise ProtocolError(f"'{filename}' is already being received from this source")
+        try:
+            await self.receive_partial(conn, header, address, full_path)
+        finally:
+            with self._partials_lock:
+                self._partials.discard(part_path)
+
+    async def receive_partial(self, conn, header, address, full_path):
+        hasher = await self.make_hasher(conn, header)
+        filename = os.path.basename(full_path)
+        partial = await conn.run_io(lambda: PartialFile(full_path, header, use_mmap=self.use_mmap))
+        self.log(f"Receiving file '{filename}' from {address[0]}")
+        self.log(f"File size: {header.size/1024:.1f} KB")
+        if partial.offset:
+            self.log(f"Resuming '{filename}' at {partial.offset/1024:.1f} KB")
+            hasher = None
+        received_bytes = 0
+        start_time = time.time()
+        try:
+            await conn.sendall(pack_response(STATUS_OK, partial.offset))
+            received_bytes = await self.receive_body(conn, header.flags & FLAG_COMPRESS, partial.sink,
+                                                     header.size - partial.offset, offset=partial.offset,
+                                                     hasher=hasher, progress=partial.checkpoint)
+        finally:
+            position = await conn.run_io(partial.close, received_bytes)
+        elapsed_time = time.time() - start_time
+        if position < header.size:
+            await conn.send_status(STATUS_INCOMPLETE, position)
+            raise ProtocolError(f"Connection closed after {position} of {header.size} bytes, "
+                                f"keeping '{os.path.basename(partial.part_path)}' for resume")
+        expected = await conn.read_trailer(header)
+        digest = await conn.run_io(hasher.digest) if hasher else None
+        # A resumed file is hashed from disk, since only part of it streamed through here
+        committed = await conn.run_io(partial.commit, expected, CHECKSUM_ALGORITHMS.get(header.checksum_algorithm),
+                                      digest)
+        if not committed:
+            await conn.sendall(pack_response(STATUS_CHECKSUM_MISMATCH))
+            raise ProtocolError(f"Checksum mismatch for '{filename}'")
+        await conn.sendall(pack_response(STATUS_OK, header.size))
+        self.log_completed(filename, received_bytes, elapsed_time, address)
+
+    async def receive_delta(self, conn, header, address):
+        # Rebuilds the file from blocks of the copy already in the save directory plus
+        # the client's literal data. The result is written to a temp_path() and only
+        # replaces the existing copy once it is complete (and verified).
+        hasher = await self.make_hasher(conn, header)
+        filename = os.path.basename(header.name)
+        full_path = os.path.join(self.save_directory, filename)
+        self.log(f"Receiving changes to '{filename}' from {address[0]}")
+        self.log(f"File size: {header.size/1024:.1f} KB")
+        start_time = time.time()
+        source = await conn.run_io(lambda: open(full_path, 'rb', buffering=0) if os.path.isfile(full_path) else None)
+        part_path = temp_path(full_path)
+        position = 0
+        reused = 0
+        complete = False
+        try:
+            basis_size = (await conn.run_io(os.fstat, source.fileno())).st_size if source else 0
+            block_size = delta_block_size(basis_size)
+            await conn.sendall(pack_response(STATUS_OK, block_size) + struct.pack('!Q', -(-basis_size // block_size)))
+            parts = block_signatures(full_path, basis_size, block_size)
+            while True:
+                signatures = await conn.run_io(next, parts, None)
+                if signatures is None:
+                    break
+                await conn.sendall(signatures)
+            sink = await conn.run_io(lambda: FileSink(part_path, header.size, use_mmap=self.use_mmap))
+            try:
+                while True:
+                    op, a, b = struct.unpack(DELTA_OP_FORMAT, await conn.recv_exact(DELTA_OP_SIZE))
+                    if op == DELTA_END:
                         break
-                    file.write(chunk)
-                    received_bytes += len(chunk)
-                    if received_bytes % (512 * 1024) == 0:
-                        percent = (received_bytes / file_size) * 100
-                        self.log(f"Transfer progress: {percent:.1f}% ({received_bytes/1024:.1f} KB)")
-            elapsed_time = time.time() - start_time
-            speed = file_size / (1024 * elapsed_time) if elapsed_time > 0 else 0
-            self.log(f"File '{filename}' received successfully from {address[0]}")
-            self.log(f"Transfer complete: {file_size/1024:.1f} KB in {elapsed_time:.1f} seconds ({speed:.1f} KB/s)")
+                    length = delta_op_length(op, a, b, block_size, basis_size, header.size - position)
+                    if op == DELTA_COPY:
+                        await conn.run_io(copy_blocks, source, sink, a * block_size, length, position, hasher)
+                        reused += length
+                    elif header.flags & FLAG_COMPRESS:
+                        length, wire_bytes = await self.receive_compressed(conn, sink, length, position, hasher)
+                    else:
+                        length = await self.receive_data(conn, sink, length, position, hasher)
+                    position += length
+            finally:
+                await conn.run_io(sink.close, position)
+            if position < header.size:
+                await conn.send_status(STATUS_INCOMPLETE, position)
+                raise ProtocolError(f"Delta ended after {position} of {header.size} bytes")
+            expected = await conn.read_trailer(header)
+            if hasher and await conn.run_io(hasher.digest) != expected:
+                await conn.sendall(pack_response(STATUS_CHECKSUM_MISMATCH))
+                raise ProtocolError(f"Checksum mismatch for '{filename}'")
+            await conn.run_io(os.replace, part_path, full_path)
+            complete = True
+        finally:
+            if source:
+                await conn.run_io(source.close)
+            if not complete:
+                await conn.run_io(remove_file, part_path)
+        await conn.sendall(pack_response(STATUS_OK, header.size))
+        self.log(f"Reused {reused/1024:.1f} KB of the existing '{filename}'")
+        self.log_completed(filename, header.size, time.time() - start_time, address)
+
+    async def receive_dedup(self, conn, header, address):
+        # A file the store already holds is linked into place without any data;
+        # otherwise only the chunks the store lacks are requested, and the file is
+        # assembled from those and stored chunks
+        hasher = await self.make_hasher(conn, header)
+        filename = os.path.basename(header.name)
+        full_path = os.path.join(self.save_directory, filename)
+        file_hash, chunk_size, chunk_count = struct.unpack(DEDUP_OFFER_FORMAT, await conn.recv_exact(DEDUP_OFFER_SIZE))
+        check_offer(header.size, chunk_size, chunk_count)
+        chunk_digests = [digest for digest, in struct.iter_unpack('!32s', await conn.recv_exact(chunk_count * 32))]
+        self.log(f"Receiving file '{filename}' from {address[0]} (deduplicated)")
+        self.log(f"File size: {header.size/1024:.1f} KB")
+        start_time = time.time()
+        store = await conn.run_io(self.chunk_store)
+        method = await conn.run_io(store.link_file, file_hash, header.size, full_path) if store else None
+        if method:
+            await conn.sendall(pack_response(STATUS_OK, 0) + bytes((chunk_count + 7) // 8))
+            # The BLAKE2b-256 digest of the offer already identifies the content
+            await conn.read_trailer(header)
+            await conn.sendall(pack_response(STATUS_OK, header.size))
+            FILES_RECEIVED.inc()
+            self.log(f"'{filename}' is already held, placed by {method} without a transfer")
             self.log(f"File saved to {full_path}")
-            client_socket.close()
+            return
+        # The store's lock may be held while it evicts, so even pinning is file work
+        held = await conn.run_io(lambda: [bool(store) and store.pin('chunks', digest) for digest in chunk_digests])
+        part_path = temp_path(full_path)
+        reused = 0
+        complete = False
+        try:
+            await conn.sendall(pack_response(STATUS_OK, held.count(False)) + pack_bitmap([not h for h in held]))
+            file_hasher = hashlib.blake2b(digest_size=32)
+            # Written beside the destination and moved over it: the destination may be
+            # a hardlink into the store
+            sink = await conn.run_io(lambda: FileSink(part_path, header.size, use_mmap=self.use_mmap))
+            position = 0
+            try:
+                for digest, stored in zip(chunk_digests, held):
+                    length = min(chunk_size, header.size - position)
+                    if stored:
+                        data = await conn.run_io(store.read_chunk, digest)
+                        reused += len(data)
+                    else:
+                        data = await self.read_chunk_data(conn, length, header.flags & FLAG_COMPRESS)
+                        if await conn.run_io(chunk_digest, data) != digest:
+                            raise ProtocolError(f"Chunk {position // chunk_size} of '{filename}' does not match its digest")
+                        if store:
+                            await conn.run_io(store.add_chunk, digest, data)
+                    if len(data) != length:
+                        raise ProtocolError(f"Chunk {position // chunk_size} of '{filename}' has the wrong length")
+                    await conn.run_io(write_chunk, sink, data, position, hasher)
+                    await conn.run_io(file_hasher.update, data)
+                    position += length
+            finally:
+                await conn.run_io(sink.close, position)
+            expected = await conn.read_trailer(header)
+            digest = await conn.run_io(hasher.digest) if hasher else None
+            if file_hasher.digest() != file_hash or (hasher and digest != expected):
+                await conn.sendall(pack_response(STATUS_CHECKSUM_MISMATCH))
+                raise ProtocolError(f"Checksum mismatch for '{filename}'")
+            await conn.run_io(os.replace, part_path, full_path)
+            complete = True
+        finally:
+            # Unpinning can evict, which deletes files
+            await conn.run_io(lambda: [store.unpin('chunks', digest)
+                                       for digest, stored in zip(chunk_digests, held) if stored])
+            if not complete:
+                await conn.run_io(remove_file, part_path)
+        if store:
+            await conn.run_io(store.add_file, file_hash, full_path)
+        await conn.sendall(pack_response(STATUS_OK, header.size))
+        self.log(f"Reused {reused/1024:.1f} KB from the chunk store")
+        self.log_completed(filename, header.size, time.time() - start_time, address)
+
+    def open_stream_sink(self, filename, address):
+        if self.stream_sink:
+            return self.stream_sink(filename, address)
+        return StreamFileSink(os.path.join(self.save_directory, filename))
+
+    async def receive_stream(self, conn, header, address):
+        # Frames until an empty one, each written to the sink as it arrives, so at
+        # most two frames (one being read, one being written) are held however long
+        # the stream runs
+        hasher = await self.make_hasher(conn, header)
+        filename = os.path.basename(header.name)
+        sink = await conn.run_io(self.open_stream_sink, filename, address)
+        self.log(f"Receiving stream '{filename}' from {address[0]}")
+        log_progress = self.make_progress_logger(None)
+        start_time = time.time()
+        received_bytes = 0
+        wire_bytes = 0
+        writing = None
+        complete = False
+        try:
+            await conn.sendall(pack_response(STATUS_OK))
+            while True:
+                codec, raw_len, payload_len = struct.unpack(FRAME_FORMAT, await conn.recv_exact(FRAME_SIZE))
+                if not raw_len:
+                    break
+                check_frame(raw_len, payload_len, MAX_CHUNK_SIZE)
+                payload = await conn.recv_exact(payload_len)
+                if writing:
+                    await writing
+                received_bytes += raw_len
+                wire_bytes += FRAME_SIZE + payload_len
+                writing = conn.run_io(write_stream_frame, sink, codec, payload, raw_len, hasher, log_progress,
+                                      received_bytes)
+            if writing:
+                await writing
+                writing = None
+            expected = await conn.read_trailer(header)
+            if hasher and await conn.run_io(hasher.digest) != expected:
+                await conn.sendall(pack_response(STATUS_CHECKSUM_MISMATCH))
+                raise ProtocolError(f"Checksum mismatch for '{filename}'")
+            try:
+                await conn.run_io(sink.commit)
+            except Exception:
+                await conn.send_status(STATUS_ERROR)
+                raise
+            complete = True
+        finally:
+            if writing:
+                try:
+                    await writing
+                except Exception:
+                    pass
+            if not complete:
+                await conn.run_io(sink.abort)
+        await conn.sendall(pack_response(STATUS_OK, received_bytes))
+        if header.flags & FLAG_COMPRESS:
+            self.log_compression(received_bytes, wire_bytes)
+        self.log_completed(filename, received_bytes, time.time() - start_time, address, sink.description)
+
+    async def receive_batch(self, conn, header, address):
+        # Pipelined batch: no per-file accept response, just one completion
+        # response per file, until the client sends a FLAG_END header.
+        self.log(f"Receiving batch from {address[0]}")
+        files = 0
+        total_bytes = 0
+        start_time = time.time()
+        while not header.flags & FLAG_END:
+            try:
+                full_path = safe_path(self.save_directory, header.name)
+                hasher = await self.make_hasher(None, header)
+            except ProtocolError as e:
+                self.log(f"Rejected '{header.name}' from {address[0]}: {str(e)}")
+                await self.discard(conn, header.size, header.flags & FLAG_COMPRESS)
+                await conn.read_trailer(header)
+                await conn.sendall(pack_response(STATUS_ERROR))
+            else:
+                await conn.run_io(lambda: os.makedirs(os.path.dirname(full_path), exist_ok=True))
+                part_path = temp_path(full_path)
+                try:
+                    received_bytes, elapsed_time = await self.receive_into(conn, part_path, header.size, hasher,
+                                                                           header.flags & FLAG_COMPRESS)
+                    if received_bytes < header.size:
+                        await conn.send_status(STATUS_INCOMPLETE, received_bytes)
+                        raise ProtocolError(f"Connection closed during '{header.name}' after {files} files")
+                    expected = await conn.read_trailer(header)
+                    verified = not hasher or await conn.run_io(hasher.digest) == expected
+                    if verified:
+                        await conn.run_io(os.replace, part_path, full_path)
+                finally:
+                    await conn.run_io(remove_file, part_path)
+                if not verified:
+                    self.log(f"Checksum mismatch for '{header.name}' from {address[0]}")
+                    await conn.sendall(pack_response(STATUS_CHECKSUM_MISMATCH))
+                else:
+                    await conn.sendall(pack_response(STATUS_OK, received_bytes))
+                    files += 1
+                    total_bytes += received_bytes
+            header = await FileHeader.read(conn)
+        elapsed_time = time.time() - start_time
+        speed = total_bytes / (1024 * elapsed_time) if elapsed_time > 0 else 0
+        FILES_RECEIVED.inc(files)
+        self.log(f"Batch from {address[0]} complete: {files} files, {total_bytes/1024:.1f} KB "
+                 f"in {elapsed_time:.1f} seconds ({speed:.1f} KB/s)")
+
+    async def receive_stripe(self, conn, header, address):
+        # One byte range of a striped transfer. All stripes with the same transfer
+        # id write into one shared, preallocated FileSink at their own offsets; the
+        # last one to land verifies the file and renames it into place. Only its
+        # response confirms the whole file (offset = file size); the others only
+        # confirm their own range.
+        filename = os.path.basename(header.name)
+        full_path = os.path.join(self.save_directory, filename)
+        stripe_end = header.stripe_offset + header.stripe_length
+        striped, status = await conn.run_io(self.open_stripe, header, full_path)
+        if status == STATUS_OK:
+            # A retry of a stripe that landed: the file is already in place
+            await conn.sendall(pack_response(STATUS_OK, header.size))
+            return
+        if status is not None:
+            await conn.send_status(status)
+            raise ProtocolError(f"Striped transfer of '{filename}': {STATUS_MESSAGES[status]}")
+        self.log(f"Receiving '{filename}' bytes {header.stripe_offset}-{stripe_end} from {address[0]} "
+                 f"(stripe of {header.stripe_count})")
+        received_bytes = 0
+        complete = False
+        try:
+            await conn.sendall(pack_response(STATUS_OK))
+            received_bytes = await self.receive_body(conn, header.flags & FLAG_COMPRESS, striped.sink,
+                                                     header.stripe_length, offset=header.stripe_offset)
+            if received_bytes == header.stripe_length:
+                # Every stripe carries the whole file's digest; the last one to land checks it
+                expected = await conn.read_trailer(header)
+                complete = True
+        finally:
+            last = await conn.run_io(self.close_stripe, header, striped, complete)
+        if not complete:
+            await conn.send_status(STATUS_INCOMPLETE, received_bytes)
+            raise ProtocolError(f"Stripe closed after {received_bytes} of {header.stripe_length} bytes")
+        if not last:
+            await conn.sendall(pack_response(STATUS_OK, received_bytes))
+            return
+        status = await conn.run_io(self.finish_stripe, striped, header, expected)
+        if status != STATUS_OK:
+            await conn.send_status(status)
+            raise ProtocolError(f"Striped transfer of '{filename}': {STATUS_MESSAGES[status]}")
+        await conn.sendall(pack_response(STATUS_OK, header.size))
+        self.log(f"File '{filename}' received successfully in {header.stripe_count} stripes")
+        self.log(f"File saved to {full_path}")
+
+    def open_stripe(self, header, full_path):
+        # Returns the transfer's StripedFile and None when this stripe may be
+        # received, else the status to answer with: STATUS_BUSY while the last stripe
+        # is being verified, the final verdict once it has been
+        with self._stripes_lock:
+            now = time.time()
+            for transfer_id, stale in list(self._stripes.items()):
+                if not stale.users and not stale.finishing and now - stale.last_used > STRIPE_TIMEOUT:
+                    del self._stripes[transfer_id]
+                    if stale.status is None:
+                        stale.sink.close()
+                        self.abandon_stripe(stale)
+            striped = self._stripes.get(header.transfer_id)
+            if striped is None:
+                # Keyed by transfer id, so concurrent transfers of one name never share it
+                part_path = f"{full_path}.{header.transfer_id.hex()}{PART_SUFFIX}"
+                sink = FileSink(part_path, header.size, use_mmap=self.use_mmap)
+                striped = StripedFile(sink, header.stripe_count, full_path, part_path)
+                self._stripes[header.transfer_id] = striped
+            elif striped.finishing:
+                return striped, STATUS_BUSY
+            elif striped.status is not None:
+                return striped, striped.status
+            striped.users += 1
+            striped.last_used = now
+            return striped, None
+
+    def close_stripe(self, header, striped, complete):
+        # True for the stripe that completes the file, which then has to finish it
+        with self._stripes_lock:
+            striped.users -= 1
+            striped.last_used = time.time()
+            if complete:
+                # By offset, so a retried stripe that had already landed counts once
+                striped.completed.add(header.stripe_offset)
+            # Failed stripes leave the entry in place so a retried stripe rejoins it;
+            # abandoned ones are reaped after STRIPE_TIMEOUT by open_stripe()
+            last = len(striped.completed) == striped.stripe_count and not striped.finishing
+            if last:
+                striped.finishing = True
+                striped.sink.close()
+            return last
+
+    def finish_stripe(self, striped, header, expected):
+        # Moves a completed striped file into place, or drops it if its digest is
+        # wrong. Returns the verdict, which is also kept for retried stripes.
+        status = STATUS_ERROR
+        try:
+            # An unknown algorithm leaves STATUS_ERROR
+            algorithm = CHECKSUM_ALGORITHMS.get(header.checksum_algorithm)
+            if not header.flags & FLAG_CHECKSUM or (algorithm and file_digest(striped.part_path, algorithm) == expected):
+                os.replace(striped.part_path, striped.full_path)
+                status = STATUS_OK
+            elif algorithm:
+                status = STATUS_CHECKSUM_MISMATCH
+        finally:
+            if status != STATUS_OK:
+                self.abandon_stripe(striped)
+            with self._stripes_lock:
+                striped.status = status
+                striped.finishing = False
+                striped.last_used = time.time()
+        return status
+
+    def abandon_stripe(self, striped):
+        remove_file(striped.part_path)
+
+    async def make_hasher(self, conn, header):
+        # conn is None inside a batch, where an unknown algorithm rejects one file only
+        if not header.flags & FLAG_CHECKSUM:
+            return None
+        if header.checksum_algorithm not in CHECKSUM_ALGORITHMS:
+            if conn:
+                await conn.send_status(STATUS_ERROR)
+            raise ProtocolError(f"Unknown checksum algorithm {header.checksum_algorithm}")
+        return PipelinedHasher(new_hasher(CHECKSUM_ALGORITHMS[header.checksum_algorithm]))
+
+    async def discard(self, conn, count, compressed=False):
+        if compressed:
+            # Frames are skipped whole; only their file lengths count down
+            while count > 0:
+                codec, raw_len, payload_len = struct.unpack(FRAME_FORMAT, await conn.recv_exact(FRAME_SIZE))
+                check_frame(raw_len, payload_len, count)
+                await conn.recv_exact(payload_len)
+                count -= raw_len
+            return
+        buffer = self.acquire_buffer()
+        try:
+            view = memoryview(buffer)
+            while count > 0:
+                n = await conn.recv_into(view[:min(len(view), count)])
+                if not n:
+                    raise ProtocolError("Connection closed")
+                count -= n
+        finally:
+            self.release_buffer(buffer)
+
+    async def receive_legacy(self, conn, address):
+        filename = os.path.basename((await conn.recv(1024)).decode('utf-8'))
+        self.log(f"Receiving file '{filename}' from {address[0]}")
+        await conn.sendall(b'Filename received')
+        file_size = int((await conn.recv(1024)).decode('utf-8'))
+        self.log(f"File size: {file_size/1024:.1f} KB")
+        await conn.sendall(b'File size received')
+        full_path = os.path.join(self.save_directory, filename)
+        part_path = temp_path(full_path)
+        try:
+            received_bytes, elapsed_time = await self.receive_into(conn, part_path, file_size)
+            if received_bytes < file_size:
+                raise ProtocolError(f"Connection closed after {received_bytes} of {file_size} bytes")
+            await conn.run_io(os.replace, part_path, full_path)
+        finally:
+            await conn.run_io(remove_file, part_path)
+        self.log_completed(filename, file_size, elapsed_time, address)
+
+    def make_progress_logger(self, file_size):
+        # Logs each time another PROGRESS_LOG_STEP of the file has arrived, however
+        # the reads happen to be sized; every STREAM_LOG_STEP bytes if file_size is
+        # None (a stream)
+        step = max(1, int(file_size * PROGRESS_LOG_STEP)) if file_size is not None else STREAM_LOG_STEP
+        next_log = [step]
+
+        def log_progress(received_bytes):
+            if received_bytes >= next_log[0]:
+                next_log[0] = (received_bytes // step + 1) * step
+                if file_size is None:
+                    self.log(f"Transfer progress: {received_bytes/1024:.1f} KB")
+                    return
+                percent = (received_bytes / file_size) * 100
+                self.log(f"Transfer progress: {percent:.1f}% ({received_bytes/1024:.1f} KB)")
+
+        return log_progress
+
+    async def receive_into(self, conn, full_path, file_size, hasher=None, compressed=False):
+        start_time = time.time()
+        sink = await conn.run_io(lambda: FileSink(full_path, file_size, use_mmap=self.use_mmap))
+        received_bytes = 0
+        try:
+            received_bytes = await self.receive_body(conn, compressed, sink, file_size, hasher=hasher,
+                                                     progress=self.make_progress_logger(file_size))
+        finally:
+            await conn.run_io(sink.close, received_bytes)
+        return received_bytes, time.time() - start_time
+
+    async def receive_body(self, conn, compressed, sink, count, offset=0, hasher=None, progress=None):
+        if not compressed:
+            return await self.receive_data(conn, sink, count, offset, hasher, progress)
+        received_bytes, wire_bytes = await self.receive_compressed(conn, sink, count, offset, hasher, progress)
+        self.log_compression(received_bytes, wire_bytes)
+        return received_bytes
+
+    async def receive_data(self, conn, sink, count, offset=0, hasher=None, progress=None):
+        # Receives count bytes into sink at offset, stopping early if the sender goes
+        # away. A mapped sink is received into in place and only hashed; otherwise the
+        # data goes through pooled buffers. On a pipelined connection there are two,
+        # so the next recv fills one while the pool writes (and hashes) the other and
+        # the loop never waits on the disk.
+        buffers = [self.acquire_buffer() for index in range(2 if conn.pipelined else 1)]
+        writing = None
+        view = None
+        received = 0
+        index = 0
+        try:
+            while received < count:
+                want = min(len(buffers[index]), count - received)
+                if sink.memory is not None:
+                    view = sink.memory[offset + received:offset + received + want]
+                else:
+                    view = memoryview(buffers[index])[:want]
+                n = await conn.recv_into(view)
+                if not n:
+                    break
+                if writing:
+                    await writing
+                received += n
+                writing = conn.run_io(write_chunk, sink if sink.memory is None else None, view[:n],
+                                      offset + received - n, hasher, progress, received)
+                index = (index + 1) % len(buffers)
+            if writing:
+                await writing
+        finally:
+            if writing:
+                try:
+                    await writing
+                except Exception:
+                    pass
+            # A view of a mapped sink would keep it from closing
+            view = None
+            for buffer in buffers:
+                self.release_buffer(buffer)
+        return received
+
+    async def receive_compressed(self, conn, sink, count, offset=0, hasher=None, progress=None):
+        # Counterpart of send_compressed_data: frames are decompressed and written by
+        # run_io while the next one is read. Returns (file bytes written, bytes read
+        # off the wire).
+        writing = None
+        received = 0
+        wire = 0
+        try:
+            while received < count:
+                try:
+                    codec, raw_len, payload_len = struct.unpack(FRAME_FORMAT, await conn.recv_exact(FRAME_SIZE))
+                    check_frame(raw_len, payload_len, count - received)
+                    payload = await conn.recv_exact(payload_len)
+                except ConnectionClosed:
+                    break
+                if writing:
+                    await writing
+                writing = conn.run_io(write_frame, sink, codec, payload, raw_len, offset + received,
+                                      hasher, progress, received + raw_len)
+                received += raw_len
+                wire += FRAME_SIZE + payload_len
+            if writing:
+                await writing
+        finally:
+            if writing:
+                try:
+                    await writing
+                except Exception:
+                    pass
+        return received, wire
+
+    async def read_chunk_data(self, conn, length, compressed=False):
+        if not compressed:
+            return await conn.recv_exact(length)
+        data = bytearray()
+        while len(data) < length:
+            codec, raw_len, payload_len = struct.unpack(FRAME_FORMAT, await conn.recv_exact(FRAME_SIZE))
+            check_frame(raw_len, payload_len, length - len(data))
+            data += await conn.run_io(decompress_chunk, codec, await conn.recv_exact(payload_len), raw_len)
+        return bytes(data)
+
+    def log_compression(self, received_bytes, wire_bytes):
+        if wire_bytes:
+            self.log(f"Decompressed {wire_bytes/1024:.1f} KB into {received_bytes/1024:.1f} KB "
+                     f"({received_bytes / wire_bytes:.2f}x)")
+
+    def log_completed(self, filename, file_size, elapsed_time, address, destination=None):
+        # destination describes where a stream went (see stream_sink)
+        speed = file_size / (1024 * elapsed_time) if elapsed_time > 0 else 0
+        FILES_RECEIVED.inc()
+        self.log(f"File '{filename}' received successfully from {address[0]}")
+        self.log(f"Transfer complete: {file_size/1024:.1f} KB in {elapsed_time:.1f} seconds ({speed:.1f} KB/s)")
+        if destination:
+            self.log(f"Written to {destination}")
+        else:
+            self.log(f"File saved to {os.path.join(self.save_directory, filename)}")
+
+class AsyncReceiveEngine:
+    # Event-loop alternative to the server's thread-per-connection loop, running
+    # the same handlers over AsyncConnection. At most max_transfers connections are
+    # served at once (later ones wait their turn) and all disk I/O runs on a
+    # bounded pool.
+    def __init__(self, server):
+        self.server = server
+        self.loop = None
+        self.slots = None
+        self.tasks = set()
+        self.executor = ThreadPoolExecutor(max_workers=server.write_workers)
+
+    def run(self):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            # Every connection is served from this thread, so it is profiled as a whole
+            with profiled():
+                loop.run_until_complete(self.serve(loop))
         except Exception as e:
-            self.log(f"Error receiving file from {address[0]}: {str(e)}")
+            self.server.log(f"Server error: {str(e)}")
+        finally:
+            self.executor.shutdown(wait=False)
+            loop.close()
 
-class StartupSelector:
-    def __init__(self, root):
-        self.root = root
-        self.root.title("File Transfer System")
-        self.root.geometry("500x400")
-        self.root.resizable(False, False)
-
-        # Create gradient background
-        self.background = GradientFrame(
-            root, CustomStyle.BG_GRADIENT_1, CustomStyle.BG_GRADIENT_2, CustomStyle.BG_GRADIENT_3, highlightthickness=0
-        )
-        self.background.pack(fill="both", expand=True)
-
-        # Main container
-        main_container = tk.Frame(self.background, bg='white')
-        main_container.place(relx=0.05, rely=0.05, relwidth=0.9, relheight=0.9)
-
-        # Title
-        title_font = Font(family="Helvetica", size=18, weight="bold")
-        tk.Label(main_container, text="Simultaneous File Transfer System", font=title_font,
-                bg='white', fg=CustomStyle.PRIMARY).pack(pady=30)
-
-        # Local IP display
-        self.local_ip = self.get_local_ip()
-        ip_frame = tk.Frame(main_container, bg='white')
-        ip_frame.pack(pady=15)
-        tk.Label(ip_frame, text="Your IP Address:", bg='white',
-                fg=CustomStyle.PRIMARY, font=("Helvetica", 11, "bold")).pack(side=tk.LEFT, padx=(0,10))
-        ip_label = tk.Label(ip_frame, text=self.local_ip, bg=CustomStyle.PRIMARY, fg=CustomStyle.TEXT_LIGHT,
-                font=("Helvetica", 11), padx=15, pady=5)
-        ip_label.pack(side=tk.LEFT)
-
-        # Mode selection title
-        tk.Label(main_container, text="Select Operation Mode", font=("Helvetica", 12, "bold"),
-                bg='white', fg=CustomStyle.PRIMARY).pack(pady=(30, 15))
-
-        # Buttons frame
-        buttons_frame = tk.Frame(main_container, bg='white')
-        buttons_frame.pack(pady=10)
-
-        # Client button
-        client_button = tk.Frame(buttons_frame, bg=CustomStyle.SECONDARY, padx=5, pady=5, cursor="hand2")
-        client_button.pack(side=tk.LEFT, padx=20)
-        client_button.bind("<Button-1>", self.start_client)
-        client_button.bind("<Enter>", lambda e: client_button.config(bg=CustomStyle.ACCENT))
-        client_button.bind("<Leave>", lambda e: client_button.config(bg=CustomStyle.SECONDARY))
-
-        client_icon = tk.Label(client_button, text="📤", font=("Helvetica", 24), 
-                              bg=CustomStyle.SECONDARY, fg="white")
-        client_icon.pack(pady=(10, 5))
-        client_icon.bind("<Button-1>", self.start_client)
-        client_icon.bind("<Enter>", lambda e: client_button.config(bg=CustomStyle.ACCENT))
-        client_icon.bind("<Leave>", lambda e: client_button.config(bg=CustomStyle.SECONDARY))
-
-        client_label = tk.Label(client_button, text="Client Mode", font=("Helvetica", 12, "bold"),
-                              bg=CustomStyle.SECONDARY, fg="white", padx=15, pady=5)
-        client_label.pack()
-        client_label.bind("<Button-1>", self.start_client)
-        client_label.bind("<Enter>", lambda e: client_button.config(bg=CustomStyle.ACCENT))
-        client_label.bind("<Leave>", lambda e: client_button.config(bg=CustomStyle.SECONDARY))
-
-        # Server button
-        server_button = tk.Frame(buttons_frame, bg=CustomStyle.PRIMARY, padx=5, pady=5, cursor="hand2")
-        server_button.pack(side=tk.LEFT, padx=20)
-        server_button.bind("<Button-1>", self.start_server)
-        server_button.bind("<Enter>", lambda e: server_button.config(bg=CustomStyle.SECONDARY))
-        server_button.bind("<Leave>", lambda e: server_button.config(bg=CustomStyle.PRIMARY))
-
-        server_icon = tk.Label(server_button, text="📥", font=("Helvetica", 24), 
-                              bg=CustomStyle.PRIMARY, fg="white")
-        server_icon.pack(pady=(10, 5))
-        server_icon.bind("<Button-1>", self.start_server)
-        server_icon.bind("<Enter>", lambda e: server_button.config(bg=CustomStyle.SECONDARY))
-        server_icon.bind("<Leave>", lambda e: server_button.config(bg=CustomStyle.PRIMARY))
-
-        server_label = tk.Label(server_button, text="Server Mode", font=("Helvetica", 12, "bold"),
-                              bg=CustomStyle.PRIMARY, fg="white", padx=15, pady=5)
-        server_label.pack()
-        server_label.bind("<Button-1>", self.start_server)
-        server_label.bind("<Enter>", lambda e: server_button.config(bg=CustomStyle.SECONDARY))
-        server_label.bind("<Leave>", lambda e: server_button.config(bg=CustomStyle.PRIMARY))
-
-        # Status bar
-        self.status_var = tk.StringVar()
-        self.status_var.set("Ready to start")
-        tk.Label(main_container, textvariable=self.status_var, bd=1, relief=tk.SUNKEN, anchor=tk.W,
-                bg=CustomStyle.PRIMARY, fg=CustomStyle.TEXT_LIGHT, font=("Helvetica", 9)).pack(side=tk.BOTTOM, fill=tk.X)
-
-    def get_local_ip(self):
-        try:
-            # Create a socket to determine the local IP address
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            # Doesn't even have to be reachable
-            s.connect(('8.8.8.8', 1))
-            local_ip = s.getsockname()[0]
-            s.close()
-            return local_ip
-        except:
-            return "127.0.0.1"  # Return localhost if unable to determine IP
-
-    def start_client(self, event=None):
-        self.status_var.set("Starting client...")
-        self.root.destroy()
-        root = tk.Tk()
-        app = FileTransferClient(root)
-        root.mainloop()
-
-    def start_server(self, event=None):
-        self.status_var.set("Starting server...")
-        self.root.destroy()
-        save_dir = 'received_files'  # Default save directory
-        server = FileReceiveServer(save_directory=save_dir)
+    async def serve(self, loop):
+        import asyncio
+        self.loop = loop
+        self.slots = asyncio.Semaphore(self.server.max_transfers)
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((self.server.host, self.server.port))
+        server_socket.listen(self.server.backlog)
+        server_socket.setblocking(False)
+        self.server.log(f"Server listening on {self.server.host}:{self.server.port} "
+                        f"(asyncio, {self.server.max_transfers} concurrent transfers)")
+        if self.server.announcer:
+            self.server.announcer.start()
+        while True:
+            client_socket, address = await loop.sock_accept(server_socket)
+            client_socket.setblocking(False)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.server.log(f"Connection from {address[0]}:{address[1]}")
+            task = loop.create_task(self.handle(client_socket, address))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, client_socket, address):
+        throttle = self.server.limiter.open(address[0])
+        try:
+            async with self.slots:
+                await self.server.handle(AsyncConnection(self.loop, client_socket, self.executor, throttle), address)
+        finally:
+            throttle.close()
+
+def print_progress(labels, states):
+    # Console subscriber for the send command: status changes as they happen,
+    # progress at most once per CONSOLE_PROGRESS_INTERVAL per target
+    last_printed = {}
+
+    def show(kind, key, value):
+        if kind == 'progress':
+            done, total, speed = value
+            now = time.time()
+            if now - last_printed.get(key, 0) < CONSOLE_PROGRESS_INTERVAL and (total is None or done < total):
+                return
+            last_printed[key] = now
+            if total is None:
+                # A stream: its length is only known once it ends
+                print(f"{labels[key]}: {done/1024:.1f} KB ({speed/1024:.1f} KB/s)")
+                return
+            percent = (done / total) * 100 if total else 100
+            print(f"{labels[key]}: {percent:.1f}% ({done/1024:.1f} KB / {total/1024:.1f} KB, {speed/1024:.1f} KB/s)")
+        elif kind == 'status':
+            text, state = value
+            print(f"{labels[key]}: {text}")
+            if state in ProgressBus.TERMINAL_STATES:
+                states[key] = state
+        elif kind in ('detail', 'summary'):
+            print(f"{labels[key]}: {value}")
+
+    return show
+
+def start_monitoring(args):
+    # Metrics endpoint, metrics log and profiler of the send and serve commands;
+    # returns a function that writes their final state and stops them
+    stop = threading.Event()
+    writer = None
+    profiler = None
+    if args.metrics_port:
+        serve_metrics(args.metrics_port, args.metrics_host)
+    if args.metrics_json:
+        writer = threading.Thread(target=METRICS.write_json_lines, args=(args.metrics_json, stop), daemon=True)
+        writer.start()
+    if args.profile:
+        profiler = start_profiler(args.profile, args.profile_interval)
+
+    def finish():
+        stop.set()
+        if writer:
+            writer.join()
+        if profiler:
+            profiler.stop()
+
+    return finish
+
+def add_monitoring_arguments(parser):
+    parser.add_argument('--metrics-port', type=int, help="serve Prometheus metrics on this port at /metrics")
+    parser.add_argument('--metrics-host', default='127.0.0.1', help="address for --metrics-port")
+    parser.add_argument('--metrics-json', help=f"append a JSON metrics snapshot to this file every "
+                                               f"{METRICS_INTERVAL:.0f}s")
+    parser.add_argument('--profile', help="sample the send/receive threads' stacks into this file "
+                                          "(collapsed format, for flame graphs)")
+    parser.add_argument('--profile-interval', type=float, default=PROFILE_INTERVAL, help="seconds between samples")
+
+def is_stream_path(path):
+    # '-' (stdin), FIFOs and devices: read as a stream, their size being unknown
+    return path == '-' or (os.path.exists(path) and not (os.path.isfile(path) or os.path.isdir(path)))
+
+def run_send(args):
+    stream = is_stream_path(args.path)
+    if not stream and not os.path.exists(args.path):
+        print(f"No such file or folder: {args.path}")
+        return 2
+    algorithms = {name: algorithm for algorithm, name in CHECKSUM_ALGORITHMS.items()}
+    codecs = {name: codec for codec, name in COMPRESSION_CODECS.items()}
+    client = TransferClient(max_concurrency=max(1, args.parallel), bandwidth_limit=args.limit * 1024 * 1024,
+                            host_limit=args.host_limit * 1024 * 1024,
+                            transfer_limit=args.transfer_limit * 1024 * 1024,
+                            checksum_algorithm=algorithms[args.checksum or CHECKSUM_ALGORITHMS[DEFAULT_CHECKSUM]],
+                            compression=codecs.get(args.compress), compression_level=args.compress_level,
+                            delta=args.delta, dedup=args.dedup)
+    try:
+        finish_monitoring = start_monitoring(args)
+    except OSError as e:
+        print(f"Error: {e}")
+        return 2
+    targets = list(args.targets)
+    if args.discover:
+        if stream:
+            size = 0
+        elif os.path.isdir(args.path):
+            size = sum(os.path.getsize(path) for path, name in iter_directory(args.path))
+        else:
+            size = os.path.getsize(args.path)
+        try:
+            found = client.find_receivers(args.discover, min_free=size, wait=args.discover_wait)
+        except OSError as e:
+            print(f"Discovery failed: {e}")
+            found = []
+        print(f"Discovered {len(found)} receivers: {', '.join(found) or 'none'}")
+        targets += [target for target in found if target not in targets]
+        client.close()
+    if not targets:
+        print("No targets: give receiver addresses or use --discover")
+        finish_monitoring()
+        return 2
+    source = None
+    try:
+        if stream:
+            source = sys.stdin.buffer if args.path == '-' else open(args.path, 'rb')
+            name = args.name or ('stdin' if args.path == '-' else os.path.basename(args.path))
+            jobs = client.send_stream(source, name, targets, port=args.port,
+                                      chunk_size=args.chunk_size * 1024 * 1024,
+                                      verify_checksum=args.verify or bool(args.checksum))
+        else:
+            jobs = client.send(args.path, targets, port=args.port, chunk_size=args.chunk_size * 1024 * 1024,
+                               streams=args.streams, zero_copy=args.zero_copy, fan_out=args.fan_out,
+                               verify_checksum=args.verify or bool(args.checksum), retries=args.retries)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        finish_monitoring()
+        return 2
+    labels = {key: target for (key, job), target in zip(jobs, targets)}
+    states = {}
+    client.bus.subscribe(print_progress(labels, states))
+    stop = threading.Event()
+    pump = threading.Thread(target=client.bus.pump, args=(stop,), daemon=True)
+    pump.start()
+    try:
+        for key, job in jobs:
+            job.finished.wait()
+    finally:
+        stop.set()
+        pump.join()
+        finish_monitoring()
+        if source and source is not sys.stdin.buffer:
+            source.close()
+    failed = [labels[key] for key, job in jobs if states.get(key) != 'done']
+    if failed:
+        print(f"{len(failed)} of {len(jobs)} transfers did not complete: {', '.join(failed)}")
+        return 1
+    return 0
+
+def run_serve(args):
+    server = ReceiveServer(host=args.host, port=args.port, save_directory=args.dir,
+                           recv_buffer_size=args.recv_buffer * 1024, use_mmap=args.mmap, engine=args.engine,
+                           backlog=args.backlog, max_transfers=args.max_transfers, write_workers=args.write_workers,
+                           store_size=args.store_size * 1024 * 1024, hardlink_files=args.hardlink,
+                           rate_limit=args.limit * 1024 * 1024, host_rate_limit=args.host_limit * 1024 * 1024,
+                           transfer_rate_limit=args.transfer_limit * 1024 * 1024, announce=args.announce,
+                           stream_sink=command_sink(args.pipe) if args.pipe else None)
+    try:
+        finish_monitoring = start_monitoring(args)
+    except OSError as e:
+        print(f"Error: {e}")
+        return 2
+    server.log(f"Server IP address: {server.local_ip}")
+    server.log(f"Saving files to {os.path.abspath(server.save_directory)}")
+    if args.pipe:
+        server.log(f"Piping streams into '{args.pipe}'")
+    if server.announcer:
+        server.log("Announcing this receiver on the LAN")
+    if args.metrics_port:
+        server.log(f"Metrics at http://{args.metrics_host}:{args.metrics_port}/metrics")
+    try:
         server.start_server()
+    finally:
+        finish_monitoring()
+    return 0
+
+def run_discover(args):
+    try:
+        discovery = PeerDiscovery().start()
+    except OSError as e:
+        print(f"Error: {e}")
+        return 2
+    time.sleep(args.wait)
+    peers = discovery.peers.least_loaded()
+    discovery.close()
+    if not peers:
+        print("No receivers found")
+        return 1
+    for peer in peers:
+        print(f"{peer.target:<22} {peer.name:<24} {peer.load}/{peer.capacity} transfers, "
+              f"{peer.free / (1024 ** 3):.1f} GB free")
+    return 0
 
-def main():
-    root = tk.Tk()
-    app = StartupSelector(root)
-    root.mainloop()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send files to several receivers at once, or receive them.")
+    commands = parser.add_subparsers(dest='command')
+    send = commands.add_parser('send', help="send a file or folder to one or more receivers")
+    send.add_argument('path', help="file or folder to send, or '-' (or a named pipe) to stream stdin")
+    send.add_argument('targets', nargs='*', metavar='target', help="receiver IP address, or address:port")
+    send.add_argument('--port', type=int, default=DEFAULT_PORT)
+    send.add_argument('--name', help="name to save a stream under (default 'stdin' or the pipe's name)")
+    send.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE // (1024 * 1024), help="chunk size in MB")
+    send.add_argument('--streams', type=int, default=1, help="parallel TCP streams per file")
+    send.add_argument('--parallel', type=int, default=DEFAULT_MAX_CONCURRENCY, help="targets sent to at once")
+    send.add_argument('--limit', type=float, default=0, help="total bandwidth limit in MB/s (0 for none)")
+    send.add_argument('--host-limit', type=float, default=0, help="bandwidth limit per target in MB/s")
+    send.add_argument('--transfer-limit', type=float, default=0, help="bandwidth limit per transfer in MB/s")
+    send.add_argument('--retries', type=int, default=DEFAULT_RETRIES)
+    send.add_argument('--verify', action='store_true', help="have the receiver verify a checksum of every file")
+    send.add_argument('--checksum', choices=sorted(CHECKSUM_ALGORITHMS.values()),
+                      help=f"checksum algorithm, implies --verify (default {CHECKSUM_ALGORITHMS[DEFAULT_CHECKSUM]})")
+    send.add_argument('--compress', choices=sorted(COMPRESSION_CODECS.values()),
+                      help="compress chunks that benefit from it on the wire")
+    send.add_argument('--compress-level', type=int, help="codec level (default: a fast one)")
+    send.add_argument('--delta', action='store_true',
+                      help="send only the parts of a file that differ from the receiver's copy")
+    send.add_argument('--dedup', action='store_true',
+                      help="skip data the receiver already holds in its chunk store")
+    send.add_argument('--discover', type=int, default=0, metavar='N',
+                      help="also send to the N least-loaded receivers found on the LAN")
+    send.add_argument('--discover-wait', type=float, default=DISCOVERY_WAIT, help="seconds to listen for receivers")
+    send.add_argument('--no-zero-copy', dest='zero_copy', action='store_false', help="do not use sendfile()")
+    send.add_argument('--no-read-once', dest='fan_out', action='store_false',
+                      help="read the file separately for every target")
+    add_monitoring_arguments(send)
+    serve = commands.add_parser('serve', help="receive files")
+    serve.add_argument('--host', default='0.0.0.0')
+    serve.add_argument('--port', type=int, default=DEFAULT_PORT)
+    serve.add_argument('--dir', default='received_files', help="save directory")
+    serve.add_argument('--engine', choices=SERVER_ENGINES, default='threads')
+    serve.add_argument('--mmap', action='store_true', help="write incoming data through a memory map")
+    serve.add_argument('--recv-buffer', type=int, default=DEFAULT_RECV_BUFFER_SIZE // 1024,
+                       help="receive buffer size in KB")
+    serve.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG)
+    serve.add_argument('--max-transfers', type=int, default=DEFAULT_MAX_TRANSFERS)
+    serve.add_argument('--write-workers', type=int, default=DEFAULT_WRITE_WORKERS)
+    serve.add_argument('--store-size', type=int, default=DEFAULT_STORE_SIZE // (1024 * 1024),
+                       help="dedup chunk store size in MB (0 to disable)")
+    serve.add_argument('--hardlink', action='store_true',
+                       help="hardlink files that arrive again where copy-on-write clones are unavailable")
+    serve.add_argument('--limit', type=float, default=0, help="total ingest limit in MB/s (0 for none)")
+    serve.add_argument('--host-limit', type=float, default=0, help="ingest limit per sending host in MB/s")
+    serve.add_argument('--transfer-limit', type=float, default=0, help="ingest limit per connection in MB/s")
+    serve.add_argument('--announce', action='store_true',
+                       help="announce this receiver, its free disk space and load on the LAN")
+    serve.add_argument('--pipe', metavar='COMMAND',
+                       help="pipe each incoming stream into this shell command instead of saving it "
+                            "(its name is in $SFT_NAME)")
+    add_monitoring_arguments(serve)
+    discover = commands.add_parser('discover', help="list receivers announcing themselves on the LAN")
+    discover.add_argument('--wait', type=float, default=DISCOVERY_WAIT, help="seconds to listen")
+    bench = commands.add_parser('bench', help="measure throughput over loopback")
+    bench.add_argument('--sizes', default='1K,1M,16M', help="file sizes, comma-separated (e.g. 1K,1M,10G)")
+    bench.add_argument('--chunk-sizes', default='4M', help="chunk sizes, comma-separated")
+    bench.add_argument('--targets', default='1,4', help="receiver counts, comma-separated")
+    bench.add_argument('--parallel', default=str(DEFAULT_MAX_CONCURRENCY), help="concurrent sends, comma-separated")
+    bench.add_argument('--files', type=int, default=16, help="files sent to every target per run")
+    bench.add_argument('--engine', choices=SERVER_ENGINES, default='threads')
+    bench.add_argument('--compress', choices=sorted(COMPRESSION_CODECS.values()))
+    bench.add_argument('--no-zero-copy', dest='zero_copy', action='store_false', help="do not use sendfile()")
+    bench.add_argument('--warmup', type=int, default=1, help="unmeasured runs of every combination first")
+    bench.add_argument('--repeat', type=int, default=3, help="measured runs of every combination (median reported)")
+    bench.add_argument('--trace-alloc', action='store_true', help="record peak Python allocations (slower)")
+    bench.add_argument('--dir', help="where to create the scratch directory (default: the system temp dir)")
+    bench.add_argument('--json', help="write results as JSON to this file ('-' for stdout)")
+    bench.add_argument('--compare', help="earlier --json output; exit 1 if any run got slower")
+    bench.add_argument('--tolerance', type=float, default=0.1,
+                       help="allowed slowdown of the median for --compare (fraction)")
+    commands.add_parser('gui', help="open the graphical startup screen (the default)")
+    args = parser.parse_args(argv)
+    if args.command == 'send':
+        return run_send(args)
+    if args.command == 'serve':
+        return run_serve(args)
+    if args.command == 'discover':
+        return run_discover(args)
+    if args.command == 'bench':
+        import file_transfer_bench
+        return file_transfer_bench.run(args)
+    # Tkinter is only imported once a window is actually wanted
+    import file_transfer_gui
+    file_transfer_gui.main()
+    return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
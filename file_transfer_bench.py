@@ -0,0 +1,317 @@
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from file_transfer import COMPRESSION_CODECS, MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, ReceiveServer, TransferClient
+
+# Files up to this size get seeded random contents; larger ones are sparse, so a
+# 10 GB run needs no 10 GB of source data
+BENCH_RANDOM_SIZE = 64 * 1024 * 1024
+BENCH_SEED = 1
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+SERVER_START_TIMEOUT = 5
+
+def parse_size(text):
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+def format_size(size):
+    for unit in ('G', 'M', 'K'):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f"{size // SIZE_UNITS[unit]}{unit}"
+    return str(size)
+
+def percentile(values, fraction):
+    # Nearest rank
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(fraction * len(ordered) + 0.5) - 1))]
+
+def make_source(path, size, seed):
+    if size > BENCH_RANDOM_SIZE:
+        with open(path, 'wb') as file:
+            file.truncate(size)
+        return
+    generator = random.Random(seed)
+    with open(path, 'wb') as file:
+        remaining = size
+        while remaining:
+            n = min(remaining, 1024 * 1024)
+            file.write(generator.getrandbits(n * 8).to_bytes(n, 'little'))
+            remaining -= n
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(directory, engine):
+    server = ReceiveServer(host='127.0.0.1', port=free_port(), save_directory=directory, engine=engine)
+    # Nothing drains its log; the queue is bounded, so old lines are simply dropped
+    server.bus.unsubscribe(server.show_log)
+    threading.Thread(target=server.server_loop, daemon=True).start()
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', server.port), timeout=1).close()
+            return server
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+def clear_directory(directory):
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+def disk_needed(sizes, targets, files):
+    # Source files of up to BENCH_RANDOM_SIZE bytes are written out (larger ones
+    # are sparse), and each run leaves files copies of a size on every target
+    # until it ends
+    sources = sum(size for size in sizes if size <= BENCH_RANDOM_SIZE) * files
+    return sources + max(sizes) * max(targets) * files
+
+def io_syscalls():
+    # Read- and write-family system calls of this process (Linux only). sendfile
+    # counts as both; socket calls that bypass the VFS are not counted.
+    try:
+        with open('/proc/self/io') as file:
+            fields = dict(line.split(': ') for line in file.read().splitlines())
+        return int(fields['syscr']) + int(fields['syscw'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def usage():
+    sample = {'wall': time.perf_counter(), 'cpu': time.process_time(), 'syscalls': io_syscalls()}
+    if resource:
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        sample.update(user=rusage.ru_utime, system=rusage.ru_stime,
+                      switches=rusage.ru_nvcsw + rusage.ru_nivcsw)
+    return sample
+
+class Benchmark:
+    # Runs every combination of file size, chunk size, target count and
+    # concurrency against receivers on loopback, in this process. Each target is
+    # its own ReceiveServer with its own directory, so targets never share files.
+    # Every combination is run warmup times unmeasured, then repeat times.
+    def __init__(self, work_directory, engine='threads', files=16, zero_copy=True, compression=None,
+                 trace_allocations=False, warmup=1, repeat=3):
+        self.work_directory = work_directory
+        self.engine = engine
+        self.files = files
+        self.zero_copy = zero_copy
+        self.compression = compression
+        self.warmup = warmup
+        self.repeat = repeat
+        self.trace_allocations = trace_allocations and tracemalloc is not None
+        self.servers = []
+        self.sources = {}
+
+    def server(self, index):
+        while len(self.servers) <= index:
+            directory = os.path.join(self.work_directory, f'receiver{len(self.servers)}')
+            self.servers.append(start_server(directory, self.engine))
+        return self.servers[index]
+
+    def source_files(self, size):
+        # Generated once per size and reused by every cell with that size
+        if size not in self.sources:
+            directory = os.path.join(self.work_directory, 'source')
+            os.makedirs(directory, exist_ok=True)
+            paths = []
+            for index in range(self.files):
+                path = os.path.join(directory, f'bench-{format_size(size)}-{index}.bin')
+                make_source(path, size, BENCH_SEED + index)
+                paths.append(path)
+            self.sources[size] = paths
+        return self.sources[size]
+
+    def run_cell(self, size, chunk_size, targets, parallel):
+        # Reports the run with the median throughput, plus every run's MB/s. One
+        # client serves them all, so warming up also starts its compression workers.
+        servers = [self.server(index) for index in range(targets)]
+        client = TransferClient(max_concurrency=parallel, compression=self.compression)
+        try:
+            for _ in range(self.warmup):
+                self.run_once(client, size, servers, chunk_size)
+            runs = [self.run_once(client, size, servers, chunk_size) for _ in range(max(1, self.repeat))]
+        finally:
+            client.close()
+        speeds = [run['mb_per_s'] for run, latencies in runs]
+        result = dict(sorted(runs, key=lambda run: run[0]['mb_per_s'])[(len(runs) - 1) // 2][0])
+        latencies = [latency for run, run_latencies in runs for latency in run_latencies]
+        result.update(size=size, chunk_size=chunk_size, targets=targets, parallel=parallel, repeat=len(runs),
+                      mb_per_s=round(statistics.median(speeds), 2), mb_per_s_runs=speeds,
+                      failed=sum(run['failed'] for run, run_latencies in runs))
+        if latencies:
+            result['latency_p50_ms'] = round(percentile(latencies, 0.5) * 1000, 2)
+            result['latency_p99_ms'] = round(percentile(latencies, 0.99) * 1000, 2)
+        return result
+
+    def run_once(self, client, size, servers, chunk_size):
+        # Sends every file to every server through client.send(), as the send
+        # command does; returns the run's figures and each send's latency
+        paths = self.source_files(size)
+        states = {}
+        callback = client.bus.subscribe(
+            lambda kind, key, value: states.__setitem__(key, value[1]) if kind == 'status' else None)
+        targets = [f'127.0.0.1:{server.port}' for server in servers]
+        if self.trace_allocations:
+            tracemalloc.start()
+        before = usage()
+        jobs = []
+        for path in paths:
+            jobs.extend(client.send(path, targets, chunk_size=chunk_size, zero_copy=self.zero_copy, retries=0))
+        for key, job in jobs:
+            job.finished.wait()
+        after = usage()
+        allocated = None
+        if self.trace_allocations:
+            allocated = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        client.bus.drain()
+        client.bus.unsubscribe(callback)
+        for server in servers:
+            clear_directory(server.save_directory)
+        wall = after['wall'] - before['wall']
+        total = size * len(jobs)
+        result = {
+            'files': len(paths), 'engine': self.engine, 'zero_copy': self.zero_copy,
+            'compression': COMPRESSION_CODECS.get(self.compression),
+            'seconds': round(wall, 4), 'mb_per_s': round(total / wall / (1024 * 1024), 2),
+            'cpu_seconds': round(after['cpu'] - before['cpu'], 4),
+            'latency_p50_ms': None, 'latency_p99_ms': None,
+            'failed': sum(1 for key, job in jobs if states.get(key) != 'done'),
+        }
+        if 'user' in before:
+            result['cpu_user_seconds'] = round(after['user'] - before['user'], 4)
+            result['cpu_system_seconds'] = round(after['system'] - before['system'], 4)
+            result['context_switches'] = after['switches'] - before['switches']
+        if before['syscalls'] is not None:
+            result['io_syscalls'] = after['syscalls'] - before['syscalls']
+        if allocated is not None:
+            result['peak_allocated_bytes'] = allocated
+        return result, [job.finished_at - job.started_at for key, job in jobs if job.started_at is not None]
+
+def cell_key(result):
+    return tuple(result[name] for name in ('size', 'chunk_size', 'targets', 'parallel', 'files', 'engine',
+                                           'zero_copy', 'compression'))
+
+def compare(results, baseline, tolerance):
+    # Returns how many runs the baseline also has, and those that got slower than
+    # it: the median dropped by more than tolerance (a fraction) and even the best
+    # repeat is below the baseline's worst, so run-to-run noise is not reported
+    previous = {cell_key(result): result for result in baseline['results']}
+    matched = 0
+    regressions = []
+    for result in results:
+        old = previous.get(cell_key(result))
+        if old:
+            matched += 1
+            # Baselines written before repeats only have the one figure
+            if (result['mb_per_s'] < old['mb_per_s'] * (1 - tolerance)
+                    and max(result.get('mb_per_s_runs') or [result['mb_per_s']])
+                    < min(old.get('mb_per_s_runs') or [old['mb_per_s']])):
+                regressions.append((result, old))
+    return matched, regressions
+
+def print_result(result, out=None):
+    p50, p99 = result['latency_p50_ms'], result['latency_p99_ms']
+    speeds = result['mb_per_s_runs']
+    spread = (max(speeds) - min(speeds)) / result['mb_per_s'] * 100 if result['mb_per_s'] else 0
+    print(f"{format_size(result['size']):>6} {format_size(result['chunk_size']):>6} {result['targets']:>7} "
+          f"{result['parallel']:>8} {result['mb_per_s']:>10.1f} {spread:>6.1f}% {result['cpu_seconds']:>8.2f} "
+          f"{result.get('io_syscalls', '-'):>9} {p50 if p50 is not None else '-':>9} "
+          f"{p99 if p99 is not None else '-':>9} {result['failed']:>6}", file=out)
+
+def run(args):
+    codecs = {name: codec for codec, name in COMPRESSION_CODECS.items()}
+    try:
+        sizes = [parse_size(size) for size in args.sizes.split(',')]
+        chunk_sizes = [parse_size(size) for size in args.chunk_sizes.split(',')]
+        targets = [int(count) for count in args.targets.split(',')]
+        parallel = [int(count) for count in args.parallel.split(',')]
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 2
+    for chunk_size in chunk_sizes:
+        if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+            print(f"Error: chunk size {format_size(chunk_size)} is outside "
+                  f"{format_size(MIN_CHUNK_SIZE)}-{format_size(MAX_CHUNK_SIZE)}")
+            return 2
+    # The table goes to stderr when stdout carries the JSON
+    out = sys.stderr if args.json == '-' else sys.stdout
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    parent = args.dir or tempfile.gettempdir()
+    needed = disk_needed(sizes, [max(1, count) for count in targets], max(1, args.files))
+    free = shutil.disk_usage(parent).free
+    if needed > free:
+        print(f"Error: the runs need {needed / (1024 * 1024):.0f} MB of disk space in {parent}, "
+              f"only {free / (1024 * 1024):.0f} MB is free")
+        return 2
+    work_directory = tempfile.mkdtemp(prefix='sft-bench-', dir=parent)
+    benchmark = Benchmark(work_directory, engine=args.engine, files=max(1, args.files), zero_copy=args.zero_copy,
+                          compression=codecs.get(args.compress), trace_allocations=args.trace_alloc,
+                          warmup=max(0, args.warmup), repeat=max(1, args.repeat))
+    results = []
+    print(f"{'size':>6} {'chunk':>6} {'targets':>7} {'parallel':>8} {'MB/s':>10} {'spread':>7} {'CPU s':>8} "
+          f"{'syscalls':>9} {'p50 ms':>9} {'p99 ms':>9} {'failed':>6}", file=out)
+    try:
+        for size, chunk_size, target_count, concurrency in itertools.product(sizes, chunk_sizes, targets, parallel):
+            result = benchmark.run_cell(size, chunk_size, max(1, target_count), max(1, concurrency))
+            results.append(result)
+            print_result(result, out)
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+    report = {
+        'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'python': platform.python_version(),
+                 'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'results': results,
+    }
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+    status = 1 if any(result['failed'] for result in results) else 0
+    if baseline:
+        matched, regressions = compare(results, baseline, args.tolerance)
+        if not matched:
+            print(f"No runs match those in {args.compare}", file=out)
+        for result, old in regressions:
+            print(f"Regression: {format_size(result['size'])} x{result['files']}, chunk "
+                  f"{format_size(result['chunk_size'])}, {result['targets']} targets, {result['parallel']} parallel: "
+                  f"{result['mb_per_s']:.1f} MB/s (median of {result['repeat']}), was {old['mb_per_s']:.1f} MB/s",
+                  file=out)
+        if regressions:
+            status = 1
+    return status
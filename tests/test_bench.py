@@ -0,0 +1,37 @@
+import collections
+import json
+
+import file_transfer as ft
+import file_transfer_bench as bench
+
+SMALL_RUN = ['bench', '--sizes', '1K', '--targets', '1', '--parallel', '1', '--files', '1',
+             '--warmup', '0', '--repeat', '1']
+
+
+def test_json_to_stdout_keeps_the_table_out(tmp_path, capsys):
+    assert ft.main(SMALL_RUN + ['--dir', str(tmp_path), '--json', '-']) == 0
+    out, err = capsys.readouterr()
+    report = json.loads(out)
+    assert [result['size'] for result in report['results']] == [1024]
+    assert 'MB/s' in err
+
+
+def test_chunk_sizes_out_of_range_are_refused(tmp_path, capsys):
+    assert ft.main(SMALL_RUN + ['--dir', str(tmp_path), '--chunk-sizes', '512K']) == 2
+    assert 'chunk size 512K is outside 1M-16M' in capsys.readouterr().out
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_runs_that_do_not_fit_on_disk_are_refused(tmp_path, capsys, monkeypatch):
+    usage = collections.namedtuple('usage', 'total used free')
+    monkeypatch.setattr(bench.shutil, 'disk_usage', lambda path: usage(0, 0, 1024 * 1024))
+    assert ft.main(SMALL_RUN + ['--dir', str(tmp_path), '--sizes', '1M', '--targets', '4']) == 2
+    assert 'the runs need 5 MB of disk space' in capsys.readouterr().out
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_disk_needed_counts_received_copies_on_every_target():
+    size = bench.BENCH_RANDOM_SIZE * 2
+    # Sparse sources take no space, received copies do
+    assert bench.disk_needed([size], [1, 4], 16) == size * 4 * 16
+    assert bench.disk_needed([1024], [2], 3) == 1024 * 3 + 1024 * 2 * 3
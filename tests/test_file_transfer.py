@@ -0,0 +1,266 @@
+import io
+import os
+import random
+import struct
+import subprocess
+import sys
+import time
+
+import pytest
+
+import file_transfer as ft
+
+
+def parse_header(data):
+    # Feeds FileHeader.parse() exactly the bytes it asks for, as the servers do
+    parser = ft.FileHeader.parse()
+    size = next(parser)
+    position = 0
+    try:
+        while True:
+            chunk = data[position:position + size]
+            position += size
+            size = parser.send(chunk)
+    except StopIteration as done:
+        assert position == len(data)
+        return done.value
+
+
+# Protocol headers
+
+def test_plain_header_is_version_1():
+    header = ft.FileHeader('report.pdf', 12345)
+    parsed = parse_header(header.pack())
+    assert parsed.version == 1
+    assert (parsed.name, parsed.size, parsed.flags, parsed.ext_flags) == ('report.pdf', 12345, 0, 0)
+
+
+def test_header_round_trips_checksum_stripe_and_resume():
+    digest = bytes(range(32))
+    header = ft.FileHeader('dir/naïve.bin', 1 << 40, flags=ft.FLAG_COMPRESS,
+                           checksum_algorithm=ft.CHECKSUM_SHA256, checksum=digest)
+    header.set_stripe(b'\x01' * 16, 1 << 20, 1 << 21, 3).set_resume(1700000000)
+    parsed = parse_header(header.pack())
+    assert parsed.name == 'dir/naïve.bin'
+    assert parsed.size == 1 << 40
+    assert parsed.flags == ft.FLAG_COMPRESS | ft.FLAG_CHECKSUM | ft.FLAG_STRIPE | ft.FLAG_RESUME
+    assert (parsed.checksum_algorithm, parsed.checksum) == (ft.CHECKSUM_SHA256, digest)
+    assert (parsed.transfer_id, parsed.stripe_offset, parsed.stripe_length, parsed.stripe_count) == \
+        (b'\x01' * 16, 1 << 20, 1 << 21, 3)
+    assert parsed.source_mtime == 1700000000
+
+
+def test_trailer_header_carries_no_digest():
+    parsed = parse_header(ft.FileHeader('a', 10).set_trailer(ft.CHECKSUM_CRC32).pack())
+    assert parsed.flags & ft.FLAG_TRAILER
+    assert (parsed.checksum_algorithm, parsed.checksum) == (ft.CHECKSUM_CRC32, b'')
+
+
+def test_dedup_header_is_version_2():
+    parsed = parse_header(ft.FileHeader('a', 10).set_dedup().pack())
+    assert parsed.version == 2
+    assert parsed.ext_flags == ft.EXT_FLAG_DEDUP
+
+
+def test_stream_header_is_version_3():
+    parsed = parse_header(ft.FileHeader('a', 0).set_stream().set_trailer(ft.CHECKSUM_SHA256).pack())
+    assert parsed.version == 3
+    assert parsed.ext_flags == ft.EXT_FLAG_STREAM
+    assert parsed.flags & ft.FLAG_TRAILER
+
+
+def test_header_with_bad_magic_is_refused():
+    data = bytearray(ft.FileHeader('a', 10).pack())
+    data[0] ^= 0xff
+    with pytest.raises(ft.ProtocolError):
+        parse_header(bytes(data))
+
+
+def test_stripe_outside_the_file_is_refused():
+    header = ft.FileHeader('a', 100).set_stripe(b'\0' * 16, 50, 51, 2)
+    with pytest.raises(ft.ProtocolError):
+        parse_header(header.pack())
+
+
+def test_response_round_trip():
+    status, offset = struct.unpack(ft.RESPONSE_FORMAT, ft.pack_response(ft.STATUS_INCOMPLETE, 4096))[2:]
+    assert (status, offset) == (ft.STATUS_INCOMPLETE, 4096)
+
+
+# Path sanitising
+
+def test_safe_path_keeps_folders_under_root(tmp_path):
+    assert ft.safe_path(str(tmp_path), 'photos/2024/./a.jpg') == os.path.join(str(tmp_path), 'photos', '2024', 'a.jpg')
+    assert ft.safe_path(str(tmp_path), 'photos\\b.jpg') == os.path.join(str(tmp_path), 'photos', 'b.jpg')
+
+
+@pytest.mark.parametrize('name', ['', '/', '../x', 'a/../../x', '/etc/passwd', '\\windows\\x', '.sft-store/chunks/x'])
+def test_safe_path_refuses_escapes(tmp_path, name):
+    with pytest.raises(ft.ProtocolError):
+        ft.safe_path(str(tmp_path), name)
+
+
+@pytest.mark.skipif(os.name == 'nt', reason="colons are only legal outside Windows")
+def test_safe_path_allows_colons_outside_windows(tmp_path):
+    assert ft.safe_path(str(tmp_path), 'logs/12:30:00.txt') == os.path.join(str(tmp_path), 'logs', '12:30:00.txt')
+
+
+@pytest.mark.skipif(not hasattr(os, 'symlink') or os.name == 'nt', reason="needs POSIX symlinks")
+def test_safe_path_refuses_symlinks_out_of_root(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    os.symlink(str(tmp_path), str(root / 'escape'))
+    with pytest.raises(ft.ProtocolError):
+        ft.safe_path(str(root), 'escape/x')
+
+
+# Rate limiting
+
+def test_token_bucket_without_rate_never_delays():
+    bucket = ft.TokenBucket(0)
+    bucket.take(1 << 30)
+    assert bucket.delay() == 0
+
+
+def test_token_bucket_delays_until_debt_is_paid():
+    rate = 1000
+    bucket = ft.TokenBucket(rate)
+    bucket.take(int(rate * ft.THROTTLE_BURST))
+    assert bucket.delay() == pytest.approx(0, abs=0.01)
+    bucket.take(500)
+    assert bucket.delay() == pytest.approx(0.5, abs=0.05)
+
+
+def test_token_bucket_rate_change_caps_the_burst():
+    bucket = ft.TokenBucket(1000000)
+    bucket.set_rate(100)
+    bucket.take(int(100 * ft.THROTTLE_BURST) + 100)
+    assert bucket.delay() == pytest.approx(1.0, abs=0.05)
+
+
+def test_throttle_slices_at_the_lowest_burst():
+    limiter = ft.RateLimiter(total=8000, per_host=0, per_transfer=4000)
+    throttle = limiter.open('127.0.0.1')
+    assert throttle.slice_size() == int(4000 * ft.THROTTLE_BURST)
+    limiter.set_limits(total=0, per_transfer=0)
+    assert throttle.slice_size() is None
+    throttle.close()
+    assert not limiter.hosts
+
+
+def test_job_limit_survives_a_new_default():
+    limiter = ft.RateLimiter(per_transfer=1000)
+    default, overridden = limiter.open('a'), limiter.open('a', 5000)
+    limiter.set_limits(per_transfer=2000)
+    assert (default.transfer.rate, overridden.transfer.rate) == (2000, 5000)
+    limiter.set_override(overridden, None)
+    assert overridden.transfer.rate == 2000
+
+
+# Delta sync
+
+def test_delta_rebuilds_an_edited_file(tmp_path):
+    generator = random.Random(7)
+    basis = bytes(generator.getrandbits(8) for _ in range(256 * 1024))
+    path = tmp_path / 'basis.bin'
+    path.write_bytes(basis)
+    block_size = ft.delta_block_size(len(basis))
+    signatures = list(struct.iter_unpack(ft.DELTA_SIGNATURE_FORMAT,
+                                         b''.join(ft.block_signatures(str(path), len(basis), block_size))))
+    assert len(signatures) == -(-len(basis) // block_size)
+    # An insertion shifts everything after it off the block grid
+    edited = basis[:100000] + b'inserted bytes' + basis[100000:]
+    rebuilt = bytearray()
+    literal = 0
+    for offset, length, first_block in ft.delta_ops(edited, block_size, signatures):
+        assert offset == len(rebuilt)
+        if first_block is None:
+            rebuilt += edited[offset:offset + length]
+            literal += length
+        else:
+            rebuilt += basis[first_block * block_size:first_block * block_size + length]
+    assert bytes(rebuilt) == edited
+    assert literal <= 2 * block_size + len(b'inserted bytes')
+
+
+def test_delta_op_outside_the_basis_is_refused():
+    with pytest.raises(ft.ProtocolError):
+        ft.delta_op_length(ft.DELTA_COPY, 3, 2, 1024, 4 * 1024, 10 * 1024)
+    with pytest.raises(ft.ProtocolError):
+        ft.delta_op_length(ft.DELTA_DATA, 11, 0, 1024, 0, 10)
+
+
+# Resume journal
+
+def test_journal_round_trip(tmp_path):
+    path = str(tmp_path / 'x.part.journal')
+    assert ft.read_journal(path) is None
+    ft.write_journal(path, {'size': 10, 'mtime': 5, 'offset': 4})
+    assert ft.read_journal(path) == {'size': 10, 'mtime': 5, 'offset': 4}
+    with open(path, 'w') as file:
+        file.write('{not json')
+    assert ft.read_journal(path) is None
+
+
+def test_partial_file_resumes_only_the_same_version(tmp_path):
+    full_path = str(tmp_path / 'big.bin')
+    header = ft.FileHeader('big.bin', 1000).set_resume(int(time.time()))
+    partial = ft.PartialFile(full_path, header)
+    partial.sink.write_at(b'x' * 400, 0)
+    assert partial.close(400) == 400
+    resumed = ft.PartialFile(full_path, header)
+    assert resumed.offset == 400
+    resumed.sink.write_at(b'y' * 600, 400)
+    resumed.close(600)
+    assert resumed.commit()
+    with open(full_path, 'rb') as file:
+        assert file.read() == b'x' * 400 + b'y' * 600
+    assert not os.path.exists(resumed.part_path) and not os.path.exists(resumed.journal_path)
+
+    stale = ft.PartialFile(full_path, header)
+    stale.close(300)
+    changed = ft.FileHeader('big.bin', 1000).set_resume(header.source_mtime + 1)
+    restarted = ft.PartialFile(full_path, changed)
+    assert restarted.offset == 0
+    restarted.close(0)
+
+
+# Stream sources
+
+def test_iter_source_reads_file_objects_in_chunks():
+    assert list(ft.iter_source(io.BytesIO(b'abcdefg'), 3)) == [b'abc', b'def', b'g']
+
+
+def test_iter_source_copies_reused_buffers_and_splits_large_items():
+    buffer = bytearray(b'1234')
+
+    def generate():
+        yield buffer
+        buffer[:] = b'5678'
+        yield buffer
+        yield b''
+        yield b'abcdefghij'
+
+    assert list(ft.iter_source(generate(), 4)) == [b'1234', b'5678', b'abcd', b'efgh', b'ij']
+
+
+# Imports
+
+def test_import_leaves_heavy_modules_unloaded():
+    # Checked in a fresh interpreter, as other tests load them
+    code = ("import sys, file_transfer; "
+            "print(' '.join(name for name in ('lzma', 'bz2', 'shutil', 'asyncio', 'multiprocessing') "
+            "if name in sys.modules))")
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(ft.__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    assert output.strip() == ''
+
+
+# Command line
+
+@pytest.mark.parametrize('options, announced', [([], False), (['--announce'], True)])
+def test_serve_announces_only_when_asked(tmp_path, monkeypatch, options, announced):
+    servers = []
+    monkeypatch.setattr(ft.ReceiveServer, 'start_server', lambda self: servers.append(self))
+    assert ft.main(['serve', '--host', '0.0.0.0', '--dir', str(tmp_path)] + options) == 0
+    assert (servers[0].announcer is not None) == announced
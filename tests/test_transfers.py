@@ -0,0 +1,381 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import file_transfer as ft
+
+ENGINES = ['threads', 'asyncio']
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(directory, engine, **kwargs):
+    server = ft.ReceiveServer(host='127.0.0.1', port=free_port(), save_directory=str(directory), engine=engine,
+                              **kwargs)
+    threading.Thread(target=server.server_loop, daemon=True).start()
+    deadline = time.time() + 5
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', server.port), timeout=1).close()
+            return server
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def run_jobs(client, jobs):
+    # Waits for (key, job) pairs and returns {key: (final state, detail)}
+    states = {}
+    details = {}
+
+    def collect(kind, key, value):
+        if kind == 'status' and value[1] in ft.ProgressBus.TERMINAL_STATES:
+            states[key] = value[1]
+        elif kind == 'detail':
+            details[key] = value
+
+    client.bus.subscribe(collect)
+    for key, job in jobs:
+        job.finished.wait(60)
+    client.bus.drain()
+    client.bus.unsubscribe(collect)
+    return {key: (states.get(key), details.get(key)) for key, job in jobs}
+
+
+def send(client, path, server, **kwargs):
+    return run_jobs(client, client.send(str(path), [f'127.0.0.1:{server.port}'], **kwargs))
+
+
+def make_file(path, size, seed=0):
+    data = bytes((i * 7 + seed) % 251 for i in range(size))
+    path.write_bytes(data)
+    return data
+
+
+def random_file(path, size):
+    data = os.urandom(size)
+    path.write_bytes(data)
+    return data
+
+
+def slow_digests(monkeypatch, seconds):
+    # Makes every whole-file hash take longer than the client's connect timeout
+    file_digest = ft.file_digest
+
+    def slow_digest(*args, **kwargs):
+        time.sleep(seconds)
+        return file_digest(*args, **kwargs)
+
+    monkeypatch.setattr(ft, 'CONNECT_TIMEOUT', 0.2)
+    monkeypatch.setattr(ft, 'file_digest', slow_digest)
+
+
+def leftovers(directory):
+    return sorted(name for name in os.listdir(str(directory)) if name.endswith(ft.PART_SUFFIX)
+                  or name.endswith(ft.JOURNAL_SUFFIX))
+
+
+@pytest.fixture
+def client():
+    client = ft.TransferClient()
+    yield client
+    client.close()
+
+
+# Both engines run the same handlers
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_send_with_checksum(tmp_path, client, engine, use_mmap):
+    server = start_server(tmp_path / 'in', engine, use_mmap=use_mmap)
+    data = make_file(tmp_path / 'a.bin', 3 * 1024 * 1024 + 17)
+    states = send(client, tmp_path / 'a.bin', server, verify_checksum=True, retries=0)
+    assert list(states.values()) == [('done', None)]
+    assert (tmp_path / 'in' / 'a.bin').read_bytes() == data
+    assert leftovers(tmp_path / 'in') == []
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_compressed_send(tmp_path, engine):
+    server = start_server(tmp_path / 'in', engine)
+    data = b'compressible ' * 200000
+    (tmp_path / 'a.txt').write_bytes(data)
+    client = ft.TransferClient(compression=ft.CODEC_ZLIB)
+    try:
+        states = send(client, tmp_path / 'a.txt', server, verify_checksum=True, retries=0)
+    finally:
+        client.close()
+    assert [state for state, detail in states.values()] == ['done']
+    assert (tmp_path / 'in' / 'a.txt').read_bytes() == data
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_folder_batch(tmp_path, client, engine):
+    server = start_server(tmp_path / 'in', engine)
+    folder = tmp_path / 'tree'
+    (folder / 'sub').mkdir(parents=True)
+    small = make_file(folder / 'small.txt', 100)
+    large = make_file(folder / 'sub' / 'large.bin', 200000, seed=1)
+    states = send(client, folder, server, verify_checksum=True)
+    assert [state for state, detail in states.values()] == ['done']
+    assert (tmp_path / 'in' / 'tree' / 'small.txt').read_bytes() == small
+    assert (tmp_path / 'in' / 'tree' / 'sub' / 'large.bin').read_bytes() == large
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_stream(tmp_path, client, engine):
+    server = start_server(tmp_path / 'in', engine)
+    chunks = [bytes([i]) * 100000 for i in range(30)]
+    jobs = client.send_stream(iter(chunks), 'log.bin', [f'127.0.0.1:{server.port}'], verify_checksum=True)
+    assert [state for state, detail in run_jobs(client, jobs).values()] == ['done']
+    assert (tmp_path / 'in' / 'log.bin').read_bytes() == b''.join(chunks)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_connection_cut_keeps_the_old_file(tmp_path, engine):
+    server = start_server(tmp_path / 'in', engine)
+    (tmp_path / 'in' / 'a.bin').write_bytes(b'old')
+    header = ft.FileHeader('a.bin', 1 << 20)
+    with socket.create_connection(('127.0.0.1', server.port)) as sock:
+        sock.sendall(header.pack())
+        sock.recv(ft.RESPONSE_SIZE)
+        sock.sendall(b'x' * 1000)
+    time.sleep(0.5)
+    assert (tmp_path / 'in' / 'a.bin').read_bytes() == b'old'
+    assert leftovers(tmp_path / 'in') == []
+
+
+def test_blocking_connection_never_suspends():
+    class Conn:
+        def __init__(self):
+            self.sent = []
+
+        def sendall(self, data):
+            self.sent.append(data)
+
+    conn = ft.BlockingConnection(Conn())
+
+    async def handler():
+        await conn.sendall(b'a')
+        return await conn.run_io(len, b'abc')
+
+    assert ft.run_blocking(handler()) == 3
+    assert conn.conn.sent == [b'a']
+
+
+# Resuming
+
+def interrupted_upload(server, path, sent):
+    # Sends the first `sent` bytes of a resumable upload and hangs up
+    header = ft.FileHeader(path.name, path.stat().st_size).set_resume(path.stat().st_mtime_ns)
+    with socket.create_connection(('127.0.0.1', server.port)) as sock:
+        sock.sendall(header.pack())
+        sock.recv(ft.RESPONSE_SIZE)
+        sock.sendall(path.read_bytes()[:sent])
+    time.sleep(0.5)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_resume_continues_at_the_journalled_offset(tmp_path, client, engine):
+    server = start_server(tmp_path / 'in', engine)
+    data = make_file(tmp_path / 'a.bin', 3 * 1024 * 1024)
+    interrupted_upload(server, tmp_path / 'a.bin', 2 * 1024 * 1024)
+    assert len(leftovers(tmp_path / 'in')) == 2
+    statuses = []
+    client.bus.subscribe(lambda kind, key, value: statuses.append(value[0]) if kind == 'status' else None)
+    states = send(client, tmp_path / 'a.bin', server, verify_checksum=True, retries=0)
+    assert [state for state, detail in states.values()] == ['done']
+    assert 'Resuming at 2048.0 KB...' in statuses
+    assert (tmp_path / 'in' / 'a.bin').read_bytes() == data
+    assert leftovers(tmp_path / 'in') == []
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_resumed_verify_waits_for_a_slow_hash(tmp_path, client, engine, monkeypatch):
+    # The resumed file is hashed from disk once complete, which takes longer than the connect timeout
+    server = start_server(tmp_path / 'in', engine)
+    data = random_file(tmp_path / 'a.bin', 3 * 1024 * 1024)
+    interrupted_upload(server, tmp_path / 'a.bin', 2 * 1024 * 1024)
+    slow_digests(monkeypatch, 1)
+    statuses = []
+    client.bus.subscribe(lambda kind, key, value: statuses.append(value[0]) if kind == 'status' else None)
+    states = send(client, tmp_path / 'a.bin', server, verify_checksum=True, retries=0)
+    assert list(states.values()) == [('done', None)]
+    assert 'Resuming at 2048.0 KB...' in statuses
+    assert (tmp_path / 'in' / 'a.bin').read_bytes() == data
+    assert leftovers(tmp_path / 'in') == []
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('options', [{}, {'delta': True}, {'dedup': True}])
+def test_concurrent_uploads_of_one_name_never_mix(tmp_path, engine, options):
+    # Throttled so the two uploads overlap
+    server = start_server(tmp_path / 'in', engine, transfer_rate_limit=4 * 1024 * 1024)
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    first = make_file(tmp_path / 'a' / 'same.bin', 4 * 1024 * 1024, seed=1)
+    second = make_file(tmp_path / 'b' / 'same.bin', 4 * 1024 * 1024 + 1, seed=2)
+    if options:
+        make_file(tmp_path / 'in' / 'same.bin', 1024 * 1024, seed=3)
+    client = ft.TransferClient(**options)
+    try:
+        jobs = client.send(str(tmp_path / 'a' / 'same.bin'), [f'127.0.0.1:{server.port}'], retries=0)
+        jobs += client.send(str(tmp_path / 'b' / 'same.bin'), [f'127.0.0.1:{server.port}'], retries=0)
+        states = run_jobs(client, jobs)
+    finally:
+        client.close()
+    assert [state for state, detail in states.values()] == ['done', 'done']
+    assert (tmp_path / 'in' / 'same.bin').read_bytes() in (first, second)
+    assert leftovers(tmp_path / 'in') == []
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_second_upload_of_the_same_file_is_refused_while_busy(tmp_path, engine):
+    server = start_server(tmp_path / 'in', engine, transfer_rate_limit=4 * 1024 * 1024)
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    first = make_file(tmp_path / 'a' / 'same.bin', 4 * 1024 * 1024, seed=1)
+    second = make_file(tmp_path / 'b' / 'same.bin', 4 * 1024 * 1024, seed=2)
+    # Same size and mtime: both map onto one part file
+    mtime = time.time() - 60
+    os.utime(str(tmp_path / 'a' / 'same.bin'), (mtime, mtime))
+    os.utime(str(tmp_path / 'b' / 'same.bin'), (mtime, mtime))
+    client = ft.TransferClient()
+    try:
+        jobs = client.send(str(tmp_path / 'a' / 'same.bin'), [f'127.0.0.1:{server.port}'], retries=0)
+        time.sleep(0.3)
+        jobs += client.send(str(tmp_path / 'b' / 'same.bin'), [f'127.0.0.1:{server.port}'], retries=0)
+        states = run_jobs(client, jobs)
+    finally:
+        client.close()
+    assert list(states.values()) == [('done', None), ('failed', ft.STATUS_MESSAGES[ft.STATUS_BUSY])]
+    assert (tmp_path / 'in' / 'same.bin').read_bytes() == first
+    assert leftovers(tmp_path / 'in') == []
+    # Retried once the first upload is done, it goes through
+    client = ft.TransferClient()
+    try:
+        assert [state for state, detail in send(client, tmp_path / 'b' / 'same.bin', server).values()] == ['done']
+    finally:
+        client.close()
+    assert (tmp_path / 'in' / 'same.bin').read_bytes() == second
+
+
+# Striping
+
+def send_stripe(server, data, transfer_id, index, count, digest=None):
+    # Sends stripe `index` of `count` equal ones by hand; returns the server's
+    # (status, offset) for the stripe, or its refusal
+    length = len(data) // count
+    header = ft.FileHeader('striped.bin', len(data)).set_stripe(transfer_id, index * length, length, count)
+    header.set_trailer(ft.CHECKSUM_SHA256)
+    with socket.create_connection(('127.0.0.1', server.port)) as sock:
+        conn = ft.Connection(sock)
+        sock.sendall(header.pack())
+        status, offset = ft.read_response(conn)
+        if status != ft.STATUS_OK or offset:
+            return status, offset
+        sock.sendall(data[index * length:(index + 1) * length])
+        sock.sendall(ft.pack_trailer(digest or hashlib.sha256(data).digest()))
+        return ft.read_response(conn)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_striped_send_waits_for_a_slow_verification(tmp_path, client, engine, monkeypatch):
+    server = start_server(tmp_path / 'in', engine)
+    data = random_file(tmp_path / 'big.bin', 2 * ft.MIN_STRIPE_SIZE + 12345)
+    slow_digests(monkeypatch, 1)
+    states = send(client, tmp_path / 'big.bin', server, streams=3, verify_checksum=True, retries=0)
+    assert list(states.values()) == [('done', None)]
+    assert (tmp_path / 'in' / 'big.bin').read_bytes() == data
+    assert leftovers(tmp_path / 'in') == []
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_only_the_last_stripe_confirms_the_file(tmp_path, engine):
+    server = start_server(tmp_path / 'in', engine)
+    data = os.urandom(2 * 1024 * 1024)
+    transfer_id = os.urandom(16)
+    assert send_stripe(server, data, transfer_id, 0, 2) == (ft.STATUS_OK, len(data) // 2)
+    assert send_stripe(server, data, transfer_id, 1, 2) == (ft.STATUS_OK, len(data))
+    # A retry after the file was placed is told so without sending anything
+    assert send_stripe(server, data, transfer_id, 1, 2) == (ft.STATUS_OK, len(data))
+    assert (tmp_path / 'in' / 'striped.bin').read_bytes() == data
+    assert leftovers(tmp_path / 'in') == []
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_stripe_retried_while_the_file_is_verified_is_refused(tmp_path, engine, monkeypatch):
+    server = start_server(tmp_path / 'in', engine)
+    data = os.urandom(2 * 1024 * 1024)
+    transfer_id = os.urandom(16)
+    slow_digests(monkeypatch, 1)
+    assert send_stripe(server, data, transfer_id, 0, 2) == (ft.STATUS_OK, len(data) // 2)
+    last = []
+    thread = threading.Thread(target=lambda: last.append(send_stripe(server, data, transfer_id, 1, 2)))
+    thread.start()
+    time.sleep(0.5)
+    # Must not truncate the part file being hashed
+    assert send_stripe(server, data, transfer_id, 1, 2) == (ft.STATUS_BUSY, 0)
+    thread.join()
+    assert last == [(ft.STATUS_OK, len(data))]
+    assert (tmp_path / 'in' / 'striped.bin').read_bytes() == data
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_striped_checksum_mismatch_is_final(tmp_path, engine):
+    server = start_server(tmp_path / 'in', engine)
+    data = os.urandom(2 * 1024 * 1024)
+    transfer_id = os.urandom(16)
+    wrong = bytes(32)
+    assert send_stripe(server, data, transfer_id, 0, 2, wrong) == (ft.STATUS_OK, len(data) // 2)
+    assert send_stripe(server, data, transfer_id, 1, 2, wrong) == (ft.STATUS_CHECKSUM_MISMATCH, 0)
+    assert send_stripe(server, data, transfer_id, 0, 2, wrong) == (ft.STATUS_CHECKSUM_MISMATCH, 0)
+    assert os.listdir(str(tmp_path / 'in')) == []
+
+
+# Scheduling
+
+def test_a_send_that_raises_fails_its_job(tmp_path, client, monkeypatch):
+    def broken(*args, **kwargs):
+        raise RuntimeError("broken send")
+
+    monkeypatch.setattr(client, 'send_file', broken)
+    make_file(tmp_path / 'a.bin', 1024)
+    logged = []
+    client.bus.subscribe(lambda kind, key, value: logged.append(value) if kind == 'log' else None)
+    jobs = client.send(str(tmp_path / 'a.bin'), ['127.0.0.1:1'])
+    assert run_jobs(client, jobs) == {jobs[0][0]: ('failed', 'broken send')}
+    job = jobs[0][1]
+    assert job.state == 'failed'
+    assert str(job.error) == 'broken send'
+    assert logged == ["Send failed unexpectedly: RuntimeError('broken send')"]
+
+
+def test_cancelling_a_queued_fan_out_target_detaches_it(tmp_path):
+    server = start_server(tmp_path / 'in', 'threads')
+    other = start_server(tmp_path / 'other', 'threads')
+    data = random_file(tmp_path / 'a.bin', 12 * 1024 * 1024)
+    client = ft.TransferClient(max_concurrency=2)
+    try:
+        # Keeps one worker busy, so the second target waits in the queue
+        release = threading.Event()
+        client.scheduler.submit(lambda hook: release.wait(60))
+        (key, running), (other_key, queued) = client.send(str(tmp_path / 'a.bin'), [
+            f'127.0.0.1:{server.port}', f'127.0.0.1:{other.port}'], chunk_size=1024 * 1024)
+        assert client.scheduler.cancel(queued.id) == 'queued'
+        reader, consumer = running.kwargs['fan_out']
+        assert list(reader.positions) == [consumer]
+        assert run_jobs(client, [(key, running)]) == {key: ('done', None)}
+        assert (tmp_path / 'in' / 'a.bin').read_bytes() == data
+        release.set()
+    finally:
+        client.close()